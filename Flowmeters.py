@@ -1,58 +1,146 @@
+import time
+from tools.startup import StartupTimer, lazyImport
+startup = StartupTimer()  # Times each startup step, the report is printed once the devices are connected
 import os
 import numpy as np
 from PyQt5 import QtWidgets, QtGui, QtCore
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
-import pyqtgraph as pg
+pg = lazyImport('pyqtgraph')  # Loaded when the plots are built, after the window is shown
 import qdarkstyle
-from datetime import datetime
 import sys
-import csv
 import yaml
-import time
-import matheson_fm as fm
+from tools.samples import HistoryStore, openSampleStore
+from tools.devices import readFlowmeters
+from tools.recording import readMetadata, writeMetadata
+from tools.writers import openWriter, runPath
+from tools.acquisition import Pacer
+from tools.scheduler import AcquisitionScheduler
+from tools.metrics import Metrics, MetricsExporter
+from tools.calibration import Calibration
+from tools.window import WorkerMixin, WindowMixin
+startup.mark('imports')
 
 # Loads settings from YAML file located in 'tools' directory  
 settingsFile = os.path.dirname(os.path.realpath(__file__))+"/tools/settings.yaml" 
 # settingsFile = "tools/settings.yaml" 
 with open(settingsFile, 'r') as stream:
-    settings = yaml.safe_load(stream)
+    settings = yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+startup.mark('settings')
+
+# Stage timings, recorded by the worker and the window
+metrics = Metrics(**settings['metrics'])
 
-class Worker(QtCore.QObject):
+# Flowmeter voltage to flow, one curve per gas
+calibration = Calibration(**settings['calibration'])
+
+class Worker(QtCore.QObject, WorkerMixin):
 
     running = pyqtSignal(bool)
     data = QtCore.pyqtSignal(object)
+    batch = QtCore.pyqtSignal(object)
+    progress = QtCore.pyqtSignal(str)
+    connected = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(object, str)  # the request that failed (None outside polled mode), the error
 
     @QtCore.pyqtSlot(str, str, int)
 
     def __init__(self): 
 
         QtCore.QThread.__init__(self)
-        self.fm = fm.fm()
+        self.settings = settings
+        self.fm = None  # Opened by connectDevices() in the worker thread
+        self.acquiring = False
+        self.channels = ['ai0', 'ai1']
+        self.gases = ['', '']
+        self.raw = None
+        self.rawTarget = None
         self.running.emit(True)
 
-    def getData(self, ):
+    def getData(self, request=None):
         
         self.running.emit(True)
         
-        fm0Data = self.fm.getData(channel = "ai0")
-        fm1Data = self.fm.getData(channel = "ai1")   
-        self.data.emit([fm0Data,fm1Data])  # Emit acquired data to update plot
+        # All enabled channels are sampled in one read and reduced here, the GUI only gets the statistics
+        try:
+            self.syncRaw()
+            record = readFlowmeters(self.fm, self.channels, raw=self.raw is not None, calibration=calibration, gases=self.gases)
+            metrics.record('read', record['duration'])
+            self.recordRaw(record)
+            record['emitted'] = time.perf_counter()
+            record['request'] = request
+            self.data.emit(record)  # Emit acquired data to update plot
+        except Exception as error:
+            self.failed.emit(request, str(error))
  
         self.running.emit(False)
 
+    def startAcquisition(self, rate, batch):
+
+        # Continuous mode: read at a fixed rate in this thread and send the samples
+        # to the GUI in batches of about `batch` seconds until stopAcquisition().
+        # A read error ends the loop, the samples read until then and running(False)
+        # are always sent so the GUI can close its file
+        self.acquiring = True
+        self.running.emit(True)
+        pacer = Pacer(rate)
+        channels = list(self.channels)
+        gases = list(self.gases)
+        rows = list()
+        sent = time.monotonic()
+        error = None
+        try:
+            while self.acquiring:
+                pacer.wait()
+                self.syncRaw()
+                record = readFlowmeters(self.fm, channels, raw=self.raw is not None, calibration=calibration, gases=gases)
+                metrics.record('read', record['duration'])
+                self.recordRaw(record)
+                rows.append([record['start'], record['end']] + list(record['stats']['mean']) + list(record['flow']) + list(record['stats']['std']))
+                if time.monotonic() - sent >= batch:
+                    self.sendBatch(channels, rows, pacer)
+                    rows = list()
+                    sent = time.monotonic()
+        except Exception as exception:
+            error = str(exception)
+        finally:
+            # The last batch carries the totals of the run, even when it has no rows
+            self.acquiring = False
+            self.sendBatch(channels, rows, pacer)
+            if error is not None:
+                self.failed.emit(None, error)
+            self.running.emit(False)
+
+    def sendBatch(self, channels, rows, pacer):
+
+        data = np.array(rows, dtype=float).reshape(len(rows), 2 + 3 * len(channels)).T
+        self.batch.emit({'channels': channels, 'data': data, 'stats': pacer.stats(), 'emitted': time.perf_counter()})
+
+    def stopAcquisition(self):
+
+        # Called directly from the GUI thread since the loop above keeps this
+        # worker's event queue busy until it returns
+        self.acquiring = False
+
     def status(self) :
 
         self.running.emit()
 
 
-class MainWindow(QtWidgets.QMainWindow):
+class MainWindow(QtWidgets.QMainWindow, WindowMixin):
 
     work_getData = QtCore.pyqtSignal(int)  # Define a signal that emits integers
+    work_startAcquisition = QtCore.pyqtSignal(float, float)
+    work_setChannels = QtCore.pyqtSignal(object)
+    work_connect = QtCore.pyqtSignal()
+    work_syncRaw = QtCore.pyqtSignal()
 
     def __init__(self):
         super(MainWindow, self).__init__()
+        self.settings = settings
+        self.metrics = metrics
+        self.calibration = calibration
         self.setContentsMargins(140, 40, 10, 10)
         self.setWindowTitle("Flowmeter 4.3") 
         self.setWindowIcon(QtGui.QIcon('icons/UHV Channels.ico'))
@@ -64,33 +152,35 @@ class MainWindow(QtWidgets.QMainWindow):
         self.worker.data.connect(self.getData)  # Signal to update plot with data        
         self.worker.running.connect(self.getStatus)
         self.work_getData.connect(self.worker.getData)
-        self.worker_thread.start()       
+        self.worker.batch.connect(self.getBatch)
+        self.work_startAcquisition.connect(self.worker.startAcquisition)
+        self.work_setChannels.connect(self.worker.setChannels)
+        self.work_connect.connect(self.worker.connectDevices)
+        self.work_syncRaw.connect(self.worker.syncRaw)
+        self.worker.progress.connect(self.statusBar().showMessage)
+        self.worker.connected.connect(self.devicesConnected)
+        self.worker.failed.connect(self.readFailed)
+        self.worker_thread.start()
+        self.deviceReady = False       
+
+        # 'polled' reads once per timer tick, 'continuous' lets the worker read at its own rate
+        self.continuous = settings['acquisition']['mode'] == 'continuous'
+        self.acquiring = False
+        self.draining = False
+        self.acquisitionStats = None
 
         # Initial values for plotting 
-        self.data0 = list()
-        self.data1 = list()
-        self.time = list()
-        self.time0 = time.time()
+        rate = settings['acquisition']['rate'] if self.continuous else 1000 / settings['acquisition']['refresh']
+        self.samples = openSampleStore(['time', 'time end', 'chan0', 'chan1', 'flow0', 'flow1', 'noise0', 'noise1'], settings, rate)
+        self.startClock()
+        self.writer = None
+        self.saved = 0
          
-        # Add labels to the plot 
-        self.plot_analog = pg.PlotWidget() 
-        self.setCentralWidget(self.plot_analog)
-        font = QtGui.QFont("Arial", 15)
-        self.plot_analog.setGeometry(150, 50, 600, 400)  # Adjust geometry as needed
-        self.plot_analog.setBackground("w")
-        self.plot_analog.setTitle("Flowmeter Input Data ", color = "k")
-        self.plot_analog.setLabel('left', text='Voltage  (v)', color = "k")
-        self.plot_analog.getAxis('bottom').setPen('black')
-        self.plot_analog.getAxis("bottom").label.setFont(font)
-        self.plot_analog.getAxis('bottom').setTextPen('black')
-        self.plot_analog.getAxis("bottom").setTickFont(font)
-        self.plot_analog.getAxis("bottom").setTickFont(font)
-        self.plot_analog.getAxis("left").label.setFont(font)
-        self.plot_analog.getAxis('left').setPen('black')
-        self.plot_analog.getAxis('left').setTextPen('black')
-        self.plot_analog.getAxis("left").setTickFont(font)
-        self.plot_analog.setLabel('bottom', text='Time (s)', color = "k")          
-        self.legend = self.plot_analog.addLegend()  
+        self.curves = dict()
+        self.plotSelection = None
+        self.plotFlow = False
+        self.plotted = -1
+        self.viewRange = None
 
 
         fontsize_small = 10 
@@ -112,6 +202,14 @@ class MainWindow(QtWidgets.QMainWindow):
         self.checkbox_Save.setStyleSheet('QLineEdit {background-color: white; color: black;}')
         self.checkbox_Save.setFont(QtGui.QFont('Arial', fontsize_small))
 
+        self.checkbox_Diagnostics = QCheckBox(self)
+        self.checkbox_Diagnostics.setText('Diagnostics')
+        self.checkbox_Diagnostics.setCheckable(True)
+        self.checkbox_Diagnostics.resize(100, 30)
+        self.checkbox_Diagnostics.move(10, 410)
+        self.checkbox_Diagnostics.setFont(QtGui.QFont('Arial', fontsize_small))
+        self.checkbox_Diagnostics.toggled.connect(self.showDiagnostics)
+
         self.textbox_File = QLabel(self)
         self.textbox_File.move(350,10)
         self.textbox_File.resize(400,30)
@@ -154,6 +252,18 @@ class MainWindow(QtWidgets.QMainWindow):
         self.chan = self.combobox_Chan1.currentIndex()
         self.combobox_Chan1.addItems(settings['gases'])
 
+        # Flowmeter channels: (checkbox, combobox, DAQ channel, column in self.samples, plot color)
+        # More flowmeters only need another checkbox/combobox pair added here
+        self.channels = [(self.checkbox_Chan0, self.combobox_Chan0, 'ai0', 'chan0', 'r'),
+                         (self.checkbox_Chan1, self.combobox_Chan1, 'ai1', 'chan1', 'k')]
+        self.samples.reset(['time', 'time end'] + [column for checkbox, combobox, channel, column, color in self.channels]
+                           + [self.flowColumn(column) for checkbox, combobox, channel, column, color in self.channels]
+                           + [self.noiseColumn(column) for checkbox, combobox, channel, column, color in self.channels])
+        for checkbox, combobox, channel, column, color in self.channels:
+            checkbox.toggled.connect(self.setChannels)
+            combobox.currentTextChanged.connect(self.setChannels)
+        self.setChannels()
+
 
         # Adding widgets to layout
         layout = QtWidgets.QVBoxLayout()
@@ -161,7 +271,10 @@ class MainWindow(QtWidgets.QMainWindow):
         # Create a main layout for central widget
         mainLayout = QtWidgets.QHBoxLayout()
         mainLayout.addLayout(layout)
-        mainLayout.addWidget(self.plot_analog)
+        self.label_Loading = QLabel('Loading plots...')
+        self.label_Loading.setAlignment(QtCore.Qt.AlignCenter)
+        mainLayout.addWidget(self.label_Loading)
+        self.mainLayout = mainLayout
 
         centralWidget = QtWidgets.QWidget()
         centralWidget.setLayout(mainLayout)
@@ -169,54 +282,128 @@ class MainWindow(QtWidgets.QMainWindow):
 
         # Timer
         self.timer = QtCore.QTimer()
-        self.timer.setInterval(500)  
+        self.timer.setInterval(settings['acquisition']['refresh'])  
         self.timer.timeout.connect(self.mainLoop)
-        self.timer.start()
+
+        # Polled reads go through the scheduler, which keeps at most one request in flight
+        self.scheduler = AcquisitionScheduler(self.timer.interval(), window=settings['acquisition']['window'], timeout=settings['acquisition']['timeout'])
+        self.scheduler.request.connect(self.requestData)
+        self.scheduler.warning.connect(self.rateWarning)
+        self.label_Rate = QLabel('')
+        self.label_Rate.setStyleSheet('color: red')
+        self.statusBar().addPermanentWidget(self.label_Rate)
+
+        # Stage latencies: optional panel, metrics file and localhost endpoint from settings
+        self.diagnostics = None
+        self.exporter = MetricsExporter(metrics, **settings['metrics']).start()
+        self.lastTick = None
+        self.checkbox_Diagnostics.setChecked(settings['metrics']['panel'])
 
 
         self.show()            
+        startup.mark('window')
+        QtCore.QTimer.singleShot(0, self.finishStartup)
+
+    def buildPlots(self):
+
+        # Add labels to the plot 
+        self.plot_analog = pg.PlotWidget() 
+        font = QtGui.QFont("Arial", 15)
+        self.plot_analog.setGeometry(150, 50, 600, 400)  # Adjust geometry as needed
+        self.plot_analog.setBackground("w")
+        self.plot_analog.setTitle("Flowmeter Input Data ", color = "k")
+        self.plot_analog.setLabel('left', text='Voltage  (v)', color = "k")
+        self.plot_analog.getAxis('bottom').setPen('black')
+        self.plot_analog.getAxis("bottom").label.setFont(font)
+        self.plot_analog.getAxis('bottom').setTextPen('black')
+        self.plot_analog.getAxis("bottom").setTickFont(font)
+        self.plot_analog.getAxis("bottom").setTickFont(font)
+        self.plot_analog.getAxis("left").label.setFont(font)
+        self.plot_analog.getAxis('left').setPen('black')
+        self.plot_analog.getAxis('left').setTextPen('black')
+        self.plot_analog.getAxis("left").setTickFont(font)
+        self.plot_analog.setLabel('bottom', text='Time (s)', color = "k")          
+        self.legend = self.plot_analog.addLegend()  
+        self.plot_analog.setClipToView(True)
+        self.plot_analog.setDownsampling(auto=True, mode='peak')
+        self.plot_analog.getViewBox().sigXRangeChanged.connect(self.viewChanged)
+
+        # Takes the place of the placeholder shown while pyqtgraph was loading
+        self.mainLayout.replaceWidget(self.label_Loading, self.plot_analog)
+        self.label_Loading.deleteLater()
+
+    def finishStartup(self):
+
+        # Runs once the window is on screen: plots, then the timer, then the devices in the worker thread
+        startup.mark('window shown')
+        self.statusBar().showMessage('Loading plots...')
+        QtWidgets.QApplication.processEvents()
+        self.buildPlots()
+        startup.mark('plots (pyqtgraph)')
+        self.timer.start()
+        self.work_connect.emit()
+
+    def devicesConnected(self, status):
+
+        if 'flowmeter' in status:
+            self.deviceReady = status['flowmeter']
+            if self.deviceReady:
+                startup.mark('flowmeter connected')
+                self.statusBar().showMessage('Flowmeter connected', 5000)
+            else:
+                startup.mark('flowmeter failed')
+                self.statusBar().showMessage('Flowmeter not connected: '+status['error'])
+                print('Flowmeter not connected: '+status['error'])
+            print(startup.report())
 
 
 
     def mainLoop(self):    
 
-        if self.checkbox_Chan0.isChecked() | self.checkbox_Chan1.isChecked() | (self.checkbox_Chan0.isChecked() & self.checkbox_Chan1.isChecked()) :
+        # Lateness of this tick, slow repaints or saves on the GUI thread show up here
+        now = time.perf_counter()
+        if self.lastTick is not None:
+            metrics.record('gui_lag', max(now - self.lastTick - self.timer.interval() / 1000, 0.0))
+        self.lastTick = now
+
+        if self.deviceReady and len(self.channelSelection()) > 0 :
  
             self.button_go.setEnabled(True) 
-            self.combobox_Chan0.setEnabled(True)
-            self.combobox_Chan1.setEnabled(True)
-            self.checkbox_Chan0.setEnabled(True)
-            self.checkbox_Chan1.setEnabled(True) 
+            for checkbox, combobox, channel, column, color in self.channels:
+                combobox.setEnabled(True)
+                checkbox.setEnabled(True) 
             self.checkbox_Save.setStyleSheet('QLineEdit {background-color: white; color: black;}')
   
             if self.button_go.isChecked(): 
 
-                self.work_getData.emit(self)
+                if not self.continuous:
+                    self.scheduler.tick()
+                elif not (self.acquiring or self.draining):
+                    self.acquiring = True
+                    self.work_startAcquisition.emit(settings['acquisition']['rate'], settings['acquisition']['batch'])
                 
                 self.checkbox_Save.setStyleSheet('QLineEdit {background-color: white; color: black;}')
                 
 
                 if self.checkbox_Save.isChecked() :  # should make an if statement regard when there is only 0(index) to not get error for the -1
-                    self.save()                 
+                    with metrics.timed('save'):
+                        self.save()                 
 
-                self.updatePlot()   
+                with metrics.timed('updatePlot'):
+                    self.updatePlot()   
 
                 self.button_go.setText('Stop')
                 self.button_go.setStyleSheet("background-color: red")
                 self.checkbox_Save.setEnabled(False) 
 
                 if  self.go:
- 
-                    self.plot_analog.clear()
-
-                    self.updatePlot()   
 
                     self.button_go.setText('Stop')
                     self.button_go.setStyleSheet("background-color: red")
                     self.checkbox_Save.setEnabled(False) 
                 else :
                     self.reset() 
-                    self.time0 = time.time() 
+                    self.startClock()
                 
                 self.go = True
 
@@ -226,7 +413,12 @@ class MainWindow(QtWidgets.QMainWindow):
                 self.checkbox_Save.setEnabled(True)
                 self.checkbox_Save.setText('Save')
                 self.checkbox_Save.setStyleSheet('QLineEdit {background-color: white; color: black;}') 
-                self.go = False 
+                self.stopAcquisition()
+                # The last batch or read still on its way is saved before the file is closed, on a later tick
+                if not (self.scheduler.waiting() or self.draining):
+                    self.stopPolling()
+                    self.closeWriter()
+                    self.go = False 
                 
         else:
             self.button_go.setEnabled(False)
@@ -241,149 +433,202 @@ class MainWindow(QtWidgets.QMainWindow):
 
             self.go = True 
             self.reset()
-            self.time0 = time.time()  
-
-            now = datetime.now()
-            folder = settings['data']['folder'] 
-            folder = folder+f'{now.year:04d}'+'/'+f'{now.year:04d}'+'.'+f'{now.month:02d}'+'.'+f'{now.day:02d}'+'/'
-            os.makedirs(folder, exist_ok=True) 
-
+            self.startClock()
 
-            file = 'prc'+f'{now.year:04d}'+f'{now.month:02d}'+f'{now.day:02d}'+'_'+f'{now.hour:02d}'+f'{now.minute:02d}'+f'{now.second:02d}'
-            self.path = folder+file
+            self.path, self.file = runPath(settings['data']['folder'])
+            file = self.file
             self.textbox_File.setText('File: '+file)
             print('Saving to file: '+self.path)
 
-            with open(self.path+'.csv', "w", newline='') as TFile:
-
-                TWriter = csv.writer(TFile, delimiter=',')
-
-                if self.checkbox_Chan0.isChecked() & self.checkbox_Chan1.isChecked() :
-                            
-                    name0 = self.combobox_Chan0.currentText()  # Get the selected item from combobox_Chan0
-                    name1 = self.combobox_Chan1.currentText()  # Get the selected item from combobox_Chan1
-
-                    TWriter.writerow([name0, name1])
-
-                    # if (len(self.data0) > 1 ) & (len(self.data1) > 1):
-                    #     TWriter.writerow([self.data0[-1], self.data1[-1]])
-                    #     print("getting data: " + str(self.data0[-1])) 
-
-                elif self.checkbox_Chan0.isChecked():
-
-                    name0 = self.combobox_Chan0.currentText()  # Get the selected item from combobox_Chan0 
-
-                    TWriter.writerow([name0])
-
-                    # if len(self.data0) > 1:
-                    #     TWriter.writerow([self.data0[-1]])
-                         
-                        
-                elif self.checkbox_Chan1.isChecked():
-                    
-                    name1 = self.combobox_Chan1.currentText()  # Get the selected item from combobox_Chan1
-                    TWriter.writerow([name1])
-
-                    # if len(self.data1) > 1:
-                    #     TWriter.writerow([self.data1[-1]])
+            # The file stays open for the whole run, rows are flushed in batches
+            header = [name for column, name in self.savedColumns()]  # Gas selected for each enabled channel, then their flows and the read times
+            self.writer = openWriter(self.path, header, settings['data'])
+            self.saveParameters()
+            self.startRaw()
         
         else:
 
-            with open(self.path+'.csv', "a", newline='') as TFile:
-                TWriter = csv.writer(TFile, delimiter=',')
-
-                if self.checkbox_Chan0.isChecked() & self.checkbox_Chan1.isChecked() : 
-                    if (len(self.data0) > 1 ) & (len(self.data1) > 1):
-                        TWriter.writerow([self.data0[-1], self.data1[-1]])
-
-                elif self.checkbox_Chan0.isChecked():
-                    if len(self.data0) > 1:
-                        TWriter.writerow([self.data0[-1]])
-                    
-                elif self.checkbox_Chan1.isChecked():
-                    
-                    if len(self.data1) > 1:
-                        TWriter.writerow([self.data1[-1]])
+            self.writeRows()
+
+            self.textbox_File.setText('File: '+self.file+' ('+str(self.writer.pending)+' rows pending)')
+
+    def writeRows(self):
+
+        # Write every sample added since the last save, a tick can bring several in continuous mode
+        rows = [self.samples.index[column] for column, name in self.savedColumns()]
+        new = min(self.samples.total - self.saved, len(self.samples))
+        if new > 0:
+            for row in self.samples.view()[rows, -new:].T.tolist():
+                self.writer.writerow(row)
+        self.saved = self.samples.total
+
+    def closeWriter(self):
+
+        if self.writer is not None:
+            self.writeRows()
+            pending = self.writer.pending
+            self.writer.close()
+            # Sampling jitter of the run
+            par = readMetadata(self.path)
+            par['timing'] = self.timing.summary()
+            writeMetadata(self.path, par)
+            print(self.timing.report())
+            self.worker.rawTarget = None
+            self.work_syncRaw.emit()
+            self.writer = None
+            print('Closed file: '+self.path+' ('+str(pending)+' pending rows flushed)')
+            self.textbox_File.setText('File: '+self.file)
 
     def updatePlot(self):
         # Method to update plot with acquired data
-        
-        self.plot_analog.clear()
 
-        if self.checkbox_Chan0.isChecked() & self.checkbox_Chan1.isChecked() :
-            name0 = self.combobox_Chan0.currentText()  # Get the selected item from combobox_Chan0
-            name1 = self.combobox_Chan1.currentText()  # Get the selected item from combobox_Chan1
-          
-            self.plot_analog.plot(self.time, self.data0, pen="r", name = name0)
-            self.plot_analog.plot(self.time, self.data1, pen="k", name = name1)                
-            self.plot_analog.plot(self.time, self.data0, symbol='+', pen="r", size=8, symbolBrush=pg.mkBrush('r'))
-            self.plot_analog.plot(self.time, self.data1, symbol='+', pen="k", size=8, symbolBrush=pg.mkBrush('k'))
-            self.combobox_Chan0.setEnabled(False)
-            self.combobox_Chan1.setEnabled(False)
-
-            self.checkbox_Chan0.setEnabled(False)
-            self.checkbox_Chan1.setEnabled(False)
-
-        elif self.checkbox_Chan0.isChecked():
-            name0 = self.combobox_Chan0.currentText()  # Get the selected item from combobox_Chan0
-          
-            self.plot_analog.plot(self.time, self.data0, pen="r", name = name0)
-            self.plot_analog.plot(self.time, self.data0, symbol='+', pen="r", size=8, symbolBrush=pg.mkBrush('r'))
-            self.combobox_Chan0.setEnabled(False)
-            self.combobox_Chan1.setEnabled(False)
-
-            self.checkbox_Chan0.setEnabled(False)
-            self.checkbox_Chan1.setEnabled(False)
-
-        elif self.checkbox_Chan1.isChecked():
-            name1 = self.combobox_Chan1.currentText()  # Get the selected item from combobox_Chan1
-          
-            self.plot_analog.plot(self.time, self.data1, pen="k", name = name1)
-            self.plot_analog.plot(self.time, self.data1, symbol='+', pen="k", size=8, symbolBrush=pg.mkBrush('k'))   
-            self.combobox_Chan0.setEnabled(False)
-            self.combobox_Chan1.setEnabled(False)
-
-            self.checkbox_Chan0.setEnabled(False)
-            self.checkbox_Chan1.setEnabled(False)
+        # Curves are only rebuilt when the channel selection changes
+        selection = self.channelSelection()
+        if selection != self.plotSelection:
+            self.buildCurves(selection)
+
+        # Skip the redraw when nothing new has arrived since the last tick
+        if self.samples.total != self.plotted:
+            data = self.plotData()
+            t = data[self.samples.index['time']]
+            for column, curve in self.curves.items():
+                curve.setData(t, data[self.samples.index[self.flowColumn(column) if self.plotFlow else column]])
+            self.plotted = self.samples.total
+
+        if len(selection) > 0:
+            for checkbox, combobox, channel, column, color in self.channels:
+                combobox.setEnabled(False)
+                checkbox.setEnabled(False)
+
+    def plotData(self):
+
+        # The min/max envelope when there are more samples than pixels, so the
+        # cost of a redraw does not grow with the length of the run
+        data = self.samples.envelope(self.viewRange, self.plot_analog.getViewBox().width())
+        if data is not None:
+            return data
+        # Otherwise the samples themselves, with a view's width either side
+        t0, t1 = self.viewRange if self.viewRange is not None else (-np.inf, np.inf)
+        return self.samples.history(2 * t0 - t1, 2 * t1 - t0)
+
+    def buildCurves(self, selection):
+
+        for curve in self.curves.values():
+            self.plot_analog.removeItem(curve)
+        self.curves = dict()
+        for column, name, color in selection:
+            self.curves[column] = self.plot_analog.plot(pen=color, name=name, symbol='+', symbolSize=8, symbolPen=color, symbolBrush=pg.mkBrush(color))
+        # Flow is plotted only when every gas shown has a calibration curve
+        self.plotFlow = calibration.plot and (len(selection) > 0) and all(name in calibration for column, name, color in selection)
+        self.plot_analog.setLabel('left', text='Flow  ('+calibration.unit+')' if self.plotFlow else 'Voltage  (v)', color = "k")
+        self.plotSelection = selection
+        self.plotted = -1
+
+    def savedColumns(self):
+
+        # (column, header) of the saved data: the voltage of each enabled channel, the flow of those
+        # with a calibrated gas, the noise of each voltage, then the start and end of each read on the monotonic clock
+        selection = self.channelSelection()
+        return ([(column, name) for column, name, color in selection]
+                + [(self.flowColumn(column), calibration.name(name)) for column, name, color in selection if name in calibration]
+                + [(self.noiseColumn(column), name+' noise (v)') for column, name, color in selection]
+                + [('time', 'Flowmeter start (s)'), ('time end', 'Flowmeter end (s)')])
 
     def getData(self,data) :
 
-
-        if self.checkbox_Chan0.isChecked() & self.checkbox_Chan1.isChecked() :
-            data0_mean = np.mean(data[0])
-            data1_mean = np.mean(data[1])
-            self.data0.append(data0_mean)
-            self.data1.append(data1_mean)
-            self.time.append(time.time() - self.time0)
-            
-        elif self.checkbox_Chan0.isChecked():
-            data0_mean = np.mean(data[0]) 
-            self.data0.append(data0_mean)
-            self.time.append(time.time() - self.time0)
-
-        elif self.checkbox_Chan1.isChecked():
-            data1_mean = np.mean(data[1]) 
-            self.data1.append(data1_mean)
-            self.time.append(time.time() - self.time0)
+        start = time.perf_counter()
+        metrics.record('delivery', start - data['emitted'])
+        self.scheduler.completed(data.get('request'))
+
+        # Disabled channels are stored as NaN so every column shares the time axis,
+        # the times are the start and end of the read in the worker
+        sample = {'time': data['start'] - self.t0, 'time end': data['end'] - self.t0}
+        self.timing.add('flowmeter', data['start'], data['end'])
+        for channel, stats, flow in zip(data['channels'], data['stats'], data['flow']):
+            sample[self.channelColumn(channel)] = stats['mean']
+            sample[self.flowColumn(self.channelColumn(channel))] = flow
+            sample[self.noiseColumn(self.channelColumn(channel))] = stats['std']
+        if len(sample) > 2:
+            self.samples.append(sample)
+        metrics.record('getData', time.perf_counter() - start)
+
+    def getBatch(self, batch):
+
+        # Samples from the worker's continuous loop, rows are the start and end of each read,
+        # the voltage of each channel read, the flow of each channel read, then the noise of each voltage.
+        # The batches sent after stopAcquisition() are kept until the loop has returned
+        if not (self.acquiring or self.draining):
+            return
+        start = time.perf_counter()
+        metrics.record('delivery', start - batch['emitted'])
+        block = batch['data']
+        columns = np.full((len(self.samples.columns), block.shape[1]), np.nan)
+        columns[self.samples.index['time']] = block[0] - self.t0
+        columns[self.samples.index['time end']] = block[1] - self.t0
+        self.timing.add('flowmeter', block[0], block[1])
+        for idx, channel in enumerate(batch['channels']):
+            columns[self.samples.index[self.channelColumn(channel)]] = block[idx + 2]
+            columns[self.samples.index[self.flowColumn(self.channelColumn(channel))]] = block[idx + 2 + len(batch['channels'])]
+            columns[self.samples.index[self.noiseColumn(self.channelColumn(channel))]] = block[idx + 2 + 2 * len(batch['channels'])]
+        self.samples.extend(columns)
+        metrics.record('getData', time.perf_counter() - start)
+        self.acquisitionStats = batch['stats']
+        stats = self.acquisitionStats
+        self.statusBar().showMessage(f"{stats['rate']:.1f} Hz, {stats['late']} late, {stats['dropped']} dropped")
+
+    def stopAcquisition(self):
+
+        if self.acquiring:
+            self.worker.stopAcquisition()
+            self.acquiring = False
+            self.draining = True  # until the worker's loop has returned
 
     def getStatus(self, running):
         
         self.running = running
+        if (not running) and self.draining :
+            # The continuous loop has returned, its last batch had the totals
+            self.draining = False
+            if self.acquisitionStats is not None:
+                stats = self.acquisitionStats
+                print(f"Acquisition stopped: {stats['samples']} samples at {stats['rate']:.1f} Hz, {stats['late']} late, {stats['dropped']} dropped")
 
     def reset(self):
 
-        self.data0 = []
-        self.data1 = []
-        self.time = []
+        self.samples.reset()
+        self.saved = 0
+        self.acquisitionStats = None
         self.plot_analog.clear()
+        self.curves = dict()
+        self.plotSelection = None
+        self.viewRange = None
 
     def closeEvent(self, event):
         # Clean up when closing the application
+        self.timer.stop()
+        self.stopAcquisition()
+        self.stopPolling()
+        # The batch the worker sends when its loop returns is delivered before the file is closed
         self.worker_thread.quit()
         self.worker_thread.wait()
+        QtCore.QCoreApplication.processEvents()
+        self.closeWriter()
+        self.worker.syncRaw()  # The worker thread has stopped, its raw recording is closed from here
+        self.exporter.stop()
+        if self.diagnostics is not None:
+            self.diagnostics.close()
+        if isinstance(self.samples, HistoryStore):
+            self.samples.close()
    
 if __name__ == "__main__":
     app = QtWidgets.QApplication(sys.argv)
+    startup.mark('QApplication')
     app.setStyleSheet(qdarkstyle.load_stylesheet())
-    w = MainWindow()
+    startup.mark('style')
+    if '--attach' in sys.argv:
+        # Only view the run recorded by tools.daemon, no device is opened
+        from tools.viewer import ViewerWindow
+        w = ViewerWindow(settings, title='Flowmeter')
+    else:
+        w = MainWindow()
     app.exec_()
\ No newline at end of file
@@ -1,31 +1,52 @@
+import time
+from tools.startup import StartupTimer, lazyImport
+startup = StartupTimer()  # Times each startup step, the report is printed once the devices are connected
 import os
 import numpy as np
 from PyQt5 import QtWidgets, QtGui, QtCore
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
-import pyqtgraph as pg
+pg = lazyImport('pyqtgraph')  # Loaded when the plots are built, after the window is shown
 import qdarkstyle
-from datetime import datetime
 import sys
-import csv
 import yaml
-import time
-import matheson_fm as fm
 import re
-from srsinst.rga import RGA100 as srs_rga
+from concurrent.futures import ThreadPoolExecutor
+from tools.samples import HistoryStore, SpectrumStore, openSampleStore
+from tools.devices import openRGA, readFlowmeters, switchOnRGA, switchOffRGA, readCycle, clock
+from tools.writers import openWriter, runPath
+from tools.recording import readMetadata, writeMetadata
+from tools.acquisition import Pacer
+from tools.scheduler import AcquisitionScheduler, MassScheduler
+from tools.metrics import Metrics, MetricsExporter
+from tools.calibration import Calibration
+from tools.livelog import LiveLog
+from tools.window import WorkerMixin, WindowMixin
+startup.mark('imports')
 
 settingsFile = os.path.dirname(os.path.realpath(__file__))+"/tools/settings.yaml" 
 # settingsFile = "tools/settings.yaml" 
 with open(settingsFile, 'r') as stream:
-    settings = yaml.safe_load(stream)
+    settings = yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+startup.mark('settings')
+
+# Stage timings, recorded by the worker and the window
+metrics = Metrics(**settings['metrics'])
+
+# Flowmeter voltage to flow, one curve per gas
+calibration = Calibration(**settings['calibration'])
 
-class Worker(QtCore.QObject):
+class Worker(QtCore.QObject, WorkerMixin):
 
     running = pyqtSignal(bool)
     data = QtCore.pyqtSignal(object)
     # go = pyqtSignal(bool) ###
     masses = pyqtSignal(object)
+    spectrum = pyqtSignal(object)
+    progress = pyqtSignal(str)
+    connected = pyqtSignal(object)
+    failed = pyqtSignal(object, str)  # the request that failed (None for scans), the error
 
 
     @QtCore.pyqtSlot(str, str, int)
@@ -33,46 +54,147 @@ class Worker(QtCore.QObject):
     def __init__(self): 
 
         QtCore.QThread.__init__(self)
-        self.fm = fm.fm()
+        self.settings = settings
+        self.fm = None  # Opened by connectDevices() in the worker thread
         self.running.emit(True)
         self.rgaOn = False ###
         self.masses = []
-
-    def getData(self):
+        self.massScheduler = MassScheduler([], **settings['srs']['rga100']['schedule'])
+        self.channels = ['ai0', 'ai1']
+        self.gases = ['', '']
+        self.scanning = False
+        self.cycling = False
+        self.raw = None
+        self.rawTarget = None
+        # One thread per device so the DAQ and the serial RGA are read at the same time
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='device')
+
+    def getData(self, request=None):
         
         self.running.emit(True)
-        
-        fm0Data = self.fm.getData(channel = "ai0")
-        fm1Data = self.fm.getData(channel = "ai1") 
-        masses = self.masses
-        if self.rgaOn :
-            Pi_values = list()
-            for mass in masses :
-                intensity = self.rga.scan.get_multiple_mass_scan(mass)
-                intensity_in_torr = self.rga.scan.get_partial_pressure_corrected_spectrum(intensity)
-                intensity_in_torr = np.array(intensity_in_torr)
-                Pi_values.append(intensity_in_torr[0])
-        else :
-            Pi_values = np.zeros((len(masses)))
-        self.data.emit([[fm0Data,fm1Data],Pi_values,masses])
+        try:
+            self.cycle(request)
+        except Exception as error:
+            self.failed.emit(request, str(error))
         self.running.emit(False)
 
+    def cycle(self, request=None):
+
+        # The flowmeter and RGA reads run concurrently, so a cycle takes about as
+        # long as the slower device instead of the sum of both. The RGA only
+        # scans the masses the scheduler finds due
+        masses = self.massScheduler.next(clock()) if self.rgaOn else self.masses
+        executor = self.executor if settings['acquisition']['concurrent'] else None
+        self.syncRaw()
+        fmData, Pi_values, scan = readCycle(self.fm, self.rga if self.rgaOn else None, list(self.channels), masses, settings['srs']['rga100']['batch'], executor, self.raw is not None,
+                                           calibration, list(self.gases))
+        metrics.record('flowmeter_read', fmData['duration'])
+        self.recordRaw(fmData)
+        if scan is not None :
+            metrics.record('rga_read', scan['time'])
+            self.massScheduler.update(masses, Pi_values, scan['starts'])
+        fmData['emitted'] = time.perf_counter()
+        fmData['request'] = request
+        self.data.emit([fmData,Pi_values,masses,scan])
+
+    def startCycles(self, rate) :
+
+        # Scheduled mode: cycles run back to back in this thread, at most `rate` per second
+        # (0 for no limit), so the masses due often are no longer held to the GUI refresh.
+        # Runs until stopCycles() or an error, running(False) is always sent
+        self.cycling = True
+        self.running.emit(True)
+        pacer = Pacer(rate) if rate > 0 else None
+        try:
+            while self.cycling :
+                if pacer is not None :
+                    pacer.wait()
+                self.cycle()
+        except Exception as error:
+            self.failed.emit(None, str(error))
+        finally:
+            self.cycling = False
+            if pacer is not None :
+                stats = pacer.stats()
+                print(f"Cycles stopped: {stats['samples']} cycles at {stats['rate']:.1f} Hz, {stats['late']} late, {stats['dropped']} dropped")
+            self.running.emit(False)
+
+    def stopCycles(self) :
+
+        # Called directly from the GUI thread, startCycles() keeps this worker's event queue busy
+        self.cycling = False
+
+    def startScan(self, par) :
+
+        # Repeated analog or histogram surveys. Each survey is measured in chunks of
+        # par['chunk'] amu and every chunk is sent to the GUI as soon as it is read,
+        # the flowmeters are read alongside each chunk. Runs until stopScan() or an error.
+        if not self.rgaOn :
+            return
+        self.scanning = True
+        self.running.emit(True)
+        analog = par['mode'] == 'analog'
+        first = int(par['initial_mass'])
+        last = int(par['final_mass'])
+        chunk = max(int(par['chunk']), 1)
+        try:
+            while self.scanning :
+                t = clock()
+                lo = first
+                while self.scanning and (lo < last or (lo == last and not analog)) :
+                    hi = min(lo + chunk, last) if analog else min(lo + chunk - 1, last)
+                    self.syncRaw()
+                    fmFuture = self.executor.submit(readFlowmeters, self.fm, list(self.channels), self.raw is not None, calibration, list(self.gases))
+                    start = time.perf_counter()
+                    self.rga.scan.set_parameters(lo, hi, par['speed'], par['resolution'])
+                    if analog :
+                        intensity = self.rga.scan.get_analog_scan()
+                    else :
+                        intensity = self.rga.scan.get_histogram_scan()
+                    metrics.record('rga_scan_chunk', time.perf_counter() - start)
+                    mass = np.array(self.rga.scan.get_mass_axis(analog), dtype=float)
+                    Pi_values = np.array(self.rga.scan.get_partial_pressure_corrected_spectrum(intensity), dtype=float)
+                    self.spectrum.emit({'time': t, 'mass': mass, 'data': Pi_values, 'done': hi >= last})
+                    fmData = fmFuture.result()
+                    metrics.record('flowmeter_read', fmData['duration'])
+                    self.recordRaw(fmData)
+                    fmData['emitted'] = time.perf_counter()
+                    self.data.emit([fmData, np.zeros(0), [], None])
+                    lo = hi if analog else hi + 1
+        except Exception as error:
+            self.failed.emit(None, str(error))
+        finally:
+            # running(False) is always sent, the GUI waits for it to close the file
+            self.scanning = False
+            self.running.emit(False)
+
+    def stopScan(self) :
+
+        # Called directly from the GUI thread, startScan() keeps this worker's event queue busy
+        self.scanning = False
+
     def setMasses(self,masses) : 
         self.masses=masses
+        self.massScheduler = MassScheduler(masses, **settings['srs']['rga100']['schedule'])
 
     def startRGA(self) : 
 
         if not self.rgaOn :
             self.running.emit(True)
             print('Turning on SRS RGA.')
-            self.rga = srs_rga('serial', 'COM'+str(settings['srs']['rga100']['com']), 28800)
-            self.rga.ionizer.set_parameters(70, 12, 90)
-            self.rga.filament.turn_on()
-            self.rga.cem.turn_on()
+            self.progress.emit('Turning on SRS RGA...')
+            try :
+                self.rga = openRGA(settings)
+                switchOnRGA(self.rga)
+            except Exception as error :
+                self.connected.emit({'rga': False, 'error': str(error)})
+                self.running.emit(False)
+                return
             print('Emission current: '+str(self.rga.ionizer.emission_current)+' A')
             print('CEM Voltage: '+str(self.rga.cem.voltage)+' V')
             print('SRS RGA ready.')
             self.rgaOn = True
+            self.connected.emit({'rga': True})
             self.running.emit(False)
     
     def stopRGA(self) :
@@ -80,9 +202,7 @@ class Worker(QtCore.QObject):
         if self.rgaOn :
             self.running.emit(True)
             print('Turning off SRS RGA.')
-            self.rga.cem.turn_off()
-            self.rga.filament.turn_off()
-            self.rga.ionizer.set_parameters(0, 0, 0)
+            switchOffRGA(self.rga)
             print('Emission current: '+str(self.rga.ionizer.emission_current)+' A')
             print('CEM Voltage: '+str(self.rga.cem.voltage)+' V')
             self.rga.disconnect()
@@ -95,16 +215,24 @@ class Worker(QtCore.QObject):
         self.running.emit()
 
 
-class MainWindow(QtWidgets.QMainWindow):
+class MainWindow(QtWidgets.QMainWindow, WindowMixin):
 
     work_getData = QtCore.pyqtSignal(int)  # Define a signal that emits integers
     work_setMasses = pyqtSignal(object) ###
     work_startRGA = pyqtSignal(object)
     work_stopRGA = pyqtSignal(object)
+    work_setChannels = pyqtSignal(object)
+    work_startScan = pyqtSignal(object)
+    work_startCycles = pyqtSignal(float)
+    work_connect = pyqtSignal()
+    work_syncRaw = pyqtSignal()
 
     def __init__(self): 
 
         super(MainWindow, self).__init__()
+        self.settings = settings
+        self.metrics = metrics
+        self.calibration = calibration
         self.setContentsMargins(140, 40, 10, 10)
         self.setWindowTitle("FmMassSpec 5.2") 
         self.setWindowIcon(QtGui.QIcon('icons/UHV Channels.ico')) # ask about this
@@ -119,60 +247,47 @@ class MainWindow(QtWidgets.QMainWindow):
         self.work_setMasses.connect(self.worker.setMasses) ###
         self.work_startRGA.connect(self.worker.startRGA)
         self.work_stopRGA.connect(self.worker.stopRGA)
+        self.work_setChannels.connect(self.worker.setChannels)
+        self.work_startScan.connect(self.worker.startScan)
+        self.work_startCycles.connect(self.worker.startCycles)
+        self.worker.spectrum.connect(self.getSpectrum)
+        self.work_connect.connect(self.worker.connectDevices)
+        self.work_syncRaw.connect(self.worker.syncRaw)
+        self.worker.progress.connect(self.statusBar().showMessage)
+        self.worker.connected.connect(self.devicesConnected)
+        self.worker.failed.connect(self.readFailed)
         self.worker_thread.start()
-        self.work_getData.emit(self)
+        self.deviceReady = False
 
         #  TPD Variables
         self.go = False
         self.masses = list()
-        self.Pi = np.nan
-        self.Pi_array = list()  
+        self.Pi = np.zeros(0)
         self.rgaOn = False
         self.t = np.nan
-        self.t0 = time.time()
-        self.t_array = list()
+        self.startClock()
         self.loops = 0
-        self.data0 = list()
-        self.data1 = list()
+        self.writer = None
+        self.saved = 0
+        self.scanTimes = list()
+        self.samples = openSampleStore(['time', 'time end', 'chan0', 'chan1', 'flow0', 'flow1', 'noise0', 'noise1'], settings, 1000 / settings['acquisition']['refresh'])
 
         # TPD Settings (might not need)
         fontsize_small= 10  
 
-        # TPD Plot
-        self.plot = pg.PlotWidget()
-        # self.setCentralWidget(self.plot)
-        font = QFont("Arial", fontsize_small)
-        self.plot.setBackground('white')
-        self.plot.setLabel("left", "Partial Pressure (Torr)")
-        self.plot.setLabel("bottom", "Time (s)")
-        self.plot.setTitle("Mass Spectroscopy Output Data", color = "k",size=f'{fontsize_small}pt')
-        self.plot.getAxis('bottom').setPen('black')
-        self.plot.getAxis("bottom").label.setFont(font)
-        self.plot.getAxis('bottom').setTextPen('black')
-        self.plot.getAxis("bottom").setTickFont(font)
-        self.plot.getAxis("left").label.setFont(font)
-        self.plot.getAxis('left').setPen('black')
-        self.plot.getAxis('left').setTextPen('black')
-        self.plot.getAxis("left").setTickFont(font)
-        self.legend = self.plot.addLegend()
-
-        # Add labels to the plot 
-        self.plot_fm = pg.PlotWidget()  
-        font = QtGui.QFont("Arial", fontsize_small) 
-        self.plot_fm.setBackground("w")
-        self.plot_fm.setTitle("Flowmeter Input Data ", color = "k",size=f'{fontsize_small}pt')
-        self.plot_fm.setLabel('left', text='Voltage  (v)', color = "k")
-        self.plot_fm.getAxis('bottom').setPen('black')
-        self.plot_fm.getAxis("bottom").label.setFont(font)
-        self.plot_fm.getAxis('bottom').setTextPen('black')
-        self.plot_fm.getAxis("bottom").setTickFont(font)
-        self.plot_fm.getAxis("bottom").setTickFont(font)
-        self.plot_fm.getAxis("left").label.setFont(font)
-        self.plot_fm.getAxis('left').setPen('black')
-        self.plot_fm.getAxis('left').setTextPen('black')
-        self.plot_fm.getAxis("left").setTickFont(font)
-        self.plot_fm.setLabel('bottom', text='Time (s)', color = "k")          
-        self.legend_fm = self.plot_fm.addLegend()  
+        self.spectra = SpectrumStore([], capacity=settings['srs']['rga100']['scan']['capacity'], folder=settings['history']['folder'])
+        self.spectrumRow = None
+        self.scanning = False
+        self.draining = False
+        # With a mass schedule the worker runs the cycles back to back, the timer only renders and saves
+        schedule = settings['srs']['rga100']['schedule']
+        self.continuous = bool(schedule['intervals']) or bool(schedule['adaptive'])
+        self.acquiring = False
+        self.curves_fm = dict()
+        self.plotSelection = None
+        self.plotFlow = False
+        self.plotted = -1
+        self.viewRange = None
 
         # Input labels
         self.label_Mass = QLabel('Masses',self) 
@@ -195,6 +310,15 @@ class MainWindow(QtWidgets.QMainWindow):
         self.button_RGA.move(140,10)  
         self.button_RGA.setStyleSheet("background-color:green")
 
+        # Masses tracks the masses in the textbox, the scans survey the mass range in settings.yaml
+        self.combobox_Mode = QComboBox(self)
+        self.combobox_Mode.resize(130,27)
+        self.combobox_Mode.move(215,10)
+        if settings['devices']['rga']['driver'] == 'broker':
+            self.combobox_Mode.addItems(['Masses'])  # The broker only measures its masses
+        else:
+            self.combobox_Mode.addItems(['Masses', 'Analog scan', 'Histogram scan'])
+
         # Start/Stop button
         self.go = False
         self.button_go = QPushButton(self)
@@ -213,6 +337,14 @@ class MainWindow(QtWidgets.QMainWindow):
         self.checkbox_Save.setStyleSheet('QLineEdit {background-color: white; color: black;}')
         self.checkbox_Save.setFont(QtGui.QFont('Arial', fontsize_small))
 
+        self.checkbox_Diagnostics = QCheckBox(self)
+        self.checkbox_Diagnostics.setText('Diagnostics')
+        self.checkbox_Diagnostics.setCheckable(True)
+        self.checkbox_Diagnostics.resize(100, 30)
+        self.checkbox_Diagnostics.move(10, 410)
+        self.checkbox_Diagnostics.setFont(QtGui.QFont('Arial', fontsize_small))
+        self.checkbox_Diagnostics.toggled.connect(self.showDiagnostics)
+
         self.textbox_File = QLabel(self)
         self.textbox_File.move(350,10)
         self.textbox_File.resize(400,30)
@@ -252,14 +384,25 @@ class MainWindow(QtWidgets.QMainWindow):
         if len(settings['gases']) > 1 :
             self.combobox_Chan1.setCurrentText(settings['gases'][1])
 
+        # Flowmeter channels: (checkbox, combobox, DAQ channel, column in self.samples, plot color)
+        # More flowmeters only need another checkbox/combobox pair added here
+        self.channels = [(self.checkbox_Chan0, self.combobox_Chan0, 'ai0', 'chan0', 'r'),
+                         (self.checkbox_Chan1, self.combobox_Chan1, 'ai1', 'chan1', 'k')]
+        for checkbox, combobox, channel, column, color in self.channels :
+            checkbox.toggled.connect(self.setChannels)
+            combobox.currentTextChanged.connect(self.setChannels)
+        self.setChannels()
+
         # Adding widgets to layout
         layout = QtWidgets.QVBoxLayout()
 
         # Create a main layout for top widget
         mainLayout = QtWidgets.QVBoxLayout()
         mainLayout.addLayout(layout)
-        mainLayout.addWidget(self.plot, 5)
-        mainLayout.addWidget(self.plot_fm, 3) 
+        self.label_Loading = QLabel('Loading plots...')
+        self.label_Loading.setAlignment(QtCore.Qt.AlignCenter)
+        mainLayout.addWidget(self.label_Loading, 5)
+        self.mainLayout = mainLayout
 
         centralWidget = QtWidgets.QWidget()
         centralWidget.setLayout(mainLayout)
@@ -267,17 +410,141 @@ class MainWindow(QtWidgets.QMainWindow):
  
         # Timer
         self.timer = QtCore.QTimer()
-        self.timer.setInterval(500)  
+        self.timer.setInterval(settings['acquisition']['refresh'])
         self.timer.timeout.connect(self.mainLoop)
-        self.timer.start()
+
+        # Polled reads go through the scheduler, which keeps at most one request in flight
+        self.scheduler = AcquisitionScheduler(self.timer.interval(), window=settings['acquisition']['window'], timeout=settings['acquisition']['timeout'])
+        self.scheduler.request.connect(self.requestData)
+        self.scheduler.warning.connect(self.rateWarning)
+        self.label_Rate = QLabel('')
+        self.label_Rate.setStyleSheet('color: red')
+        self.statusBar().addPermanentWidget(self.label_Rate)
+
+        # Stage latencies: optional panel, metrics file and localhost endpoint from settings
+        self.diagnostics = None
+        self.exporter = MetricsExporter(metrics, **settings['metrics']).start()
+        self.lastTick = None
+
+        # Per-tick records go to the live log, which formats and writes them in its own thread
+        self.log = LiveLog(**settings['log'])
+        self.checkbox_Diagnostics.setChecked(settings['metrics']['panel'])
 
         # Mass spec Initialize functions
         self.setMasses()
 
         self.show()            
+        startup.mark('window')
+        QtCore.QTimer.singleShot(0, self.finishStartup)
+
+    def buildPlots(self):
+
+        fontsize_small = 10
+
+        # TPD Plot
+        self.plot = pg.PlotWidget()
+        # self.setCentralWidget(self.plot)
+        font = QFont("Arial", fontsize_small)
+        self.plot.setBackground('white')
+        self.plot.setLabel("left", "Partial Pressure (Torr)")
+        self.plot.setLabel("bottom", "Time (s)")
+        self.plot.setTitle("Mass Spectroscopy Output Data", color = "k",size=f'{fontsize_small}pt')
+        self.plot.getAxis('bottom').setPen('black')
+        self.plot.getAxis("bottom").label.setFont(font)
+        self.plot.getAxis('bottom').setTextPen('black')
+        self.plot.getAxis("bottom").setTickFont(font)
+        self.plot.getAxis("left").label.setFont(font)
+        self.plot.getAxis('left').setPen('black')
+        self.plot.getAxis('left').setTextPen('black')
+        self.plot.getAxis("left").setTickFont(font)
+        self.legend = self.plot.addLegend()
+        self.plot.setClipToView(True)
+        self.plot.setDownsampling(auto=True, mode='peak')
+        self.lines = list()
+
+        # Add labels to the plot 
+        self.plot_fm = pg.PlotWidget()  
+        font = QtGui.QFont("Arial", fontsize_small) 
+        self.plot_fm.setBackground("w")
+        self.plot_fm.setTitle("Flowmeter Input Data ", color = "k",size=f'{fontsize_small}pt')
+        self.plot_fm.setLabel('left', text='Voltage  (v)', color = "k")
+        self.plot_fm.getAxis('bottom').setPen('black')
+        self.plot_fm.getAxis("bottom").label.setFont(font)
+        self.plot_fm.getAxis('bottom').setTextPen('black')
+        self.plot_fm.getAxis("bottom").setTickFont(font)
+        self.plot_fm.getAxis("bottom").setTickFont(font)
+        self.plot_fm.getAxis("left").label.setFont(font)
+        self.plot_fm.getAxis('left').setPen('black')
+        self.plot_fm.getAxis('left').setTextPen('black')
+        self.plot_fm.getAxis("left").setTickFont(font)
+        self.plot_fm.setLabel('bottom', text='Time (s)', color = "k")          
+        self.legend_fm = self.plot_fm.addLegend()  
+        self.plot_fm.setClipToView(True)
+        self.plot_fm.setDownsampling(auto=True, mode='peak')
+        self.plot_fm.setXLink(self.plot)  # Both plots share the time axis
+        self.plot.getViewBox().sigXRangeChanged.connect(self.viewChanged)
+
+        # Spectrum plot for analog and histogram scans, takes the place of the mass plot
+        self.plot_spectrum = pg.PlotWidget()
+        self.plot_spectrum.setBackground('white')
+        self.plot_spectrum.setLabel("left", "Partial Pressure (Torr)")
+        self.plot_spectrum.setLabel("bottom", "m/z (amu)")
+        self.plot_spectrum.setTitle("Mass Spectrum", color = "k",size=f'{fontsize_small}pt')
+        for axis in ('bottom', 'left') :
+            self.plot_spectrum.getAxis(axis).setPen('black')
+            self.plot_spectrum.getAxis(axis).setTextPen('black')
+            self.plot_spectrum.getAxis(axis).label.setFont(font)
+            self.plot_spectrum.getAxis(axis).setTickFont(font)
+        self.spectrum_previous = self.plot_spectrum.plot(pen=pg.mkPen((180, 180, 180), width=1))
+        self.spectrum_current = self.plot_spectrum.plot(pen=pg.mkPen('b', width=1), connect='finite')
+        self.plot_spectrum.hide()
+
+        # The plots take the place of the placeholder shown while pyqtgraph was loading
+        self.mainLayout.replaceWidget(self.label_Loading, self.plot)
+        self.mainLayout.addWidget(self.plot_spectrum, 5)
+        self.mainLayout.addWidget(self.plot_fm, 3)
+        self.label_Loading.deleteLater()
+
+    def finishStartup(self):
+
+        # Runs once the window is on screen: plots, then the timer, then the devices in the worker thread
+        startup.mark('window shown')
+        self.statusBar().showMessage('Loading plots...')
+        QtWidgets.QApplication.processEvents()
+        self.buildPlots()
+        startup.mark('plots (pyqtgraph)')
+        self.timer.start()
+        self.work_connect.emit()
+
+    def devicesConnected(self, status):
+
+        if 'flowmeter' in status:
+            self.deviceReady = status['flowmeter']
+            if self.deviceReady:
+                startup.mark('flowmeter connected')
+                self.statusBar().showMessage('Flowmeter connected', 5000)
+            else:
+                startup.mark('flowmeter failed')
+                self.statusBar().showMessage('Flowmeter not connected: '+status['error'])
+                print('Flowmeter not connected: '+status['error'])
+            print(startup.report())
+        elif status['rga'] :
+            self.statusBar().showMessage('SRS RGA ready', 5000)
+        else :
+            # Back to off, without calling stopRGA() for an RGA that never started
+            self.rgaOn = False
+            self.button_RGA.setChecked(False)
+            self.statusBar().showMessage('RGA not connected: '+status['error'])
+            print('RGA not connected: '+status['error'])
 
     def mainLoop(self):    
 
+        # Lateness of this tick, slow repaints or saves on the GUI thread show up here
+        now = time.perf_counter()
+        if self.lastTick is not None:
+            metrics.record('gui_lag', max(now - self.lastTick - self.timer.interval() / 1000, 0.0))
+        self.lastTick = now
+
         if self.button_RGA.isChecked() :
             self.button_RGA.setText('Turn off RGA')
             self.button_RGA.setStyleSheet("background-color:red")
@@ -291,22 +558,23 @@ class MainWindow(QtWidgets.QMainWindow):
                 self.stopRGA()
             self.rgaOn = False
   
+        self.button_go.setEnabled(self.deviceReady)
         if self.button_go.isChecked(): 
             if self.rgaOn :
                 self.button_go.setText('Stop')
                 self.button_go.setStyleSheet("background-color: red")
                 self.button_RGA.setEnabled(False)
                 self.checkbox_Save.setEnabled(False)
-                self.combobox_Chan0.setEnabled(False)
-                self.combobox_Chan1.setEnabled(False)
-                self.checkbox_Chan0.setEnabled(False)
-                self.checkbox_Chan1.setEnabled(False)
+                for checkbox, combobox, channel, column, color in self.channels :
+                    combobox.setEnabled(False)
+                    checkbox.setEnabled(False)
                 self.textbox_masses.setEnabled(False)
+                self.combobox_Mode.setEnabled(False)
 
                 if not self.go :
 
                     self.reset()
-                    self.t0 = time.time() 
+                    self.startClock()
                     self.setMasses() # ???   do we need them here? (trying to merge fm and tpd) 
                     self.lines = list()
                     
@@ -320,12 +588,24 @@ class MainWindow(QtWidgets.QMainWindow):
                                 single_item.setText(single_item.text, **legendLabelStyle) 
 
                     self.go = True
+
+                    # Scans run in the worker until stopped, their spectra arrive in getSpectrum()
+                    self.plot.setVisible(self.scanMode() is None)
+                    self.plot_spectrum.setVisible(self.scanMode() is not None)
+                    if self.scanMode() is not None :
+                        self.startScan()
                     
-                if not self.running :
-                    self.work_getData.emit(self)
-                    self.updatePlot()
+                cycling = self.continuous and (self.scanMode() is None)
+                if cycling and not (self.acquiring or self.draining) :
+                    self.acquiring = True
+                    self.work_startCycles.emit(float(settings['srs']['rga100']['schedule']['rate']))
+
+                if self.scanning or cycling or self.scheduler.tick() :
+                    with metrics.timed('updatePlot'):
+                        self.updatePlot()
                     if self.checkbox_Save.isChecked() :
-                        self.save()
+                        with metrics.timed('save'):
+                            self.save()
 
             else :
 
@@ -334,98 +614,137 @@ class MainWindow(QtWidgets.QMainWindow):
                 
         else:
             self.go = False
+            self.stopScan()
+            self.stopCycles()
+            # A read or scan chunk still in flight is saved before the file is closed, on a later tick
+            if not (self.scheduler.waiting() or self.draining) :
+                self.stopPolling()
+                self.closeWriter()
             self.button_go.setText('Start')
             self.button_go.setStyleSheet("background-color:green")
             self.button_RGA.setEnabled(True)
             self.checkbox_Save.setEnabled(True)
-            self.combobox_Chan0.setEnabled(True)
-            self.combobox_Chan1.setEnabled(True)
-            self.checkbox_Chan0.setEnabled(True)
-            self.checkbox_Chan1.setEnabled(True)
+            for checkbox, combobox, channel, column, color in self.channels :
+                combobox.setEnabled(True)
+                checkbox.setEnabled(True)
             self.textbox_masses.setEnabled(True)
+            self.combobox_Mode.setEnabled(True)
     
     def getData(self,data) :
 
-        # Time data
-        self.t = round(time.time() - self.t0,2)
-        self.t = float(self.t)
-        self.t_array.append(self.t)
+        start = time.perf_counter()
+        if 'emitted' in data[0] :
+            metrics.record('delivery', start - data[0]['emitted'])
+        self.scheduler.completed(data[0].get('request'))
 
-        string = 'Time (s): '+str(self.t)
+        # Time data, the start and end of the flowmeter read in the worker
+        self.t = float(data[0]['start'] - self.t0)
+        sample = {'time': self.t, 'time end': data[0]['end'] - self.t0}
+        self.timing.add('flowmeter', data[0]['start'], data[0]['end'])
+        scan = data[3] if len(data) > 3 else None
 
         # Flow meter data            
-        if self.checkbox_Chan0.isChecked():
-            data0_mean = np.mean(data[0][0]) 
-            self.data0.append(data0_mean)
-            string += ', Chan0: '+str(data0_mean)
-        if self.checkbox_Chan1.isChecked():
-            data1_mean = np.mean(data[0][1]) 
-            self.data1.append(data1_mean)
-            string += ', Chan1: '+str(data1_mean)
-
-        # Mass spec data
+        for channel, stats, flow in zip(data[0]['channels'], data[0]['stats'], data[0]['flow']) :
+            sample[self.channelColumn(channel)] = stats['mean']
+            sample[self.flowColumn(self.channelColumn(channel))] = flow
+            sample[self.noiseColumn(self.channelColumn(channel))] = stats['std']
+
+        # Mass spec data, kept at full precision. Only the masses scanned this cycle
+        # (data[2]) get a value, the others are NaN until their next scan
         self.Pi = data[1]
-        for idx, Pi in enumerate(self.Pi) :
-            self.Pi[idx] = float(f'{float(Pi):.4e}')
-        if len(self.Pi) == len(self.masses) :
-            for idx, Pi in enumerate(self.Pi) :
-                if idx < len(self.Pi_array):
-                    self.Pi_array[idx].append(Pi)
-            if self.button_go.isChecked():
-                for idx,mass in enumerate(self.masses) :
-                    string += ', Mass '+str(mass)+': '+f'{self.Pi[idx]:.2e}'+' Torr'
-
-        # Display data in terminal
+        scanned = [mass for mass in data[2] if self.massColumn(mass) in self.samples.index]
+        if len(self.Pi) == len(data[2]) :
+            for idx, mass in enumerate(data[2]) :
+                if self.massColumn(mass) in self.samples.index :
+                    sample[self.massColumn(mass)] = self.Pi[idx]
+            # and the start and end of each mass within the scan, its own time axis
+            if scan is not None :
+                for idx, mass in enumerate(data[2]) :
+                    if self.massColumn(mass) in self.samples.index :
+                        sample[self.massColumn(mass)+' start'] = scan['starts'][idx] - self.t0
+                        sample[self.massColumn(mass)+' end'] = scan['ends'][idx] - self.t0
+                        self.timing.add(self.massColumn(mass), scan['starts'][idx], scan['ends'][idx])
+
+        self.samples.append(sample)
+
+        # Scan time per mass is the effective sampling interval of each mass
+        if scan is not None :
+            self.scanTimes.append(scan['per_mass'])
+            self.statusBar().showMessage(f"RGA scan: {scan['per_mass']*1e3:.0f} ms per mass, {scan['time']:.2f} s for {len(scanned)} of {len(self.masses)} masses, cycle {scan['cycle']:.2f} s")
+
+        # Live log, with the time the flowmeters were read
         if self.button_go.isChecked():
-            print(string)
+            self.log.log(dict(sample, timestamp=data[0].get('time')))
+        metrics.record('getData', time.perf_counter() - start)
  
     def updatePlot(self):
 
-        if len(self.t_array) != 0 :
-            # Plot mass spec data
+        # Flow meter curves are only rebuilt when the channel selection changes
+        selection = self.channelSelection()
+        if selection != self.plotSelection:
+            self.buildCurves(selection)
+
+        # Skip the redraw when nothing new has arrived since the last tick
+        if (len(self.samples) != 0) & (self.samples.total != self.plotted) :
+            data = self.plotData()
+            t = data[self.samples.index['time']]
+            # Plot mass spec data, each mass against the start of its own measurements
+            # (the flowmeter time when the RGA is off) without the cycles that skipped it
             for idx, line in enumerate(self.lines) :
-                self.lines[idx].setData(self.t_array,self.Pi_array[idx])
-                
-            self.plot_fm.clear()
+                column = self.massColumn(self.masses[idx])
+                x = data[self.samples.index[column+' start']]
+                x = np.where(np.isfinite(x), x, t)
+                y = data[self.samples.index[column]]
+                measured = np.isfinite(y)
+                self.lines[idx].setData(x[measured], y[measured])
+
             # Plot flow meter data
-            if self.checkbox_Chan0.isChecked() :
-                name0 = self.combobox_Chan0.currentText()  # Get the selected item from combobox_Chan0
-                self.plot_fm.plot(self.t_array, self.data0, symbol='+', pen="r", size=8, symbolBrush=pg.mkBrush('r'), name = name0)
-            
-            if self.checkbox_Chan1.isChecked() :
-                name1 = self.combobox_Chan1.currentText()  # Get the selected item from combobox_Chan1      
-                self.plot_fm.plot(self.t_array, self.data1, symbol='+', pen="k", size=8, symbolBrush=pg.mkBrush('k'), name = name1)
- 
-    def save(self) :
+            for column, curve in self.curves_fm.items() :
+                curve.setData(t, data[self.samples.index[self.flowColumn(column) if self.plotFlow else column]])
+            self.plotted = self.samples.total
+
+    def plotData(self):
+
+        # The min/max envelope when there are more samples than pixels, so the
+        # cost of a redraw does not grow with the length of the run
+        data = self.samples.envelope(self.viewRange, self.plot.getViewBox().width())
+        if data is not None:
+            return data
+        # Otherwise the samples themselves, with a view's width either side
+        t0, t1 = self.viewRange if self.viewRange is not None else (-np.inf, np.inf)
+        return self.samples.history(2 * t0 - t1, 2 * t1 - t0)
+
+    def buildCurves(self, selection) :
+
+        for curve in self.curves_fm.values() :
+            self.plot_fm.removeItem(curve)
+        self.curves_fm = dict()
+        for column, name, color in selection :
+            self.curves_fm[column] = self.plot_fm.plot(pen=color, name=name, symbol='+', symbolSize=8, symbolPen=color, symbolBrush=pg.mkBrush(color))
+        # Flow is plotted only when every gas shown has a calibration curve
+        self.plotFlow = calibration.plot and (len(selection) > 0) and all(name in calibration for column, name, color in selection)
+        self.plot_fm.setLabel('left', text='Flow  ('+calibration.unit+')' if self.plotFlow else 'Voltage  (v)', color = "k")
+        self.plotSelection = selection
+        self.plotted = -1
+
+    def savedColumns(self) :
+
+        # (column, header) of the saved data: the voltage of each enabled channel, the flow of those with a calibrated
+        # gas, the noise of each voltage, then the end of the flowmeter read and the start and end of each mass on the monotonic clock
+        selection = self.channelSelection()
+        return ([(column, name) for column, name, color in selection]
+                + [(self.flowColumn(column), calibration.name(name)) for column, name, color in selection if name in calibration]
+                + [(self.noiseColumn(column), name+' noise (v)') for column, name, color in selection]
+                + [('time end', 'Flowmeter end (s)')]
+                + [(self.massColumn(mass)+' '+edge, self.massColumn(mass)+' '+edge+' (s)') for mass in self.masses for edge in ('start', 'end')])
 
-        try :
-            
-            data = [self.t]
-            for Pi in self.Pi :
-                data.append(Pi) 
-            with open(self.path+'.csv', "a", newline='') as TFile:
-                TWriter = csv.writer(TFile, delimiter=',') 
-                
-                if self.checkbox_Chan0.isChecked() & self.checkbox_Chan1.isChecked() : 
-                    if (len(self.data0) > 1 ) & (len(self.data1) > 1):
-                        TWriter.writerow(data + [self.data0[-1], self.data1[-1]] ) 
-                elif self.checkbox_Chan0.isChecked():
-                    if len(self.data0) > 1:
-                        TWriter.writerow(data + [self.data0[-1]])
-                    
-                elif self.checkbox_Chan1.isChecked():
-                    
-                    if len(self.data1) > 1:
-                        TWriter.writerow(data + [self.data1[-1]])
+    def save(self) :
 
-        except :
+        # Open the data file once per run, rows are then flushed in batches
+        if self.writer is None :
 
-            now = datetime.now()
-            folder = settings['data']['folder'] 
-            folder = folder+f'{now.year:04d}'+'/'+f'{now.year:04d}'+'.'+f'{now.month:02d}'+'.'+f'{now.day:02d}'+'/'
-            os.makedirs(folder, exist_ok=True) 
-            file = 'prc'+f'{now.year:04d}'+f'{now.month:02d}'+f'{now.day:02d}'+'_'+f'{now.hour:02d}'+f'{now.minute:02d}'+f'{now.second:02d}'
-            self.path = folder+file
+            self.path, self.file = runPath(settings['data']['folder'])
+            file = self.file
             self.textbox_File.setText('File: '+file)
             print('Saving to file: '+self.path)
 
@@ -439,34 +758,120 @@ class MainWindow(QtWidgets.QMainWindow):
             
             header  = ['Time (s)']
             for mass in self.masses : # then include the Mass 12(5,6,7,8,etc.)
-                header.append('Mass '+str(mass)) 
+                header.append(self.massColumn(mass)) 
+            header += [name for column, name in self.savedColumns()]  # Gas selected for each enabled channel, then their flows and the read times
+
+            self.writer = openWriter(self.path, header, settings['data'])
+            self.saveParameters()
+            self.startRaw()
+            if settings['log']['file'] :
+                par = readMetadata(self.path)
+                par['log'] = os.path.basename(self.path)+'_log.jsonl'
+                writeMetadata(self.path, par)
+                self.log.open(self.path+'_log.jsonl')
+
+        self.writeRows()
+
+        self.textbox_File.setText('File: '+self.file+' ('+str(self.writer.pending)+' rows pending)')
+
+    def writeRows(self) :
+
+        # Write every sample added since the last save, in the column order of the header.
+        # Masses not scanned in a cycle are saved as NaN
+        rows = ([self.samples.index['time']] + [self.samples.index[self.massColumn(mass)] for mass in self.masses]
+                + [self.samples.index[column] for column, name in self.savedColumns()])
+        new = min(self.samples.total - self.saved, len(self.samples))
+        if new > 0 :
+            for row in self.samples.view()[rows, -new:].T.tolist() :
+                self.writer.writerow(row)
+        self.saved = self.samples.total
+
+    def closeWriter(self) :
+
+        if self.writer is not None :
+            self.writeRows()
+            pending = self.writer.pending
+            self.writer.close()
+            self.worker.rawTarget = None
+            self.work_syncRaw.emit()
+            self.log.close()
+            # Sampling jitter of the run
+            par = readMetadata(self.path)
+            par['timing'] = self.timing.summary()
+            writeMetadata(self.path, par)
+            print(self.timing.report())
+            if len(self.scanTimes) > 0 :
+                par = readMetadata(self.path)
+                par['rga_scan_time_per_mass'] = float(np.mean(self.scanTimes))
+                writeMetadata(self.path, par)
+            if self.spectra.total > 0 :
+                # Successive spectra as one (time, m/z) array
+                self.spectra.save(self.path+'_spectra.npz')
+                par = readMetadata(self.path)
+                par['spectra'] = os.path.basename(self.path)+'_spectra.npz'
+                writeMetadata(self.path, par)
+            self.writer = None
+            print('Closed file: '+self.path+' ('+str(pending)+' pending rows flushed)')
+            self.textbox_File.setText('File: '+self.file)
  
+    def readFailed(self, request, error):
 
-            with open(self.path+'.csv', "w", newline='') as TFile:
-
-                TWriter = csv.writer(TFile, delimiter=',')
-
-                if self.checkbox_Chan0.isChecked() & self.checkbox_Chan1.isChecked() :
-                            
-                    name0 = self.combobox_Chan0.currentText()  # Get the selected item from combobox_Chan0
-                    name1 = self.combobox_Chan1.currentText()  # Get the selected item from combobox_Chan1
+        # A failed scan is not restarted, Stop saves what it measured
+        if self.scanning :
+            self.scanning = False
+            self.draining = True  # until the worker's scan loop has returned
+        super().readFailed(request, error)
 
-                    TWriter.writerow(header + [name0, name1]) 
-
-                elif self.checkbox_Chan0.isChecked():
-
-                    name0 = self.combobox_Chan0.currentText()  # Get the selected item from combobox_Chan0  
-                    TWriter.writerow(header + [name0]) 
-                        
-                elif self.checkbox_Chan1.isChecked():
-                    
-                    name1 = self.combobox_Chan1.currentText()  # Get the selected item from combobox_Chan1
-                    TWriter.writerow(header + [name1]) 
- 
-    
     def getStatus(self, running):
         
         self.running = running
+        if not running :
+            self.draining = False
+
+    def scanMode(self) :
+
+        return {'Analog scan': 'analog', 'Histogram scan': 'histogram'}.get(self.combobox_Mode.currentText())
+
+    def startScan(self) :
+
+        par = dict(settings['srs']['rga100']['scan'])
+        par['mode'] = self.scanMode()
+        first, last = int(par['initial_mass']), int(par['final_mass'])
+        self.scanResolution = par['resolution'] if par['mode'] == 'analog' else 1
+        self.spectra.reset(np.linspace(first, last, (last - first) * self.scanResolution + 1))
+        self.spectrumRow = None
+        self.scanning = True
+        self.work_startScan.emit(par)
+
+    def stopScan(self) :
+
+        if self.scanning :
+            self.worker.stopScan()
+            self.scanning = False
+            self.draining = True  # until the worker's scan loop has returned
+
+    def stopCycles(self) :
+
+        if self.acquiring :
+            self.worker.stopCycles()
+            self.acquiring = False
+            self.draining = True  # until the worker's cycle loop has returned
+
+    def getSpectrum(self, part) :
+
+        # Partial spectra are written into the current row of the (time, m/z) store as they arrive,
+        # until the worker's scan loop has returned
+        if not (self.scanning or self.draining) :
+            return
+        if self.spectrumRow is None :
+            self.spectrumRow = self.spectra.start(part['time'] - self.t0)
+        index = np.rint((part['mass'] - self.spectra.mass[0]) * self.scanResolution).astype(int)
+        valid = (index >= 0) & (index < len(self.spectra.mass))
+        self.spectra.update(self.spectrumRow, index[valid], part['data'][valid])
+        self.spectrum_current.setData(self.spectra.mass, self.spectra.spectrum(self.spectrumRow))
+        if part['done'] :
+            self.spectrum_previous.setData(self.spectra.mass, self.spectra.spectrum(self.spectrumRow))
+            self.spectrumRow = None
 
     def startRGA(self) :
 
@@ -482,30 +887,64 @@ class MainWindow(QtWidgets.QMainWindow):
         masses = re.split(';|,',masses)
         for idx,mass in enumerate(masses) :
             masses[idx] = float(mass)
+        if self.scanMode() is not None :
+            masses = list()  # The scans record spectra instead of single masses
         self.masses = masses
         self.work_setMasses.emit(masses)
-        self.Pi_array = list()  
-        for mass in masses :
-            self.Pi_array.append(list())
+        self.samples.reset(['time', 'time end'] + [column for checkbox, combobox, channel, column, color in self.channels]
+                           + [self.flowColumn(column) for checkbox, combobox, channel, column, color in self.channels]
+                           + [self.noiseColumn(column) for checkbox, combobox, channel, column, color in self.channels]
+                           + [self.massColumn(mass) for mass in masses]
+                           + [self.massColumn(mass)+' '+edge for mass in masses for edge in ('start', 'end')])
+
+    def massColumn(self, mass) :
+
+        return 'Mass '+str(mass)
  
     def reset(self):
 
         # TPD
-        self.t_array = list()
-        self.Pi_array = list() 
-        self.data0 = []
-        self.data1 = []
-        self.time = []
+        self.samples.reset()
+        self.saved = 0
+        self.scanTimes = list()
+        self.spectra.reset()
         self.plot.clear()
         self.plot_fm.clear()
+        self.lines = list()
+        self.curves_fm = dict()
+        self.plotSelection = None
+        self.viewRange = None
 
     def closeEvent(self, event):
         # Clean up when closing the application
+        self.timer.stop()
+        self.stopScan()
+        self.stopCycles()
+        self.stopPolling()
+        # The read in flight or the scan chunk the worker sends when its loop returns is delivered before the file is closed
         self.worker_thread.quit()
         self.worker_thread.wait()
+        QtCore.QCoreApplication.processEvents()
+        self.closeWriter()
+        self.worker.syncRaw()  # The worker thread has stopped, its raw recording is closed from here
+        self.worker.executor.shutdown()
+        self.exporter.stop()
+        self.log.stop()
+        if self.diagnostics is not None:
+            self.diagnostics.close()
+        if isinstance(self.samples, HistoryStore):
+            self.samples.close()
+        self.spectra.close()
 
 if __name__ == "__main__":
     app = QtWidgets.QApplication(sys.argv)
+    startup.mark('QApplication')
     app.setStyleSheet(qdarkstyle.load_stylesheet())
-    w = MainWindow()
+    startup.mark('style')
+    if '--attach' in sys.argv:
+        # Only view the run recorded by tools.daemon, no device is opened
+        from tools.viewer import ViewerWindow
+        w = ViewerWindow(settings, title='Photoreactor Chamber')
+    else:
+        w = MainWindow()
     app.exec_()
\ No newline at end of file
@@ -0,0 +1,234 @@
+"""Acquisition benchmarks for Flowmeters.py and Photoreactor Chamber.py.
+
+Drives Worker.getData, MainWindow.getData, updatePlot, the plot repaint and
+save headlessly with the simulated devices, for a sweep of history lengths,
+flowmeter channel counts and RGA mass counts, and writes the per-stage
+timings and memory use as JSON so results can be compared between commits.
+
+    python benchmarks/bench_acquisition.py --output before.json
+    python benchmarks/bench_acquisition.py --output after.json --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+import importlib.util
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, root)
+
+import numpy as np
+from PyQt5 import QtWidgets
+
+APPS = {
+    'flowmeters': {'file': 'Flowmeters.py', 'plots': ['plot_analog']},
+    'chamber': {'file': 'Photoreactor Chamber.py', 'plots': ['plot', 'plot_fm']},
+}
+STAGES = ['worker_getData', 'getData', 'updatePlot', 'render', 'save']
+
+
+def loadApp(name, args, folder):
+
+    spec = importlib.util.spec_from_file_location(name, os.path.join(root, APPS[name]['file']))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    settings = module.settings
+    settings['data']['folder'] = folder + '/'
+    settings['data']['format'] = args.format
+    settings['devices']['flowmeter']['driver'] = 'simulated'
+    settings['devices']['flowmeter'].setdefault('simulated', {}).update({'latency': args.latency, 'samples': args.samples})
+    settings['devices']['rga']['driver'] = 'simulated'
+    settings['devices']['rga'].setdefault('simulated', {}).update({'latency': args.latency, 'mass_scan_time': args.mass_scan_time})
+    return module
+
+
+def wait(app, condition, timeout=10.0):
+
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            raise TimeoutError('Timed out waiting for the worker')
+        app.processEvents()
+        time.sleep(0.01)
+
+
+def startRun(app, name, w, channels, masses):
+
+    # Put the window in the same state as after pressing Start, then stop the
+    # timer so the benchmark drives every stage itself. The plots and the
+    # devices are set up after the window is shown
+    wait(app, lambda: w.deviceReady)
+    w.timer.stop()
+    w.checkbox_Chan0.setChecked(channels >= 1)
+    w.checkbox_Chan1.setChecked(channels >= 2)
+    w.checkbox_Save.setChecked(True)
+    if name == 'chamber':
+        w.textbox_masses.setText(','.join(str(mass) for mass in range(1, masses + 1)))
+        w.button_RGA.setChecked(True)
+        w.mainLoop()
+        wait(app, lambda: w.worker.rgaOn)
+        w.running = True
+    w.button_go.setChecked(True)
+    w.mainLoop()
+    time.sleep(0.2)
+    app.processEvents()
+    w.worker.data.disconnect()
+
+
+def fill(w, length):
+
+    # Synthetic history of the requested length
+    w.samples.reset()
+    ncol = len(w.samples.columns)
+    block = np.random.default_rng(0).random((ncol, length))
+    block[0] = 0.5 * np.arange(length)
+    w.samples.extend(block)
+    w.plotted = -1
+
+
+def tick(w, plots, payload):
+
+    # One acquisition cycle, returns the time spent in each stage
+    timings = dict()
+    t = time.perf_counter()
+    w.worker.getData()
+    timings['worker_getData'] = time.perf_counter() - t
+    t = time.perf_counter()
+    w.getData(payload[-1])
+    timings['getData'] = time.perf_counter() - t
+    t = time.perf_counter()
+    w.updatePlot()
+    timings['updatePlot'] = time.perf_counter() - t
+    t = time.perf_counter()
+    for plot in plots:
+        plot.grab()
+    timings['render'] = time.perf_counter() - t
+    t = time.perf_counter()
+    w.save()
+    timings['save'] = time.perf_counter() - t
+    return timings
+
+
+def runConfig(app, name, module, args, channels, masses):
+
+    results = list()
+    w = module.MainWindow()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        startRun(app, name, w, channels, masses)
+        plots = [getattr(w, plot) for plot in APPS[name]['plots']]
+        payload = list()
+        w.worker.data.connect(payload.append)
+        for length in args.lengths:
+            fill(w, length)
+            tick(w, plots, payload)  # warm up
+            timings = {stage: list() for stage in STAGES}
+            for repeat in range(args.repeat):
+                for stage, value in tick(w, plots, payload).items():
+                    timings[stage].append(value)
+            # Memory is measured in a separate pass, tracemalloc slows every allocation
+            tracemalloc.start()
+            tick(w, plots, payload)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del payload[:]
+            for stage in STAGES:
+                values = np.array(timings[stage]) * 1e3
+                results.append({
+                    'app': name,
+                    'length': length,
+                    'channels': channels,
+                    'masses': masses if name == 'chamber' else 0,
+                    'stage': stage,
+                    'repeat': args.repeat,
+                    'mean_ms': float(np.mean(values)),
+                    'median_ms': float(np.median(values)),
+                    'p95_ms': float(np.percentile(values, 95)),
+                    'max_ms': float(np.max(values)),
+                    'tick_alloc_peak_kb': peak / 1024,
+                    'store_kb': w.samples.buffer.nbytes / 1024,
+                })
+        w.closeWriter()
+        w.close()
+    return results
+
+
+def gitCommit():
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=root, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, path):
+
+    # Prints the ratio of the mean stage times against an earlier result file
+    with open(path, 'r') as stream:
+        before = json.load(stream)
+    key = lambda r: (r['app'], r['length'], r['channels'], r['masses'], r['stage'])
+    old = {key(r): r for r in before['results']}
+    print(f"{'app':<11}{'length':>9}{'chan':>5}{'mass':>5}  {'stage':<15}{'before ms':>11}{'after ms':>11}{'ratio':>8}")
+    for r in results:
+        if key(r) in old:
+            b = old[key(r)]['mean_ms']
+            print(f"{r['app']:<11}{r['length']:>9}{r['channels']:>5}{r['masses']:>5}  {r['stage']:<15}{b:>11.3f}{r['mean_ms']:>11.3f}{r['mean_ms'] / b if b > 0 else np.nan:>8.2f}")
+
+
+def integers(text):
+
+    return [int(float(value)) for value in text.split(',')]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark the acquisition, plotting and saving stages.')
+    parser.add_argument('--apps', default='flowmeters,chamber', help='comma separated: flowmeters, chamber')
+    parser.add_argument('--lengths', type=integers, default=[1000, 10000, 100000, 1000000], help='history lengths to sweep')
+    parser.add_argument('--channels', type=integers, default=[1, 2], help='flowmeter channel counts to sweep')
+    parser.add_argument('--masses', type=integers, default=[1, 8, 32], help='RGA mass counts to sweep (chamber only)')
+    parser.add_argument('--repeat', type=int, default=10, help='ticks timed per configuration')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated device latency per call (s)')
+    parser.add_argument('--mass-scan-time', type=float, default=0.0, help='simulated RGA time per mass (s)')
+    parser.add_argument('--samples', type=int, default=1000, help='simulated flowmeter samples per read')
+    parser.add_argument('--format', default='csv', help="data format to save: 'csv', 'binary' or 'both'")
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare', help='earlier JSON results to compare against')
+    args = parser.parse_args()
+
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv)
+    results = list()
+    with tempfile.TemporaryDirectory() as folder:
+        for name in args.apps.split(','):
+            module = loadApp(name, args, folder)
+            for channels in args.channels:
+                for masses in (args.masses if name == 'chamber' else [0]):
+                    print(f'{name}: {channels} channel(s), {masses} mass(es)', file=sys.stderr)
+                    results += runConfig(app, name, module, args, channels, masses)
+
+    report = {
+        'commit': gitCommit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'arguments': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump(report, stream, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import time
+import numpy as np
+
+
+class Pacer:
+    """Keeps an acquisition loop on a fixed sample period.
+
+    wait() sleeps until the next deadline. A sample that starts more than
+    tolerance (as a fraction of the period) after its deadline counts as late.
+    When the loop falls a full period or more behind, the missed deadlines are
+    skipped and counted as dropped instead of being made up in a burst.
+    """
+
+    def __init__(self, rate, tolerance=0.1):
+
+        self.period = 1.0 / float(rate)
+        self.tolerance = float(tolerance)
+        self.start()
+
+    def start(self):
+
+        self.t0 = time.perf_counter()
+        self.deadline = self.t0
+        self.count = 0
+        self.late = 0
+        self.dropped = 0
+
+    def wait(self):
+
+        now = time.perf_counter()
+        if now < self.deadline:
+            time.sleep(self.deadline - now)
+        else:
+            behind = now - self.deadline
+            if behind > self.tolerance * self.period:
+                self.late += 1
+            if behind >= self.period:
+                missed = int(behind / self.period)
+                self.dropped += missed
+                self.deadline += missed * self.period
+        deadline = self.deadline
+        self.deadline += self.period
+        self.count += 1
+        return deadline
+
+    def stats(self):
+
+        elapsed = time.perf_counter() - self.t0
+        return {
+            'samples': self.count,
+            'late': self.late,
+            'dropped': self.dropped,
+            'rate': self.count / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+class TimingStats:
+    """Sampling jitter of a run, from the monotonic start and end of each read.
+
+    add() takes the reads of one stream (the flowmeter, or one mass) one at a
+    time or as arrays. Only running sums are kept, so a run of any length costs
+    the same. Per stream, summary() gives the number of reads, the mean interval
+    between read starts, its jitter (rms and largest deviation from the mean)
+    and the mean and longest read duration, all in seconds.
+    """
+
+    def __init__(self):
+
+        self.streams = dict()
+
+    def add(self, stream, start, end):
+
+        start = np.atleast_1d(np.asarray(start, dtype=float))
+        end = np.atleast_1d(np.asarray(end, dtype=float))
+        valid = np.isfinite(start) & np.isfinite(end)
+        start, end = start[valid], end[valid]
+        if len(start) == 0:
+            return
+        if stream not in self.streams:
+            self.streams[stream] = {'reads': 0, 'last': None, 'intervals': 0, 'mean': 0.0, 'm2': 0.0,
+                                    'shortest': np.inf, 'longest': -np.inf, 'busy': 0.0, 'read_max': 0.0}
+        s = self.streams[stream]
+        intervals = np.diff(start if s['last'] is None else np.concatenate(([s['last']], start)))
+        if len(intervals) > 0:
+            # Mean and variance of the new intervals merged into the running ones
+            n = len(intervals)
+            mean = np.mean(intervals)
+            total = s['intervals'] + n
+            delta = mean - s['mean']
+            s['m2'] += np.sum((intervals - mean) ** 2) + delta ** 2 * s['intervals'] * n / total
+            s['mean'] += delta * n / total
+            s['intervals'] = total
+            s['shortest'] = min(s['shortest'], float(np.min(intervals)))
+            s['longest'] = max(s['longest'], float(np.max(intervals)))
+        s['reads'] += len(start)
+        s['last'] = float(start[-1])
+        s['busy'] += float(np.sum(end - start))
+        s['read_max'] = max(s['read_max'], float(np.max(end - start)))
+
+    def summary(self):
+
+        summary = dict()
+        for stream, s in self.streams.items():
+            stats = {'reads': s['reads'], 'read_mean': s['busy'] / s['reads'], 'read_max': s['read_max']}
+            if s['intervals'] > 0:
+                stats['interval_mean'] = float(s['mean'])
+                stats['jitter_rms'] = float(np.sqrt(s['m2'] / s['intervals']))
+                stats['jitter_max'] = float(max(s['longest'] - s['mean'], s['mean'] - s['shortest']))
+            summary[stream] = stats
+        return summary
+
+    def report(self):
+
+        lines = list()
+        for stream, stats in self.summary().items():
+            line = f"{stream}: {stats['reads']} reads"
+            if 'interval_mean' in stats:
+                line += (f", every {stats['interval_mean'] * 1e3:.1f} ms, jitter {stats['jitter_rms'] * 1e3:.2f} ms rms"
+                         f" / {stats['jitter_max'] * 1e3:.2f} ms max")
+            line += f", reads take {stats['read_mean'] * 1e3:.1f} ms mean / {stats['read_max'] * 1e3:.1f} ms max"
+            lines.append(line)
+        return '\n'.join(lines)
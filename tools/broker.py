@@ -0,0 +1,529 @@
+"""Device broker: one process owns the flowmeter and the RGA and shares their samples.
+
+The broker reads the devices once and publishes every sample into two rings in
+shared memory, one for the flowmeter channels and one for the RGA masses. Any
+number of processes can read them at the same time: both apps attach as
+clients when their flowmeter or RGA driver is set to 'broker' in
+settings.yaml, and other programs can use SharedRing directly.
+
+    python -m tools.broker
+    python -m tools.broker --channels ai0,ai1 --masses 2,18,28,32 --rate 10
+
+Each start of the broker is a new generation: its rings are named after it
+and it publishes their names in a state file in the temporary folder, so a
+restarted broker never reuses the memory of the previous one. Clients whose
+ring has gone silent look for a new generation there and attach to it.
+
+Stops cleanly on Ctrl+C or SIGTERM: the RGA is switched off and the shared
+memory and state file are removed, clients then time out on their next read.
+"""
+import os
+import json
+import time
+import secrets
+import tempfile
+import signal
+import argparse
+import threading
+import yaml
+import numpy as np
+from multiprocessing import shared_memory
+from tools.devices import openFlowmeter, openRGA, readChannels, switchOnRGA, switchOffRGA, scanMasses, clock
+from tools.acquisition import Pacer
+from tools.daemon import splitList
+
+settingsFile = os.path.dirname(os.path.realpath(__file__))+"/settings.yaml"
+
+# Fixed fields at the start of a ring, the column names follow as JSON
+FIELDS = np.dtype([('count', 'i8'), ('capacity', 'i8'), ('columns', 'i8'), ('pid', 'i8'), ('heartbeat', 'f8'), ('names', 'i8')])
+HEADER_SIZE = 4096
+
+
+def massColumn(mass):
+
+    return 'Mass '+str(float(mass))
+
+
+def statePath(name):
+
+    # Where the broker publishes the rings of its current generation
+    return os.path.join(tempfile.gettempdir(), name+'_broker.yml')
+
+
+def readState(name):
+
+    try:
+        with open(statePath(name), 'r') as stream:
+            state = yaml.safe_load(stream)
+    except (OSError, yaml.YAMLError):
+        state = None
+    if not isinstance(state, dict):
+        raise FileNotFoundError('The device broker '+name+' is not running')
+    return state
+
+
+def attachMemory(name):
+
+    # Only the broker removes the shared memory, a reader exiting must not
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        memory = shared_memory.SharedMemory(name=name)
+        if os.name == 'posix':
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(memory._name, 'shared_memory')
+        return memory
+
+
+class SharedRing:
+    """Ring of float64 samples in shared memory, with one writer and any number of readers.
+
+    SharedRing(name, columns, capacity) creates the ring, SharedRing(name)
+    attaches to an existing one. Samples are stored as a (columns, 2 * capacity)
+    array written twice, at i and i + capacity, so the latest `capacity`
+    samples are always one contiguous slice and read() returns a view into the
+    shared memory instead of a copy. The writer fills in new samples before it
+    raises the count in the header, each reader keeps its own cursor.
+    """
+
+    def __init__(self, name, columns=None, capacity=None):
+
+        self.name = name
+        self.owner = columns is not None
+        if self.owner:
+            columns = list(columns)
+            names = json.dumps(columns).encode()
+            if FIELDS.itemsize + len(names) > HEADER_SIZE:
+                raise ValueError('Too many columns for a shared ring: '+str(len(columns)))
+            capacity = int(capacity)
+            self.memory = shared_memory.SharedMemory(name=name, create=True, size=HEADER_SIZE + 8 * len(columns) * 2 * capacity)
+        else:
+            self.memory = attachMemory(name)
+        self.header = np.ndarray((), dtype=FIELDS, buffer=self.memory.buf)
+        if self.owner:
+            self.memory.buf[FIELDS.itemsize:FIELDS.itemsize + len(names)] = names
+            self.header['count'] = 0
+            self.header['capacity'] = capacity
+            self.header['columns'] = len(columns)
+            self.header['pid'] = os.getpid()
+            self.header['heartbeat'] = time.time()
+            self.header['names'] = len(names)
+        else:
+            names = bytes(self.memory.buf[FIELDS.itemsize:FIELDS.itemsize + int(self.header['names'])])
+            columns = json.loads(names.decode())
+            capacity = int(self.header['capacity'])
+        self.columns = columns
+        self.index = {column: idx for idx, column in enumerate(columns)}
+        self.capacity = capacity
+        self.data = np.ndarray((len(columns), 2 * capacity), dtype=np.float64, buffer=self.memory.buf, offset=HEADER_SIZE)
+
+    def count(self):
+
+        return int(self.header['count'])
+
+    def write(self, block):
+
+        # block has shape (columns, samples)
+        block = np.asarray(block, dtype=np.float64)
+        if block.ndim == 1:
+            block = block[:, np.newaxis]
+        count = self.count()
+        n = block.shape[1]
+        if n > self.capacity:
+            block = block[:, -self.capacity:]
+            count += n - self.capacity
+            n = self.capacity
+        pos = (count + np.arange(n)) % self.capacity
+        self.data[:, pos] = block
+        self.data[:, pos + self.capacity] = block
+        self.header['heartbeat'] = time.time()
+        self.header['count'] = count + n
+
+    def read(self, cursor):
+
+        # The samples from cursor to the latest as a view, and the new cursor.
+        # Samples the writer has already overwritten are skipped, and the view
+        # is only valid until the writer comes round again, copy to keep it
+        count = self.count()
+        start = max(cursor, count - self.capacity)
+        pos = start % self.capacity
+        return self.data[:, pos:pos + count - start], count
+
+    def last(self, column):
+
+        count = self.count()
+        if count == 0:
+            return np.nan
+        return float(self.data[self.index[column], (count - 1) % self.capacity])
+
+    def wait(self, cursor, timeout=5.0):
+
+        # Until there are samples after cursor. Raises TimeoutError when the
+        # writer has published nothing for `timeout` seconds
+        while self.count() <= cursor:
+            if time.time() - float(self.header['heartbeat']) > timeout:
+                raise TimeoutError('No samples from the device broker in '+self.name+' for '+str(timeout)+' s')
+            time.sleep(0.001)
+
+    def close(self):
+
+        self.header = None
+        self.data = None
+        try:
+            self.memory.close()
+        except BufferError:
+            pass  # A reader still holds a view, the mapping goes when the process exits
+        if self.owner:
+            self.memory.unlink()
+
+
+class BrokerClient:
+    """One ring of the running broker, followed across restarts of the broker.
+
+    read() returns the samples published since the previous call, waiting for
+    the broker's next one when there are none. When the ring stays silent for
+    `timeout` seconds and the broker has been started again since, the client
+    attaches to the new generation's ring and carries on from its next sample.
+    """
+
+    def __init__(self, name, ring, timeout=5.0):
+
+        self.name = name
+        self.kind = ring
+        self.timeout = float(timeout)
+        self.ring = None
+        self.generation = None
+        self.cursor = 0
+        self.attach()
+
+    def attach(self):
+
+        # True when the broker has a new generation and its ring is now the one read
+        state = readState(self.name)
+        if state['generation'] == self.generation:
+            return False
+        if not state.get(self.kind):
+            raise ValueError('The device broker '+self.name+' does not publish '+self.kind+' samples')
+        ring = SharedRing(state[self.kind])
+        if self.ring is not None:
+            self.ring.close()
+        self.ring = ring
+        self.generation = state['generation']
+        self.cursor = ring.count()
+        return True
+
+    def restarted(self):
+
+        try:
+            return self.attach()
+        except (FileNotFoundError, ValueError):
+            return False
+
+    def read(self):
+
+        # The samples a silent ring still holds are only read when the broker has not been started again
+        if time.time() - float(self.ring.header['heartbeat']) > self.timeout:
+            self.restarted()
+        while True:
+            try:
+                self.ring.wait(self.cursor, self.timeout)
+                break
+            except TimeoutError:
+                if not self.restarted():
+                    raise
+        data, self.cursor = self.ring.read(self.cursor)
+        return data
+
+    def close(self):
+
+        self.ring.close()
+
+
+class BrokerFlowmeter:
+    """Flowmeter driver that reads the samples published by the broker.
+
+    getChannels() returns every sample of the channels published since the
+    previous call, waiting for the broker's next read when there is none yet.
+    getBlock() returns them with the wall time the first of these reads
+    started and the start of the first and end of the last on the monotonic
+    clock, which all processes of the machine share.
+    """
+
+    def __init__(self, name='photochemistry', timeout=5.0, **kwargs):
+
+        self.client = BrokerClient(name, 'fm', timeout)
+
+    def getBlock(self, channels):
+
+        missing = [channel for channel in channels if channel not in self.client.ring.index]
+        if len(missing) > 0:
+            raise ValueError('Channels not read by the device broker: '+', '.join(missing))
+        data = self.client.read()
+        index = self.client.ring.index
+        times = {'time': float(data[index['time'], 0]), 'start': float(data[index['start'], 0]), 'end': float(data[index['end'], -1])}
+        return data[[index[channel] for channel in channels]], times
+
+    def getChannels(self, channels):
+
+        return self.getBlock(channels)[0]
+
+    def getData(self, channel="ai0"):
+
+        return self.getChannels([channel])[0]
+
+    def close(self):
+
+        self.client.close()
+
+
+class BrokerRGA:
+    """RGA driver for the masses measured by the broker.
+
+    Has the calls of srsinst.rga.RGA100 the apps use. Switching the RGA on and
+    off is left to the broker, and survey scans are not available since the
+    broker only measures its masses. All the masses of a client scan come
+    from one scan of the broker, whether the client scans them in batch or not.
+    """
+
+    def __init__(self, name='photochemistry', timeout=5.0, **kwargs):
+
+        self.client = BrokerClient(name, 'rga', timeout)
+        self.scan = BrokerScan(self.client)
+        self.ionizer = BrokerSwitch(self.client)
+        self.filament = BrokerSwitch(self.client)
+        self.cem = BrokerSwitch(self.client)
+
+    def disconnect(self):
+
+        self.client.close()
+
+
+class BrokerScan:
+
+    def __init__(self, client):
+
+        self.client = client
+
+    def get_timed_scan(self, *masses):
+
+        # Partial pressures from the broker's next scan, NaN for masses it does not measure,
+        # with the wall time of the scan and its start and end on the monotonic clock
+        latest = self.client.read()[:, -1]
+        index = self.client.ring.index
+        values = np.array([latest[index[massColumn(mass)]] if massColumn(mass) in index else np.nan for mass in masses])
+        return values, {'time': float(latest[index['time']]), 'start': float(latest[index['start']]), 'end': float(latest[index['end']])}
+
+    def get_multiple_mass_scan(self, *masses):
+
+        return self.get_timed_scan(*masses)[0]
+
+    def get_partial_pressure_corrected_spectrum(self, spectrum):
+
+        # The broker publishes corrected partial pressures already
+        return np.asarray(spectrum, dtype=float)
+
+    def set_parameters(self, *args):
+
+        raise RuntimeError('Survey scans are not available through the device broker')
+
+
+class BrokerSwitch:
+    """Ionizer, filament and CEM of a BrokerRGA, the readings come from the broker."""
+
+    def __init__(self, client):
+
+        self.client = client
+
+    @property
+    def emission_current(self):
+
+        return self.client.ring.last('emission_current')
+
+    @property
+    def voltage(self):
+
+        return self.client.ring.last('cem_voltage')
+
+    def set_parameters(self, *args):
+
+        pass
+
+    def turn_on(self):
+
+        pass
+
+    def turn_off(self):
+
+        pass
+
+
+class Broker:
+
+    def __init__(self, settings, channels, masses, rga=True, rate=0.0, status=10.0):
+
+        self.settings = settings
+        self.par = settings['broker']
+        self.channels = list(channels)
+        self.masses = [float(mass) for mass in masses] if rga else []
+        self.useRGA = bool(rga) and len(self.masses) > 0
+        self.rate = float(rate)
+        self.status = float(status)
+        self.stopped = threading.Event()
+        self.fm = None
+        self.rga = None
+        self.rings = list()
+        self.generation = secrets.token_hex(3)  # Short, shared memory names are limited to 31 characters on macOS
+        self.stateWritten = False
+        self.reads = 0
+        self.scans = 0
+
+    def stop(self, *args):
+
+        # Signal handler, the loops finish their current read and shut down
+        self.stopped.set()
+
+    def open(self):
+
+        # The broker's own drivers, the 'broker' driver is only for the clients
+        devices = {'flowmeter': dict(self.settings['devices']['flowmeter'], driver=self.par['flowmeter']),
+                   'rga': dict(self.settings['devices']['rga'], driver=self.par['rga'])}
+        if 'broker' in (self.par['flowmeter'], self.par['rga']):
+            raise ValueError("The broker cannot use the 'broker' driver itself")
+        own = dict(self.settings, devices=devices)
+        name = self.par['name']+'_'+self.generation
+
+        print('Opening flowmeter ('+self.par['flowmeter']+')')
+        self.fm = openFlowmeter(own)
+        self.fmRing = SharedRing(name+'_fm', ['time', 'start', 'end'] + self.channels, self.par['capacity'])
+        self.rings.append(self.fmRing)
+        if self.useRGA:
+            print('Turning on SRS RGA ('+self.par['rga']+')')
+            self.rga = openRGA(own)
+            switchOnRGA(self.rga)
+            print('Emission current: '+str(self.rga.ionizer.emission_current)+' A')
+            print('CEM Voltage: '+str(self.rga.cem.voltage)+' V')
+            self.rgaRing = SharedRing(name+'_rga', ['time', 'start', 'end', 'emission_current', 'cem_voltage'] + [massColumn(mass) for mass in self.masses], self.par['scans'])
+            self.rings.append(self.rgaRing)
+        # Written to a temporary file first so clients never read half a state
+        state = {'pid': os.getpid(), 'generation': self.generation, 'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                 'fm': self.fmRing.name, 'rga': self.rgaRing.name if self.useRGA else None}
+        path = statePath(self.par['name'])
+        with open(path+'.tmp', 'w') as outfile:
+            yaml.dump(state, outfile, default_flow_style=False)
+        os.replace(path+'.tmp', path)
+        self.stateWritten = True
+        print('Publishing in shared memory '+', '.join(ring.name for ring in self.rings))
+
+    def readFlowmeter(self):
+
+        pacer = Pacer(self.rate) if self.rate > 0 else None
+        if pacer is not None:
+            pacer.start()
+        while not self.stopped.is_set():
+            if pacer is not None:
+                pacer.wait()
+            t = time.time()
+            start = clock()
+            data = readChannels(self.fm, self.channels)
+            end = clock()
+            if data.size == 0:
+                continue
+            # The samples of a read are taken as evenly spread over its duration, and
+            # each carries the start and end of its read for the clients' timing
+            n = data.shape[1]
+            times = t + (end - start) * np.arange(n) / n
+            self.fmRing.write(np.vstack((times, np.full(n, start), np.full(n, end), data)))
+            self.reads += 1
+
+    def readRGA(self):
+
+        batch = self.settings['srs']['rga100']['batch']
+        while not self.stopped.is_set():
+            Pi_values, scan = scanMasses(self.rga, self.masses, batch)
+            self.rgaRing.write(np.concatenate(([scan['wall'], scan['start'], scan['end'], self.rga.ionizer.emission_current, self.rga.cem.voltage], Pi_values)))
+            self.scans += 1
+
+    def guard(self, loop):
+
+        # A device error stops the whole broker, so clients time out instead of reading stale samples
+        try:
+            loop()
+        finally:
+            self.stopped.set()
+
+    def run(self):
+
+        threads = list()
+        try:
+            self.open()
+            threads.append(threading.Thread(target=self.guard, args=(self.readFlowmeter,), name='broker-fm'))
+            if self.useRGA:
+                threads.append(threading.Thread(target=self.guard, args=(self.readRGA,), name='broker-rga'))
+            for thread in threads:
+                thread.start()
+            start = time.monotonic()
+            while not self.stopped.wait(self.status):
+                elapsed = time.monotonic() - start
+                line = f'{self.reads} flowmeter reads ({self.reads / elapsed:.2f} Hz)'
+                if self.useRGA:
+                    line += f', {self.scans} RGA scans ({self.scans / elapsed:.2f} Hz)'
+                print(line)
+        finally:
+            self.stopped.set()
+            for thread in threads:
+                thread.join()
+            self.close()
+
+    def close(self):
+
+        if self.rga is not None:
+            print('Turning off SRS RGA.')
+            switchOffRGA(self.rga)
+            self.rga.disconnect()
+            print('SRS RGA off.')
+            self.rga = None
+        if hasattr(self.fm, 'close'):
+            self.fm.close()
+        if self.stateWritten:
+            # Only this generation's state, a broker started since keeps its own
+            try:
+                if readState(self.par['name'])['generation'] == self.generation:
+                    os.remove(statePath(self.par['name']))
+            except FileNotFoundError:
+                pass
+            self.stateWritten = False
+        for ring in self.rings:
+            ring.close()
+        self.rings = list()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Read the flowmeters and the RGA once and share the samples with the apps.')
+    parser.add_argument('--settings', default=settingsFile, help='settings file (default tools/settings.yaml)')
+    parser.add_argument('--channels', help="flowmeter channels, e.g. 'ai0,ai1'")
+    parser.add_argument('--masses', help="RGA masses, e.g. '2,18,28,32'")
+    parser.add_argument('--no-rga', action='store_true', help='read the flowmeters only')
+    parser.add_argument('--rate', type=float, help='flowmeter reads per second, 0 reads as fast as the device allows')
+    args = parser.parse_args()
+
+    with open(args.settings, 'r') as stream:
+        settings = yaml.safe_load(stream)
+    par = settings['broker']
+    masses = args.masses if args.masses is not None else (par['masses'] or settings['srs']['rga100']['masses'])
+
+    broker = Broker(settings,
+                    channels=splitList(args.channels if args.channels is not None else par['channels']),
+                    masses=splitList(masses),
+                    rga=bool(par['rga']) and not args.no_rga,
+                    rate=args.rate if args.rate is not None else par['rate'],
+                    status=par['status'])
+    signal.signal(signal.SIGINT, broker.stop)
+    signal.signal(signal.SIGTERM, broker.stop)
+    if hasattr(signal, 'SIGBREAK'):
+        signal.signal(signal.SIGBREAK, broker.stop)  # Ctrl+Break on Windows
+    broker.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import numpy as np
+
+
+class Calibration:
+    """Converts flowmeter voltages to flow, with one curve per gas.
+
+    The curves come from the 'calibration' section of settings.yaml, each a
+    list of [volts, flow] points joined by straight lines. They are compiled
+    once into the inner breakpoints and the slope and offset of every segment,
+    so convert() is one searchsorted and one multiply-add over a whole block
+    of samples. Beyond the first and last points the end segments are extended.
+    """
+
+    def __init__(self, curves=None, unit='sccm', plot=True, **kwargs):
+
+        self.unit = unit
+        self.plot = bool(plot)
+        self.curves = dict(curves or {})
+        self.tables = {gas: self.compile(gas, points) for gas, points in self.curves.items()}
+
+    def compile(self, gas, points):
+
+        points = np.array(points, dtype=float)
+        if (points.ndim != 2) or (points.shape[1] != 2) or (len(points) < 2):
+            raise ValueError('The calibration of '+gas+' needs at least two [volts, flow] points')
+        points = points[np.argsort(points[:, 0])]
+        volts, flow = points.T
+        if np.any(np.diff(volts) == 0):
+            raise ValueError('The calibration of '+gas+' has two points at the same voltage')
+        slope = np.diff(flow) / np.diff(volts)
+        offset = flow[:-1] - slope * volts[:-1]
+        return volts[1:-1], slope, offset
+
+    def __contains__(self, gas):
+
+        return gas in self.tables
+
+    def convert(self, gas, volts):
+
+        # Flow for a voltage or an array of them, NaN when the gas has no curve
+        volts = np.asarray(volts, dtype=float)
+        if gas not in self.tables:
+            flow = np.full(volts.shape, np.nan)
+        else:
+            inner, slope, offset = self.tables[gas]
+            segment = np.searchsorted(inner, volts, side='right')
+            flow = offset[segment] + slope[segment] * volts
+        return float(flow) if flow.ndim == 0 else flow
+
+    def name(self, gas):
+
+        # Header of the flow column of a gas
+        return gas+' ('+self.unit+')'
+
+    def metadata(self, gases):
+
+        # The curves used for a run, for its .yml
+        return {'unit': self.unit, 'curves': {gas: self.curves[gas] for gas in gases if gas in self}}
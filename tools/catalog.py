@@ -0,0 +1,251 @@
+"""Catalog of the prc* runs in the dated data tree, kept in a local SQLite file.
+
+Each run is indexed once with its columns (masses and gas names), start time,
+duration, row count and the min/max/mean of every column. Later updates only
+read the runs whose files have changed since. Runs can then be found by gas
+and masses without opening them, and loaded together:
+
+    python -m tools.catalog update
+    python -m tools.catalog find --gas O2 --masses 28,32 --since 2024-01-01
+
+    catalog = Catalog()
+    runs = catalog.find(gas='Oxygen', masses=[28, 32])
+    data = catalog.load(runs, ['Time (s)', 'Mass 28.0', 'Oxygen (O2)'])
+"""
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import argparse
+import yaml
+import numpy as np
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from tools.recording import readMetadata, loadRun, readCsv
+
+settingsFile = os.path.dirname(os.path.realpath(__file__))+"/settings.yaml"
+
+# Every file and folder of a run starts with its name: .csv, .yml, _001.csv.gz, _npy, _raw, ...
+RUN = re.compile(r'^prc(\d{8}_\d{6})')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    started TEXT,
+    duration REAL,
+    rows INTEGER,
+    format TEXT,
+    signature TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS run_columns (
+    run INTEGER REFERENCES runs(id) ON DELETE CASCADE,
+    position INTEGER,
+    name TEXT,
+    kind TEXT,
+    mass REAL,
+    min REAL,
+    max REAL,
+    mean REAL
+);
+CREATE INDEX IF NOT EXISTS run_columns_run ON run_columns(run);
+CREATE INDEX IF NOT EXISTS run_columns_name ON run_columns(name);
+CREATE INDEX IF NOT EXISTS run_columns_mass ON run_columns(mass);
+CREATE INDEX IF NOT EXISTS runs_started ON runs(started);
+"""
+
+
+def columnKind(name):
+
+    # 'time' (the time axis and the read times), 'mass' with its m/z, 'noise' for the noise
+    # of a flowmeter's reads or 'gas' for a flowmeter column
+    if name.startswith('Time') or name.endswith(' (s)'):
+        return 'time', None
+    if name.endswith(' noise (v)'):
+        return 'noise', None
+    match = re.match(r'^Mass\s+([0-9.]+)$', name)
+    if match:
+        return 'mass', float(match.group(1))
+    return 'gas', None
+
+
+def readRun(path, columns=None):
+
+    # Returns (header, {column: array}), from the binary files when the run has
+    # them (memory-mapped, only the columns asked for) or from the CSV segments
+    par = readMetadata(path)
+    if 'binary' in par:
+        header = par['binary']['columns']
+        return header, loadRun(path, [column for column in header if columns is None or column in columns])
+    header, data = readCsv(path)
+    return header, {column: data[:, idx] for idx, column in enumerate(header) if columns is None or column in columns}
+
+
+class Catalog:
+
+    def __init__(self, file=None):
+
+        if file is None:
+            file = os.path.expanduser('~/photochemistry_catalog.sqlite')
+        self.file = file
+        self.db = sqlite3.connect(file)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+
+        self.db.close()
+
+    def scan(self, folder):
+
+        # {run path: signature} for every run under folder, the signature
+        # changes whenever one of the run's files is added, removed or modified
+        runs = dict()
+        for dirpath, dirnames, filenames in os.walk(folder):
+            files = dict()
+            for entry in os.scandir(dirpath):
+                match = RUN.match(entry.name)
+                if match is None:
+                    continue
+                stats = [(entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)]
+                if entry.is_dir():
+                    stats += [(entry.name+'/'+sub.name, sub.stat().st_size, sub.stat().st_mtime_ns) for sub in os.scandir(entry.path)]
+                files.setdefault('prc'+match.group(1), list()).extend(stats)
+            for name, stats in files.items():
+                # A run is something with data, not only a .yml or a log
+                if any(file.endswith(('.csv', '.csv.gz', '_npy')) for file, size, mtime in stats):
+                    runs[os.path.join(dirpath, name)] = hashlib.sha1(repr(sorted(stats)).encode()).hexdigest()
+        return runs
+
+    def update(self, folder, verbose=False):
+        """Indexes the new and changed runs under folder and drops the ones that are
+        gone, returns the number of runs indexed, removed and unchanged."""
+
+        runs = self.scan(folder)
+        known = {path: (run, signature) for run, path, signature in self.db.execute('SELECT id, path, signature FROM runs')}
+        prefix = os.path.join(folder, '')
+        removed = [run for path, (run, signature) in known.items() if path.startswith(prefix) and path not in runs]
+        with self.db:
+            self.db.executemany('DELETE FROM runs WHERE id = ?', [(run,) for run in removed])
+        changed = [path for path, signature in sorted(runs.items()) if (path not in known) or (known[path][1] != signature)]
+        for path in changed:
+            start = time.perf_counter()
+            self.index(path, runs[path])
+            if verbose:
+                print(f'Indexed {path} ({time.perf_counter() - start:.2f} s)')
+        return len(changed), len(removed), len(runs) - len(changed)
+
+    def index(self, path, signature):
+
+        match = RUN.match(os.path.basename(path))
+        started = datetime.strptime(match.group(1), '%Y%m%d_%H%M%S').isoformat()
+        header, rows, duration, stats, error = list(), 0, None, list(), None
+        try:
+            header, data = readRun(path)
+            for position, name in enumerate(header):
+                values = np.asarray(data[name], dtype=float)
+                rows = max(rows, len(values))
+                finite = values[np.isfinite(values)]
+                kind, mass = columnKind(name)
+                if len(finite) > 0:
+                    stats.append((position, name, kind, mass, float(np.min(finite)), float(np.max(finite)), float(np.mean(finite))))
+                    if (kind == 'time') and (duration is None):
+                        duration = float(finite[-1] - finite[0])
+                else:
+                    stats.append((position, name, kind, mass, None, None, None))
+        except Exception as problem:
+            # Kept with the error so it is not read again until its files change
+            error = str(problem)
+        file_format = 'binary' if 'binary' in readMetadata(path) else 'csv'
+        with self.db:
+            self.db.execute('DELETE FROM runs WHERE path = ?', (path,))
+            run = self.db.execute('INSERT INTO runs (path, started, duration, rows, format, signature, error) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                  (path, started, duration, rows, file_format, signature, error)).lastrowid
+            self.db.executemany('INSERT INTO run_columns (run, position, name, kind, mass, min, max, mean) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                [(run,) + stat for stat in stats])
+
+    def find(self, gas=None, masses=None, since=None, until=None):
+        """Runs with a flowmeter column containing `gas` (e.g. 'O2' or 'Oxygen') and
+        all of `masses`, started between since and until (ISO dates). Returns a list
+        of dicts with path, started, duration, rows and columns, oldest first."""
+
+        query = 'SELECT id, path, started, duration, rows FROM runs r WHERE error IS NULL'
+        args = list()
+        if gas:
+            query += " AND EXISTS (SELECT 1 FROM run_columns c WHERE c.run = r.id AND c.kind = 'gas' AND c.name LIKE ?)"
+            args.append('%'+gas+'%')
+        if masses:
+            masses = sorted(set(float(mass) for mass in masses))
+            query += ' AND (SELECT COUNT(DISTINCT c.mass) FROM run_columns c WHERE c.run = r.id AND c.mass IN ('+','.join('?' * len(masses))+')) = ?'
+            args += masses + [len(masses)]
+        if since:
+            query += ' AND started >= ?'
+            args.append(str(since))
+        if until:
+            query += ' AND started < ?'
+            args.append(str(until))
+        runs = list()
+        for run, path, started, duration, rows in self.db.execute(query+' ORDER BY started', args).fetchall():
+            columns = [name for name, in self.db.execute('SELECT name FROM run_columns WHERE run = ? ORDER BY position', (run,))]
+            runs.append({'path': path, 'started': started, 'duration': duration, 'rows': rows, 'columns': columns})
+        return runs
+
+    def stats(self, path):
+
+        # {column: {'min', 'max', 'mean'}} of an indexed run
+        rows = self.db.execute('SELECT c.name, c.min, c.max, c.mean FROM run_columns c JOIN runs r ON c.run = r.id WHERE r.path = ? ORDER BY c.position', (path,))
+        return {name: {'min': low, 'max': high, 'mean': mean} for name, low, high, mean in rows}
+
+    def load(self, runs, columns, workers=4):
+        """Loads `columns` from many runs at once, runs being paths or find() results.
+
+        Returns a dict with one array per column holding the rows of every run one
+        after the other (NaN where a run has no such column), and 'run', the index
+        in `runs` of the run each row comes from. The runs are read in parallel.
+        """
+
+        paths = [run['path'] if isinstance(run, dict) else run for run in runs]
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='catalog') as executor:
+            loaded = list(executor.map(lambda path: readRun(path, columns)[1], paths))
+        lengths = [max((len(data[column]) for column in data), default=0) for data in loaded]
+        result = {'run': np.repeat(np.arange(len(paths)), lengths)}
+        for column in columns:
+            result[column] = np.concatenate([np.asarray(data[column], dtype=float) if column in data else np.full(length, np.nan)
+                                             for data, length in zip(loaded, lengths)] + [np.empty(0)])
+        return result
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Index the prc* runs in SQLite and find them by gas, masses and date.')
+    parser.add_argument('command', choices=['update', 'find'])
+    parser.add_argument('--settings', default=settingsFile, help='settings file (default tools/settings.yaml)')
+    parser.add_argument('--folder', help='data folder (default data.folder in the settings)')
+    parser.add_argument('--file', help='catalog file (default catalog.file in the settings)')
+    parser.add_argument('--gas', help="flowmeter gas, any part of the name, e.g. 'O2'")
+    parser.add_argument('--masses', help="masses the runs must all have, e.g. '28,32'")
+    parser.add_argument('--since', help='runs started on or after this date, e.g. 2024-01-31')
+    parser.add_argument('--until', help='runs started before this date')
+    args = parser.parse_args()
+
+    with open(args.settings, 'r') as stream:
+        settings = yaml.safe_load(stream)
+    catalog = Catalog(args.file or settings['catalog']['file'] or None)
+    if args.command == 'update':
+        indexed, removed, unchanged = catalog.update(args.folder or settings['data']['folder'], verbose=True)
+        print(f'{indexed} runs indexed, {removed} removed, {unchanged} unchanged')
+    else:
+        masses = [mass for mass in re.split(';|,', args.masses) if mass.strip() != ''] if args.masses else None
+        runs = catalog.find(gas=args.gas, masses=masses, since=args.since, until=args.until)
+        for run in runs:
+            duration = f"{run['duration']:.0f} s" if run['duration'] is not None else '-'
+            print(f"{run['started']}  {duration:>10}  {run['rows']:>8} rows  {run['path']}")
+            print('    '+', '.join(run['columns']))
+        print(f'{len(runs)} runs')
+    catalog.close()
+
+
+if __name__ == "__main__":
+    main()
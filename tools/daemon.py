@@ -0,0 +1,258 @@
+"""Headless acquisition for long unattended runs, without the Qt GUI.
+
+Reads the flowmeters and the RGA with the same device code as the chamber app
+and saves the run under the same prcYYYYMMDD_HHMMSS name, with the same
+columns. Each cycle only scans the masses due by the 'schedule' section of
+srs.rga100, as in the chamber app. Channels, gases and masses come from the
+'daemon' section of settings.yaml unless given on the command line:
+
+    python -m tools.daemon
+    python -m tools.daemon --channels ai0,ai1 --gases "Oxygen (O2),Nitrogen (N2)" --masses 2,18,28,32 --rate 5
+
+Stops cleanly on Ctrl+C or SIGTERM: pending rows are flushed, the RGA is
+switched off and the run's .yml is completed. While running, daemon.yml in the
+data folder names the run being recorded and every row is also published in
+shared memory, where either app started with --attach follows it:
+
+    python "Photoreactor Chamber.py" --attach
+"""
+import os
+import time
+import signal
+import argparse
+import yaml
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from tools.devices import openFlowmeter, openRGA, switchOnRGA, switchOffRGA, readCycle, clock
+from tools.writers import openWriter, runPath
+from tools.recording import readMetadata, writeMetadata, RawRecorder
+from tools.acquisition import Pacer, TimingStats
+from tools.scheduler import MassScheduler
+from tools.metrics import Metrics, MetricsExporter
+from tools.calibration import Calibration
+
+settingsFile = os.path.dirname(os.path.realpath(__file__))+"/settings.yaml"
+
+
+def splitList(text):
+
+    if text is None:
+        return []
+    if isinstance(text, (list, tuple)):
+        return list(text)
+    return [item.strip() for item in str(text).replace(';', ',').split(',') if item.strip() != '']
+
+
+class Daemon:
+
+    def __init__(self, settings, channels, gases, masses, rga=True, rate=2.0, duration=0.0, status=10.0):
+
+        if len(gases) != len(channels):
+            raise ValueError(f'{len(channels)} channels but {len(gases)} gases')
+        self.settings = settings
+        self.channels = list(channels)
+        self.gases = list(gases)
+        self.masses = [float(mass) for mass in masses] if rga else []
+        self.useRGA = bool(rga) and len(self.masses) > 0
+        # Each cycle only scans the masses due, from the 'schedule' section of srs.rga100
+        self.scheduler = MassScheduler(self.masses, **settings['srs']['rga100']['schedule'])
+        self.rate = float(rate)
+        self.duration = float(duration)
+        self.status = float(status)
+        self.stopped = False
+        self.fm = None
+        self.rga = None
+        self.writer = None
+        self.raw = None
+        self.ring = None
+        self.metrics = Metrics(**settings['metrics'])
+        self.calibration = Calibration(**settings['calibration'])
+        self.calibrated = [idx for idx, gas in enumerate(self.gases) if gas in self.calibration]
+        self.timing = TimingStats()
+        self.exporter = None
+        self.statusFile = settings['data']['folder']+'daemon.yml'
+        self.statusWritten = False
+
+    def stop(self, *args):
+
+        # Signal handler, the loop finishes its current cycle and shuts down
+        self.stopped = True
+
+    def open(self):
+
+        print('Opening flowmeter ('+self.settings['devices']['flowmeter'].get('driver', 'matheson')+')')
+        self.fm = openFlowmeter(self.settings)
+        if self.useRGA:
+            print('Turning on SRS RGA.')
+            self.rga = openRGA(self.settings)
+            switchOnRGA(self.rga)
+            print('Emission current: '+str(self.rga.ionizer.emission_current)+' A')
+            print('CEM Voltage: '+str(self.rga.cem.voltage)+' V')
+
+        self.path, self.file = runPath(self.settings['data']['folder'])
+        print('Saving to file: '+self.path)
+        par = {'t_unit': 's', 'Pi_unit': 'Torr', 'time_origin': self.started,
+               'daemon': {'channels': self.channels, 'gases': self.gases, 'masses': self.masses, 'rate': self.rate},
+               'schedule': dict(self.settings['srs']['rga100']['schedule'])}
+        if len(self.calibrated) > 0:
+            par['calibration'] = self.calibration.metadata(self.gases)
+        writeMetadata(self.path, par)
+        self.header = (['Time (s)'] + ['Mass '+str(mass) for mass in self.masses] + self.gases + [self.calibration.name(self.gases[idx]) for idx in self.calibrated]
+                       + [gas+' noise (v)' for gas in self.gases] + ['Flowmeter end (s)'] + ['Mass '+str(mass)+' '+edge+' (s)' for mass in self.masses for edge in ('start', 'end')])
+        self.writer = openWriter(self.path, self.header, self.settings['data'])
+        share = self.settings['daemon'].get('share')
+        if share:
+            from tools.broker import SharedRing
+            self.ring = SharedRing(share, self.header, self.settings['daemon']['capacity'])
+        if self.settings['data']['raw']:
+            self.raw = RawRecorder(self.path, self.channels, self.gases, self.t0)
+            par = readMetadata(self.path)
+            par['raw'] = os.path.basename(self.path)+'_raw'
+            writeMetadata(self.path, par)
+
+        status = {'pid': os.getpid(), 'path': os.path.abspath(self.path), 'file': self.file, 'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'columns': self.header, 'format': self.settings['data'].get('format', 'csv'), 'rate': self.rate,
+                  'ring': self.ring.name if self.ring is not None else None}
+        with open(self.statusFile, 'w') as outfile:
+            yaml.dump(status, outfile, default_flow_style=False)
+        self.statusWritten = True
+        self.exporter = MetricsExporter(self.metrics, **self.settings['metrics']).start()
+
+    def run(self):
+
+        executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='device') if self.settings['acquisition']['concurrent'] else None
+        batch = self.settings['srs']['rga100']['batch']
+        pacer = Pacer(self.rate) if self.rate > 0 else None
+        scanTimes = list()
+        rows = 0
+        # Times are seconds on the monotonic clock of the device reads since t0
+        t0 = self.t0 = clock()
+        self.started = time.time()
+        start = time.monotonic()
+        lastStatus = start
+        try:
+            self.open()
+            if pacer is not None:
+                pacer.start()
+            while not self.stopped:
+                if (self.duration > 0) and (time.monotonic() - start >= self.duration):
+                    break
+                if pacer is not None:
+                    pacer.wait()
+                masses = self.scheduler.next(clock()) if self.useRGA else []
+                with self.metrics.timed('cycle'):
+                    fmData, Pi_values, scan = readCycle(self.fm, self.rga, self.channels, masses, batch, executor, self.raw is not None,
+                                                        self.calibration, self.gases)
+                self.metrics.record('flowmeter_read', fmData['duration'])
+                if scan is not None:
+                    self.metrics.record('rga_read', scan['time'])
+                    scanTimes.append(scan['per_mass'])
+                    self.scheduler.update(masses, Pi_values, scan['starts'])
+                with self.metrics.timed('save'):
+                    volts = list(fmData['stats']['mean'])
+                    flows = [fmData['flow'][idx] for idx in self.calibrated]
+                    noise = list(fmData['stats']['std'])
+                    self.timing.add('flowmeter', fmData['start'], fmData['end'])
+                    # The masses not scanned this cycle are NaN until their next scan
+                    pressures = list()
+                    edges = list()
+                    scanned = {mass: idx for idx, mass in enumerate(masses)} if scan is not None else {}
+                    for mass in self.masses:
+                        idx = scanned.get(mass)
+                        if idx is not None:
+                            pressures.append(Pi_values[idx])
+                            edges += [scan['starts'][idx] - t0, scan['ends'][idx] - t0]
+                            self.timing.add('Mass '+str(mass), scan['starts'][idx], scan['ends'][idx])
+                        else:
+                            pressures.append(np.nan)
+                            edges += [np.nan, np.nan]
+                    row = [fmData['start'] - t0] + pressures + volts + flows + noise + [fmData['end'] - t0] + edges
+                    self.writer.writerow(row)
+                    if self.ring is not None:
+                        self.ring.write(row)
+                    if self.raw is not None:
+                        self.raw.write(fmData, fmData.pop('raw'))
+                rows += 1
+                if time.monotonic() - lastStatus >= self.status:
+                    lastStatus = time.monotonic()
+                    line = f'{rows} rows, {rows / (lastStatus - start):.2f} Hz'
+                    if pacer is not None:
+                        stats = pacer.stats()
+                        line += f", {stats['late']} late, {stats['dropped']} dropped"
+                    print(line)
+        finally:
+            self.close(rows, scanTimes, pacer)
+            if executor is not None:
+                executor.shutdown()
+
+    def close(self, rows, scanTimes, pacer):
+
+        if self.writer is not None:
+            self.writer.close()
+            par = readMetadata(self.path)
+            if len(scanTimes) > 0:
+                par['rga_scan_time_per_mass'] = float(np.mean(scanTimes))
+            if pacer is not None:
+                par['daemon']['pacer'] = pacer.stats()
+            par['timing'] = self.timing.summary()
+            writeMetadata(self.path, par)
+            print(self.timing.report())
+            print('Closed file: '+self.path+' ('+str(rows)+' rows)')
+            self.writer = None
+        if self.raw is not None:
+            self.raw.close()
+            self.raw = None
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+        if self.rga is not None:
+            print('Turning off SRS RGA.')
+            switchOffRGA(self.rga)
+            self.rga.disconnect()
+            print('SRS RGA off.')
+            self.rga = None
+        if hasattr(self.fm, 'close'):
+            self.fm.close()
+        if self.exporter is not None:
+            self.exporter.stop()
+        if self.statusWritten and os.path.exists(self.statusFile):
+            os.remove(self.statusFile)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Record flowmeters and RGA masses without the GUI.')
+    parser.add_argument('--settings', default=settingsFile, help='settings file (default tools/settings.yaml)')
+    parser.add_argument('--channels', help="flowmeter channels, e.g. 'ai0,ai1'")
+    parser.add_argument('--gases', help="gas on each channel, e.g. 'Oxygen (O2),Nitrogen (N2)'")
+    parser.add_argument('--masses', help="RGA masses, e.g. '2,18,28,32'")
+    parser.add_argument('--no-rga', action='store_true', help='record the flowmeters only')
+    parser.add_argument('--rate', type=float, help='cycles per second, 0 reads as fast as the devices allow')
+    parser.add_argument('--duration', type=float, help='seconds to record, 0 runs until stopped')
+    parser.add_argument('--format', help="data format: 'csv', 'binary' or 'both'")
+    args = parser.parse_args()
+
+    with open(args.settings, 'r') as stream:
+        settings = yaml.safe_load(stream)
+    par = settings['daemon']
+    if args.format is not None:
+        settings['data']['format'] = args.format
+    masses = args.masses if args.masses is not None else (par['masses'] or settings['srs']['rga100']['masses'])
+
+    daemon = Daemon(settings,
+                    channels=splitList(args.channels if args.channels is not None else par['channels']),
+                    gases=splitList(args.gases if args.gases is not None else par['gases']),
+                    masses=splitList(masses),
+                    rga=par['rga'] and not args.no_rga,
+                    rate=args.rate if args.rate is not None else par['rate'],
+                    duration=args.duration if args.duration is not None else par['duration'],
+                    status=par['status'])
+    signal.signal(signal.SIGINT, daemon.stop)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    if hasattr(signal, 'SIGBREAK'):
+        signal.signal(signal.SIGBREAK, daemon.stop)  # Ctrl+Break on Windows
+    daemon.run()
+
+
+if __name__ == "__main__":
+    main()
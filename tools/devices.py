@@ -0,0 +1,408 @@
+import time
+import numpy as np
+
+# Device layer shared by both apps. The driver for each device is chosen in the
+# 'devices' section of settings.yaml, the hardware packages are only imported
+# when their driver is used so the simulated drivers run on any machine.
+
+# Summary of one channel over one read, the GUI gets these instead of the raw samples:
+# the mean voltage, its standard deviation (the noise saved with the run), its extremes and the sample count
+STATS = np.dtype([('mean', 'f8'), ('std', 'f8'), ('min', 'f8'), ('max', 'f8'), ('n', 'i8')])
+
+# Clock of the start and end of every device read: monotonic, high resolution and
+# unaffected by changes of the wall clock. Run times are differences of this clock,
+# the wall time ('time' of a read) only anchors a run on the calendar
+clock = time.perf_counter
+
+
+def openFlowmeter(settings):
+
+    par = settings['devices']['flowmeter']
+    driver = par.get('driver', 'matheson')
+    if driver == 'matheson':
+        import matheson_fm as fm
+        return fm.fm()
+    if driver == 'daq':
+        return DaqFlowmeter(**par.get('daq', {}))
+    if driver == 'simulated':
+        return SimulatedFlowmeter(**par.get('simulated', {}))
+    if driver == 'broker':
+        from tools.broker import BrokerFlowmeter
+        return BrokerFlowmeter(**settings['broker'])
+    raise ValueError('Unknown flowmeter driver: '+str(driver))
+
+
+def readChannels(fm, channels):
+
+    # Returns an array of shape (channels, samples). Drivers with getChannels()
+    # sample every channel in one acquisition, otherwise each channel is read in turn
+    if len(channels) == 0:
+        return np.empty((0, 0))
+    if hasattr(fm, 'getChannels'):
+        return fm.getChannels(list(channels))
+    return np.vstack([fm.getData(channel = channel) for channel in channels])
+
+
+def reduceBlock(data):
+
+    # Per-channel statistics of a (channels, samples) block, vectorized over the channels.
+    # The deviations reuse the mean instead of np.std computing it again
+    stats = np.empty(len(data), dtype=STATS)
+    stats['n'] = data.shape[1] if data.ndim == 2 else 0
+    if data.size == 0:
+        for field in ('mean', 'std', 'min', 'max'):
+            stats[field] = np.nan
+        return stats
+    mean = np.mean(data, axis=1)
+    stats['mean'] = mean
+    stats['std'] = np.sqrt(np.mean(np.square(data - mean[:, None]), axis=1))
+    stats['min'] = np.min(data, axis=1)
+    stats['max'] = np.max(data, axis=1)
+    return stats
+
+
+def readFlowmeters(fm, channels, raw=False, calibration=None, gases=None):
+
+    # One read of all enabled channels, reduced to a STATS record per channel, with the
+    # wall time it was taken, and its start and end on the monotonic clock. The raw
+    # block is only kept if raw is set
+    if hasattr(fm, 'getBlock'):
+        # Drivers reading the samples of another process give the times of its reads, not of the wait for them
+        data, times = fm.getBlock(list(channels))
+        t, start, end = times['time'], times['start'], times['end']
+    else:
+        t = time.time()
+        start = clock()
+        data = readChannels(fm, channels)
+        end = clock()
+    record = {'channels': list(channels), 'stats': reduceBlock(data), 'time': t, 'start': start, 'end': end, 'duration': end - start}
+    if calibration is not None:
+        # Mean flow of each channel, from every raw sample of the gas on it: with a
+        # curved calibration the flow of the mean voltage is not the mean flow
+        record['flow'] = np.full(len(data), np.nan)
+        if data.size > 0:
+            for idx, gas in enumerate(gases):
+                record['flow'][idx] = np.mean(calibration.convert(gas, data[idx]))
+    if raw:
+        record['raw'] = data
+    return record
+
+
+def openRGA(settings):
+
+    par = settings['devices']['rga']
+    driver = par.get('driver', 'srs')
+    if driver == 'srs':
+        from srsinst.rga import RGA100 as srs_rga
+        return srs_rga('serial', 'COM'+str(settings['srs']['rga100']['com']), 28800)
+    if driver == 'simulated':
+        return SimulatedRGA(**par.get('simulated', {}))
+    if driver == 'broker':
+        from tools.broker import BrokerRGA
+        return BrokerRGA(**settings['broker'])
+    raise ValueError('Unknown RGA driver: '+str(driver))
+
+
+def switchOnRGA(rga):
+
+    rga.ionizer.set_parameters(70, 12, 90)
+    rga.filament.turn_on()
+    rga.cem.turn_on()
+
+
+def switchOffRGA(rga):
+
+    rga.cem.turn_off()
+    rga.filament.turn_off()
+    rga.ionizer.set_parameters(0, 0, 0)
+
+
+def scanMasses(rga, masses, batch=True):
+
+    # Returns the partial pressures (Torr) and the scan timing: its wall time, its start
+    # and end on the monotonic clock, the start and end of each mass and its duration
+    t = time.time()
+    start = clock()
+    timed = hasattr(rga.scan, 'get_timed_scan')
+    if timed:
+        # Drivers reading the scans of another process take every mass from one of its scans, with its times
+        intensity, times = rga.scan.get_timed_scan(*masses)
+        t, start = times['time'], times['start']
+        Pi_values = np.array(rga.scan.get_partial_pressure_corrected_spectrum(intensity), dtype=float)
+        starts, ends = np.full(len(masses), start), np.full(len(masses), times['end'])
+    elif batch:
+        # One multiple-mass scan for all masses and one correction call for the whole vector
+        intensity = rga.scan.get_multiple_mass_scan(*masses)
+        end = clock()
+        Pi_values = np.array(rga.scan.get_partial_pressure_corrected_spectrum(intensity), dtype=float)
+        # The scan does not report when it measured each mass, so every mass gets the start and end of the scan
+        starts, ends = np.full(len(masses), start), np.full(len(masses), end)
+    else:
+        Pi_values = list()
+        starts, ends = np.empty(len(masses)), np.empty(len(masses))
+        for idx, mass in enumerate(masses):
+            starts[idx] = clock()
+            intensity = rga.scan.get_multiple_mass_scan(mass)
+            ends[idx] = clock()
+            intensity_in_torr = rga.scan.get_partial_pressure_corrected_spectrum(intensity)
+            intensity_in_torr = np.array(intensity_in_torr)
+            Pi_values.append(intensity_in_torr[0])
+        Pi_values = np.array(Pi_values, dtype=float)
+    elapsed = (ends[-1] if timed else clock()) - start
+    return Pi_values, {'wall': t, 'start': start, 'end': ends[-1], 'starts': starts, 'ends': ends, 'time': elapsed, 'per_mass': elapsed / len(masses)}
+
+
+def readCycle(fm, rga, channels, masses, batch=True, executor=None, raw=False, calibration=None, gases=None):
+    """One flowmeter read and one RGA scan of `masses`, returns (fmData, Pi_values, scan).
+
+    With an executor the two devices are read at the same time, so a cycle takes
+    about as long as the slower device instead of the sum of both. Without an RGA
+    (rga is None) or masses the partial pressures are zeros and scan is None.
+    fmData holds the raw block under 'raw' only when raw is set, and the mean
+    flow of each channel under 'flow' when a calibration and the gases are given.
+    """
+
+    start = clock()
+    scanning = (rga is not None) and (len(masses) > 0)
+    if executor is not None:
+        fmFuture = executor.submit(readFlowmeters, fm, list(channels), raw, calibration, gases)
+        if scanning:
+            Pi_values, scan = executor.submit(scanMasses, rga, masses, batch).result()
+        fmData = fmFuture.result()
+    else:
+        fmData = readFlowmeters(fm, list(channels), raw, calibration, gases)
+        if scanning:
+            Pi_values, scan = scanMasses(rga, masses, batch)
+    if not scanning:
+        Pi_values = np.zeros((len(masses)))
+        scan = None
+    else:
+        scan['cycle'] = clock() - start
+    return fmData, Pi_values, scan
+
+
+class DaqFlowmeter:
+    """Reads the flowmeter voltages from an NI DAQ with nidaqmx.
+
+    All requested channels are added to one task with a hardware sample clock,
+    so a read samples every channel at the same instants and costs about the
+    same whatever the number of channels.
+    """
+
+    def __init__(self, device='Dev1', rate=10000, samples=1000, min_val=0.0, max_val=5.0):
+
+        import nidaqmx
+        self.nidaqmx = nidaqmx
+        self.device = device
+        self.rate = float(rate)
+        self.samples = int(samples)
+        self.min_val = float(min_val)
+        self.max_val = float(max_val)
+        self.task = None
+        self.channels = None
+
+    def open(self, channels):
+
+        self.close()
+        self.task = self.nidaqmx.Task()
+        for channel in channels:
+            self.task.ai_channels.add_ai_voltage_chan(self.device+'/'+channel, min_val=self.min_val, max_val=self.max_val)
+        self.task.timing.cfg_samp_clk_timing(self.rate, samps_per_chan=self.samples)
+        self.channels = list(channels)
+
+    def getChannels(self, channels):
+
+        # The task is only rebuilt when the channel list changes
+        if channels != self.channels:
+            self.open(channels)
+        data = self.task.read(number_of_samples_per_channel=self.samples)
+        return np.array(data, ndmin=2)
+
+    def getData(self, channel="ai0"):
+
+        return self.getChannels([channel])[0]
+
+    def close(self):
+
+        if self.task is not None:
+            self.task.close()
+            self.task = None
+            self.channels = None
+
+
+class SimulatedFlowmeter:
+    """Stands in for matheson_fm.fm(), returns a block of noisy voltages per read."""
+
+    def __init__(self, latency=0.05, samples=1000, noise=0.01, period=60.0, seed=None):
+
+        self.latency = float(latency)
+        self.samples = int(samples)
+        self.noise = float(noise)
+        self.period = float(period)
+        self.rng = np.random.default_rng(seed)
+        self.t0 = time.monotonic()
+
+    def level(self, channel):
+
+        # Each channel gets its own slow oscillation around a different offset
+        idx = int(''.join(c for c in channel if c.isdigit()) or 0)
+        t = time.monotonic() - self.t0
+        return 1.0 + 0.5 * idx + 0.25 * np.sin(2 * np.pi * t / self.period + idx)
+
+    def getData(self, channel="ai0"):
+
+        time.sleep(self.latency)
+        return self.level(channel) + self.noise * self.rng.standard_normal(self.samples)
+
+    def getChannels(self, channels):
+
+        # One simultaneous read costs a single latency whatever the channel count
+        time.sleep(self.latency)
+        levels = np.array([self.level(channel) for channel in channels])
+        return levels[:, np.newaxis] + self.noise * self.rng.standard_normal((len(channels), self.samples))
+
+
+class SimulatedRGA:
+    """Stands in for srsinst.rga.RGA100 with the same scan, ionizer, filament and cem calls.
+
+    Every command costs latency seconds, the serial round trip at 28800 baud, and
+    every mass measured adds mass_scan_time seconds of detector time.
+    """
+
+    def __init__(self, latency=0.02, mass_scan_time=0.1, point_time=0.005, noise=0.05, sensitivity=1e-13, seed=None):
+
+        self.latency = float(latency)
+        self.mass_scan_time = float(mass_scan_time)
+        self.point_time = float(point_time)
+        self.noise = float(noise)
+        self.sensitivity = float(sensitivity)
+        self.rng = np.random.default_rng(seed)
+        self.t0 = time.monotonic()
+        self.scan = SimulatedScan(self)
+        self.ionizer = SimulatedIonizer(self)
+        self.filament = SimulatedSwitch(self)
+        self.cem = SimulatedCEM(self)
+
+    def command(self, masses=0, points=0):
+
+        time.sleep(self.latency + masses * self.mass_scan_time + points * self.point_time)
+
+    def pressure(self, masses):
+
+        # Background partial pressures that fall off with mass, plus a slow drift
+        masses = np.asarray(masses, dtype=float)
+        t = time.monotonic() - self.t0
+        base = 1e-8 / (1.0 + masses) * (1.0 + 0.2 * np.sin(2 * np.pi * t / 120.0 + masses))
+        return base * (1.0 + self.noise * self.rng.standard_normal(masses.shape))
+
+    def spectrum(self, mass):
+
+        # Gaussian peaks at the usual residual gas masses on a small background
+        peaks = np.array([2, 14, 16, 17, 18, 28, 32, 40, 44], dtype=float)
+        heights = self.pressure(peaks)
+        mass = np.asarray(mass, dtype=float)
+        shape = np.exp(-0.5 * ((mass[:, np.newaxis] - peaks[np.newaxis, :]) / 0.25) ** 2)
+        background = 1e-12 * (1.0 + self.noise * self.rng.standard_normal(mass.shape))
+        return shape @ heights + background
+
+    def disconnect(self):
+
+        self.command()
+
+
+class SimulatedScan:
+
+    def __init__(self, rga):
+
+        self.rga = rga
+        self.initial_mass = 1
+        self.final_mass = 65
+        self.scan_speed = 3
+        self.resolution = 10
+
+    def set_parameters(self, initial_mass, final_mass, scan_speed, resolution):
+
+        self.rga.command()
+        self.initial_mass = int(initial_mass)
+        self.final_mass = int(final_mass)
+        self.scan_speed = int(scan_speed)
+        self.resolution = int(resolution)
+
+    def get_mass_axis(self, for_analog_scan=True):
+
+        if for_analog_scan:
+            points = (self.final_mass - self.initial_mass) * self.resolution + 1
+            return np.linspace(self.initial_mass, self.final_mass, points)
+        return np.arange(self.initial_mass, self.final_mass + 1, dtype=float)
+
+    def get_analog_scan(self):
+
+        mass = self.get_mass_axis(True)
+        self.rga.command(points=len(mass))
+        return np.round(self.rga.spectrum(mass) / self.rga.sensitivity)
+
+    def get_histogram_scan(self):
+
+        mass = self.get_mass_axis(False)
+        self.rga.command(points=len(mass) * self.resolution)
+        return np.round(self.rga.spectrum(mass) / self.rga.sensitivity)
+
+    def get_multiple_mass_scan(self, *masses):
+
+        self.rga.command(len(masses))
+        # Ion currents in units of 0.1 fA, as returned by the RGA100
+        return np.round(self.rga.pressure(masses) / self.rga.sensitivity)
+
+    def get_partial_pressure_corrected_spectrum(self, spectrum):
+
+        return np.asarray(spectrum, dtype=float) * self.rga.sensitivity
+
+
+class SimulatedIonizer:
+
+    def __init__(self, rga):
+
+        self.rga = rga
+        self.emission_current = 0.0
+
+    def set_parameters(self, electron_energy, ion_energy, focus_voltage):
+
+        self.rga.command()
+        self.emission_current = 1e-3 if electron_energy > 0 else 0.0
+
+
+class SimulatedSwitch:
+
+    def __init__(self, rga):
+
+        self.rga = rga
+        self.on = False
+
+    def turn_on(self):
+
+        self.rga.command()
+        self.on = True
+
+    def turn_off(self):
+
+        self.rga.command()
+        self.on = False
+
+
+class SimulatedCEM(SimulatedSwitch):
+
+    def __init__(self, rga, voltage=1400):
+
+        super().__init__(rga)
+        self.set_voltage = voltage
+        self.voltage = 0
+
+    def turn_on(self):
+
+        super().turn_on()
+        self.voltage = self.set_voltage
+
+    def turn_off(self):
+
+        super().turn_off()
+        self.voltage = 0
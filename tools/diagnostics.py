@@ -0,0 +1,82 @@
+import numpy as np
+from PyQt5 import QtWidgets, QtCore
+import pyqtgraph as pg
+from tools.metrics import BUCKETS
+
+
+class DiagnosticsPanel(QtWidgets.QWidget):
+    """Window with the live stage latencies of a Metrics object: a table of
+    percentiles and the rolling histogram of the stage selected in the table."""
+
+    COLUMNS = ['Stage', 'Count', 'Last (ms)', 'Mean (ms)', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'Max (ms)']
+    KEYS = ['count', 'last', 'mean', 'p50', 'p95', 'p99', 'max']
+
+    def __init__(self, metrics, title='Diagnostics', refresh=1000):
+
+        super().__init__()
+        self.metrics = metrics
+        self.setWindowTitle(title)
+        self.resize(700, 500)
+
+        self.table = QtWidgets.QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.table.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(QtWidgets.QAbstractItemView.SingleSelection)
+        self.table.horizontalHeader().setSectionResizeMode(QtWidgets.QHeaderView.Stretch)
+
+        # Histogram bars are drawn at the bucket index, labelled with the bucket bound
+        self.plot = pg.PlotWidget()
+        self.plot.setBackground("w")
+        self.plot.setLabel('left', text='Count', color="k")
+        self.plot.setLabel('bottom', text='Duration up to', color="k")
+        labels = [f'{bound * 1e3:g} ms' for bound in BUCKETS] + ['more']
+        self.plot.getAxis('bottom').setTicks([list(enumerate(labels))[::2]])
+        self.bars = pg.BarGraphItem(x=np.arange(len(labels)), height=np.zeros(len(labels)), width=0.8, brush='b')
+        self.plot.addItem(self.bars)
+
+        layout = QtWidgets.QVBoxLayout()
+        layout.addWidget(self.table)
+        layout.addWidget(self.plot)
+        self.setLayout(layout)
+
+        self.timer = QtCore.QTimer()
+        self.timer.setInterval(refresh)
+        self.timer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+
+        self.refresh()
+        self.timer.start()
+        super().showEvent(event)
+
+    def hideEvent(self, event):
+
+        self.timer.stop()
+        super().hideEvent(event)
+
+    def refresh(self):
+
+        snapshot = self.metrics.snapshot()
+        stages = snapshot['stages']
+        selected = self.table.currentRow()
+        selected = self.table.item(selected, 0).text() if selected >= 0 and self.table.item(selected, 0) else None
+
+        self.table.setRowCount(len(stages))
+        for row, (stage, summary) in enumerate(stages.items()):
+            values = [stage] + [str(summary['count'])] + [f"{summary[key] * 1e3:.2f}" if key in summary else '' for key in self.KEYS[1:]]
+            for col, value in enumerate(values):
+                item = self.table.item(row, col)
+                if item is None:
+                    item = QtWidgets.QTableWidgetItem()
+                    self.table.setItem(row, col, item)
+                item.setText(value)
+            if stage == selected:
+                self.table.selectRow(row)
+
+        if selected in stages:
+            self.bars.setOpts(height=stages[selected]['histogram'])
+            self.plot.setTitle(selected, color="k")
+        elif len(stages) > 0:
+            self.table.selectRow(0)
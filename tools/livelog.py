@@ -0,0 +1,115 @@
+import sys
+import json
+import math
+import time
+import queue
+import threading
+
+
+class LiveLog:
+    """Per-tick log records, formatted and written in a thread of their own.
+
+    log() only puts the record on a queue, so the GUI thread never waits for the
+    console or the disk. While a file is open every record is written to it as
+    a JSON line with the values at full precision, NaN and infinities as null
+    since JSON has no form for them. At most one summary line per `interval`
+    seconds goes to the console (none if interval is 0). When the queue is full
+    new records are dropped and counted in `dropped`.
+    """
+
+    def __init__(self, interval=5.0, size=10000, stream=None, **kwargs):
+
+        self.interval = float(interval)
+        self.stream = stream if stream is not None else sys.stdout
+        self.queue = queue.Queue(maxsize=int(size))
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name='livelog', daemon=True)
+        self.thread.start()
+
+    def log(self, record):
+
+        try:
+            self.queue.put_nowait(('record', record))
+        except queue.Full:
+            self.dropped += 1
+
+    def open(self, path):
+
+        self.queue.put(('open', path))
+
+    def close(self):
+
+        self.queue.put(('close', None))
+
+    def stop(self):
+
+        self.queue.put(('stop', None))
+        self.thread.join()
+
+    def run(self):
+
+        file = None
+        count = 0
+        last = None
+        period = self.interval if self.interval > 0 else 1.0
+        lastSummary = time.monotonic()
+        while True:
+            try:
+                kind, item = self.queue.get(timeout=period)
+            except queue.Empty:
+                kind, item = None, None
+            if kind == 'record':
+                if file is not None:
+                    file.write(json.dumps(self.encode(item), default=float, allow_nan=False)+'\n')
+                count += 1
+                last = item
+            elif kind == 'open':
+                if file is not None:
+                    file.close()
+                file = open(item, 'a')
+            elif kind in ('close', 'stop'):
+                if file is not None:
+                    file.close()
+                    file = None
+                if kind == 'stop':
+                    return
+
+            now = time.monotonic()
+            if now - lastSummary >= period:
+                if file is not None:
+                    file.flush()
+                if (self.interval > 0) and (last is not None):
+                    self.stream.write(self.summary(last, count, now - lastSummary)+'\n')
+                    self.stream.flush()
+                count = 0
+                last = None
+                lastSummary = now
+
+    def encode(self, record):
+
+        # Values that are not finite numbers are written as null
+        return {key: None if self.nonFinite(value) else value for key, value in record.items()}
+
+    def nonFinite(self, value):
+
+        try:
+            return not math.isfinite(value)
+        except TypeError:
+            return False
+
+    def summary(self, record, count, elapsed):
+
+        values = ', '.join(f'{key}: {self.format(value)}' for key, value in record.items())
+        line = f'{count} records in {elapsed:.1f} s, last: {values}'
+        if self.dropped > 0:
+            line += f' ({self.dropped} dropped)'
+        return line
+
+    def format(self, value):
+
+        # Short form for the console only, the file keeps every digit
+        if not isinstance(value, float):
+            return str(value)
+        if abs(value) >= 1e6:
+            return f'{value:.3f}'
+        return f'{value:.6g}'
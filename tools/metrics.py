@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import threading
+import contextlib
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Upper bounds (s) of the latency histogram buckets, durations above the last
+# bound go into an extra overflow bucket
+BUCKETS = np.array([1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0])
+
+
+class StageStats:
+    """Durations of one stage: the last `samples` values for the rolling
+    histogram and percentiles, and running totals since the start."""
+
+    def __init__(self, samples=1000):
+
+        self.values = np.full(int(samples), np.nan)
+        self.index = 0
+        self.sum = 0.0
+        self.buckets = np.zeros(len(BUCKETS) + 1, dtype=np.int64)
+
+    def add(self, value):
+
+        self.values[self.index % len(self.values)] = value
+        self.index += 1
+        self.sum += value
+        self.buckets[np.searchsorted(BUCKETS, value)] += 1
+
+    def recent(self):
+
+        return self.values[:min(self.index, len(self.values))]
+
+    def histogram(self):
+
+        # Counts of the recent durations per bucket
+        return np.bincount(np.searchsorted(BUCKETS, self.recent()), minlength=len(BUCKETS) + 1)
+
+    def summary(self):
+
+        recent = self.recent()
+        if len(recent) == 0:
+            return {'count': 0}
+        p50, p95, p99 = np.percentile(recent, [50, 95, 99])
+        return {
+            'count': self.index,
+            'last': float(self.values[(self.index - 1) % len(self.values)]),
+            'mean': float(np.mean(recent)),
+            'p50': float(p50),
+            'p95': float(p95),
+            'p99': float(p99),
+            'max': float(np.max(recent)),
+        }
+
+
+class Metrics:
+    """Thread-safe record of stage durations, shared by the worker and the GUI.
+
+        with metrics.timed('save'):
+            self.save()
+        metrics.record('delivery', seconds)
+    """
+
+    def __init__(self, enabled=True, samples=1000, **kwargs):
+
+        self.enabled = bool(enabled)
+        self.samples = int(samples)
+        self.stages = dict()
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def record(self, stage, seconds):
+
+        if not self.enabled:
+            return
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = StageStats(self.samples)
+            self.stages[stage].add(seconds)
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def snapshot(self):
+
+        # Summary and rolling histogram of every stage, in seconds
+        with self.lock:
+            stages = {stage: dict(stats.summary(), histogram=stats.histogram().tolist()) for stage, stats in self.stages.items()}
+        return {'time': time.time(), 'uptime': time.time() - self.started, 'buckets': BUCKETS.tolist(), 'stages': stages}
+
+    def prometheus(self, prefix='photochemistry'):
+
+        # Prometheus text exposition format: a cumulative histogram per stage
+        # since the start, and the recent percentiles as gauges
+        lines = [f'# HELP {prefix}_stage_seconds Duration of each acquisition stage.',
+                 f'# TYPE {prefix}_stage_seconds histogram']
+        recent = list()
+        with self.lock:
+            for stage, stats in self.stages.items():
+                label = f'stage="{stage}"'
+                counts = np.cumsum(stats.buckets)
+                for bound, count in zip(BUCKETS, counts):
+                    lines.append(f'{prefix}_stage_seconds_bucket{{{label},le="{bound:g}"}} {count}')
+                lines.append(f'{prefix}_stage_seconds_bucket{{{label},le="+Inf"}} {counts[-1]}')
+                lines.append(f'{prefix}_stage_seconds_sum{{{label}}} {stats.sum:.9g}')
+                lines.append(f'{prefix}_stage_seconds_count{{{label}}} {stats.index}')
+                summary = stats.summary()
+                for key in ('p50', 'p95', 'p99', 'max'):
+                    if key in summary:
+                        recent.append(f'{prefix}_stage_recent_seconds{{{label},stat="{key}"}} {summary[key]:.9g}')
+        lines += [f'# HELP {prefix}_stage_recent_seconds Percentiles of the last durations of each stage.',
+                  f'# TYPE {prefix}_stage_recent_seconds gauge'] + recent
+        return '\n'.join(lines) + '\n'
+
+    def writeFile(self, path):
+
+        # .json files get the snapshot, anything else the Prometheus text. The
+        # file is replaced atomically so readers never see half a file
+        if path.endswith('.json'):
+            text = json.dumps(self.snapshot(), indent=1)
+        else:
+            text = self.prometheus()
+        with open(path+'.tmp', 'w') as stream:
+            stream.write(text)
+        os.replace(path+'.tmp', path)
+
+
+class MetricsExporter:
+    """Exports a Metrics object in the background: rewrites `file` every
+    `interval` seconds and serves http://127.0.0.1:port/metrics when port is set."""
+
+    def __init__(self, metrics, file=None, interval=10.0, port=0, **kwargs):
+
+        self.metrics = metrics
+        self.file = file or None
+        self.interval = float(interval)
+        self.port = int(port or 0)
+        self.stopped = threading.Event()
+        self.thread = None
+        self.server = None
+
+    def start(self):
+
+        if self.file is not None:
+            self.thread = threading.Thread(target=self.run, name='metrics', daemon=True)
+            self.thread.start()
+        if self.port > 0:
+            metrics = self.metrics
+
+            class Handler(BaseHTTPRequestHandler):
+
+                def do_GET(self):
+
+                    if self.path.split('?')[0] not in ('/', '/metrics'):
+                        self.send_error(404)
+                        return
+                    body = metrics.prometheus().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+
+                    pass
+
+            # Only bound to localhost, the endpoint is for a local scraper or browser. The port
+            # is in the settings both apps and the daemon share, so only the first one started gets it
+            try:
+                self.server = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+            except OSError as error:
+                print('Could not serve metrics on port '+str(self.port)+': '+str(error))
+                return self
+            threading.Thread(target=self.server.serve_forever, name='metrics-http', daemon=True).start()
+        return self
+
+    def run(self):
+
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+
+        try:
+            self.metrics.writeFile(self.file)
+        except OSError as error:
+            print('Could not write metrics file '+str(self.file)+': '+str(error))
+
+    def stop(self):
+
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+            self.write()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,238 @@
+import os
+import csv
+import sys
+import gzip
+import time
+import struct
+import yaml
+import numpy as np
+
+# Every column file starts with a fixed size .npy header so it can be rewritten
+# in place as rows are appended, the files stay loadable with np.load at any time
+HEADER_SIZE = 128
+
+
+def npyHeader(dtype, length):
+
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (np.dtype(dtype).str, length)
+    header = header.ljust(HEADER_SIZE - 11) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+def readMetadata(path):
+
+    if os.path.exists(path+'.yml'):
+        with open(path+'.yml', 'r') as stream:
+            par = yaml.safe_load(stream)
+        if par is not None:
+            return par
+    return {}
+
+
+def writeMetadata(path, par):
+
+    with open(path+'.yml', "w") as outfile:
+        yaml.dump(par, outfile, default_flow_style=False)
+
+
+class BinaryWriter:
+    """Appends rows to one .npy file per column in the folder path+'_npy'.
+
+    Has the same interface as CsvWriter. The column names and file names are
+    stored under 'binary' in the run's .yml file, next to the other metadata.
+    """
+
+    def __init__(self, path, header, flush_rows=50, flush_interval=5.0, dtype=np.float64):
+
+        self.path = path
+        self.columns = list(header)
+        self.dtype = np.dtype(dtype)
+        self.flush_rows = int(flush_rows)
+        self.flush_interval = float(flush_interval)
+        self.rows = list()
+        self.written = 0
+
+        folder = path+'_npy'
+        os.makedirs(folder, exist_ok=True)
+        self.names = [f'col{idx:02d}.npy' for idx in range(len(self.columns))]
+        self.files = list()
+        for name in self.names:
+            file = open(os.path.join(folder, name), "wb")
+            file.write(npyHeader(self.dtype, 0))
+            self.files.append(file)
+
+        par = readMetadata(path)
+        par['binary'] = {'folder': os.path.basename(folder), 'columns': self.columns, 'files': self.names, 'dtype': self.dtype.str}
+        writeMetadata(path, par)
+        self.last_flush = time.monotonic()
+
+    @property
+    def pending(self):
+
+        return len(self.rows)
+
+    @property
+    def closed(self):
+
+        return self.files is None
+
+    def writerow(self, row):
+
+        self.rows.append(row)
+        if (len(self.rows) >= self.flush_rows) or (time.monotonic() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+
+        if self.files is None:
+            return
+        if len(self.rows) > 0:
+            # Rows shorter than the header are padded with NaN
+            block = np.full((len(self.rows), len(self.columns)), np.nan, dtype=self.dtype)
+            for idx, row in enumerate(self.rows):
+                block[idx, :len(row)] = row
+            self.rows = list()
+            self.append(block)
+        for file in self.files:
+            file.flush()
+        self.last_flush = time.monotonic()
+
+    def writeblock(self, block):
+
+        # Appends a (rows, columns) array directly, after any pending rows
+        self.flush()
+        self.append(np.asarray(block, dtype=self.dtype))
+        for file in self.files:
+            file.flush()
+
+    def append(self, block):
+
+        self.written += len(block)
+        # Write the data first and the header last, so a crash never leaves a header pointing past the data
+        for idx, file in enumerate(self.files):
+            file.write(np.ascontiguousarray(block[:, idx]).tobytes())
+            file.seek(0)
+            file.write(npyHeader(self.dtype, self.written))
+            file.seek(0, os.SEEK_END)
+
+    def close(self):
+
+        if self.files is None:
+            return
+        self.flush()
+        for file in self.files:
+            file.close()
+        self.files = None
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.close()
+
+
+class RawRecorder:
+    """Saves every raw flowmeter sample of a run in path+'_raw', in the BinaryWriter layout.
+
+    Each sample is a row: its time, spread evenly over the read it came from, then
+    one column per channel in `channels` (NaN when the channel was not read). The
+    times are seconds since t0 on the device clock, like the run's time column.
+    Used from the thread doing the reads, so the raw blocks never go through the
+    GUI thread.
+    """
+
+    def __init__(self, path, channels, names=None, t0=0.0):
+
+        self.path = path
+        self.channels = list(channels)
+        self.t0 = t0
+        self.writer = BinaryWriter(path+'_raw', ['Time (s)'] + list(names or channels), flush_rows=1, flush_interval=0.0)
+
+    def write(self, record, data):
+
+        block = np.full((data.shape[1], len(self.channels) + 1), np.nan)
+        block[:, 0] = record['start'] - self.t0 + (record['end'] - record['start']) * np.arange(data.shape[1]) / max(data.shape[1], 1)
+        for idx, channel in enumerate(record['channels']):
+            if channel in self.channels:
+                block[:, self.channels.index(channel) + 1] = data[idx]
+        self.writer.writeblock(block)
+
+    def close(self):
+
+        self.writer.close()
+
+
+def loadRun(path, columns=None, mmap=True):
+    """Returns a dict of column name -> array for a run saved by BinaryWriter.
+
+    path is the run path without extension, as used for the .csv and .yml files.
+    With mmap=True the arrays are read-only memory maps and nothing is copied.
+    """
+
+    if path.endswith('.yml') or path.endswith('.csv'):
+        path = path[:-4]
+    par = readMetadata(path)
+    if 'binary' not in par:
+        raise FileNotFoundError('No binary recording listed in '+path+'.yml')
+    binary = par['binary']
+    folder = os.path.join(os.path.dirname(path), binary['folder'])
+    if columns is None:
+        columns = binary['columns']
+    data = dict()
+    for column in columns:
+        file = binary['files'][binary['columns'].index(column)]
+        data[column] = np.load(os.path.join(folder, file), mmap_mode='r' if mmap else None)
+    return data
+
+
+def csvSegments(path):
+    """Returns the CSV files of a run in order: the segments listed in its .yml
+    (as .csv.gz once compressed), or path.csv for a run written in one file."""
+
+    par = readMetadata(path)
+    names = [segment['file'] for segment in par.get('segments', [])] or [os.path.basename(path)+'.csv']
+    files = list()
+    for name in names:
+        file = os.path.join(os.path.dirname(path), name)
+        files.append(file if os.path.exists(file) else file+'.gz')
+    return files
+
+
+def readCsv(path):
+    """Returns (header, rows) of a run's CSV data, with the rows of all its segments."""
+
+    if path.endswith('.csv'):
+        path = path[:-4]
+    header = None
+    blocks = list()
+    for file in csvSegments(path):
+        with (gzip.open if file.endswith('.gz') else open)(file, 'rt', newline='') as TFile:
+            header = next(csv.reader(TFile, delimiter=','))
+            data = np.loadtxt(TFile, delimiter=',', ndmin=2)
+        if data.size > 0:
+            blocks.append(data)
+    if len(blocks) == 0:
+        return header, np.empty((0, len(header)))
+    return header, np.concatenate(blocks)
+
+
+def convertCsv(path, flush_rows=100000):
+    """Converts an existing prc*.csv run into the binary format, returns the row count."""
+
+    if path.endswith('.csv'):
+        path = path[:-4]
+    header, data = readCsv(path)
+    with BinaryWriter(path, header, flush_rows=flush_rows, flush_interval=np.inf) as writer:
+        # In blocks of flush_rows rows, each written straight from the array
+        for first in range(0, len(data), flush_rows):
+            writer.writeblock(data[first:first + flush_rows])
+    return len(data)
+
+
+if __name__ == "__main__":
+    # python -m tools.recording run1.csv run2.csv ...
+    for file in sys.argv[1:]:
+        rows = convertCsv(file)
+        print('Converted '+file+' ('+str(rows)+' rows)')
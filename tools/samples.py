@@ -0,0 +1,523 @@
+import os
+import math
+import shutil
+import tempfile
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+class SampleStore:
+    """Array-backed store for acquired samples, one row per named column.
+
+    With capacity=None the buffers grow in chunks and keep the whole run.
+    With an integer capacity the store is a bounded ring that keeps the most
+    recent samples. Every sample is written twice in ring mode (at i and
+    i+capacity) so the valid window is always one contiguous slice, which
+    lets column() and view() return views instead of copies.
+
+    With lod set to {'base': ..., 'levels': ...} a MinMaxPyramid of the samples
+    is kept up to date for plotting, see envelope().
+    """
+
+    def __init__(self, columns, chunk=4096, capacity=None, dtype=np.float64, lod=None):
+
+        self.chunk = int(chunk)
+        self.capacity = None if capacity is None else int(capacity)
+        self.dtype = dtype
+        self.columns = list()
+        self.index = dict()
+        self.buffer = np.empty((0, 0), dtype=dtype)
+        self.pyramid = None
+        if lod:
+            self.pyramid = MinMaxPyramid(columns, base=lod['base'], levels=lod['levels'], capacity=self.capacity, chunk=self.chunk, dtype=dtype)
+        self.reset(columns)
+
+    def reset(self, columns=None):
+
+        # Reuse the existing buffers, only reallocate when the column count grows
+        if columns is not None:
+            self.columns = list(columns)
+            self.index = {name: idx for idx, name in enumerate(self.columns)}
+        if self.capacity is None:
+            size = max(self.buffer.shape[1], self.chunk)
+        else:
+            size = 2 * self.capacity
+        if (self.buffer.shape[0] < len(self.columns)) or (self.buffer.shape[1] < size):
+            self.buffer = np.empty((len(self.columns), size), dtype=self.dtype)
+        self.start = 0
+        self.length = 0
+        self.total = 0
+        if self.pyramid is not None:
+            self.pyramid.reset(columns)
+
+    def __len__(self):
+
+        return self.length
+
+    def __contains__(self, name):
+
+        return name in self.index
+
+    def __getitem__(self, name):
+
+        return self.column(name)
+
+    def append(self, values):
+
+        # values is a dict keyed by column name or a sequence in column order
+        row = np.full((len(self.columns), 1), np.nan, dtype=self.dtype)
+        if isinstance(values, dict):
+            for name, value in values.items():
+                row[self.index[name], 0] = value
+        else:
+            row[:len(values), 0] = values
+        self.extend(row)
+
+    def extend(self, block):
+
+        # block has shape (columns, samples)
+        block = np.asarray(block, dtype=self.dtype)
+        if block.ndim == 1:
+            block = block[:, np.newaxis]
+        n = block.shape[1]
+        if n == 0:
+            return
+        ncol = len(self.columns)
+        if self.pyramid is not None:
+            self.pyramid.extend(block)
+
+        if self.capacity is None:
+            needed = self.length + n
+            size = self.buffer.shape[1]
+            if needed > size:
+                size = max(2 * size, needed)
+                size = -(-size // self.chunk) * self.chunk
+                buffer = np.empty((self.buffer.shape[0], size), dtype=self.dtype)
+                buffer[:, :self.length] = self.buffer[:, :self.length]
+                self.buffer = buffer
+            self.buffer[:ncol, self.length:needed] = block
+            self.length = needed
+        else:
+            capacity = self.capacity
+            if n > capacity:
+                block = block[:, -capacity:]
+                self.total += n - capacity
+                n = capacity
+            pos = (self.total + np.arange(n)) % capacity
+            self.buffer[:ncol, pos] = block
+            self.buffer[:ncol, pos + capacity] = block
+            self.total += n
+            self.length = min(self.length + n, capacity)
+            self.start = (self.total - self.length) % capacity
+            return
+        self.total += n
+
+    def column(self, name):
+
+        return self.buffer[self.index[name], self.start:self.start + self.length]
+
+    def view(self):
+
+        return self.buffer[:len(self.columns), self.start:self.start + self.length]
+
+    def last(self, name):
+
+        if self.length == 0:
+            return np.nan
+        return self.buffer[self.index[name], self.start + self.length - 1]
+
+    def history(self, t0, t1):
+
+        # Samples with t0 <= time <= t1, time is in acquisition order
+        t = self.column('time')
+        return self.view()[:, np.searchsorted(t, t0):np.searchsorted(t, t1, side='right')]
+
+    def count(self, t0, t1):
+
+        # Number of samples with t0 <= time <= t1
+        t = self.column('time')
+        return np.searchsorted(t, t1, side='right') - np.searchsorted(t, t0)
+
+    def envelope(self, xrange, pixels):
+
+        # Min/max envelope of the samples in xrange (the whole run for None) to
+        # draw on `pixels` pixels, or None when the samples are few enough to draw
+        if self.pyramid is None:
+            return None
+        pixels = max(int(pixels), 1)
+        if xrange is None:
+            t0, t1 = -np.inf, np.inf
+        else:
+            # A view's width either side, so the next pans are already drawn
+            width = xrange[1] - xrange[0]
+            t0, t1 = xrange[0] - width, xrange[1] + width
+            pixels *= 3
+        if self.count(t0, t1) <= 2 * pixels:
+            return None
+        return self.pyramid.envelope(t0, t1, pixels)
+
+
+class MinMaxPyramid:
+    """Min/max decimation of every column of a SampleStore, for plotting long runs.
+
+    Level 1 holds the time, minimum and maximum of each block of `base`
+    samples, and each next level the same for `base` blocks of the level
+    below. The levels are updated as samples arrive, only the new samples and
+    a partial block per level are looked at. envelope() picks the finest level
+    with no more blocks in view than pixels and returns each block as two
+    points at its start time, the minimum then the maximum, so a single
+    sample spike is still drawn at any zoom. With the capacity of a ring store
+    every level but the last is a ring too, the last one covers the whole run.
+    """
+
+    def __init__(self, columns, base=8, levels=8, capacity=None, time='time', chunk=4096, dtype=np.float64):
+
+        self.base = int(base)
+        self.count = int(levels)
+        # Level 1 covers as many samples as the store keeps, each next level base times more
+        self.ring = None if capacity is None else max(int(capacity) // self.base, 1)
+        self.time = time
+        self.chunk = chunk
+        self.dtype = dtype
+        self.reset(columns)
+
+    def reset(self, columns=None):
+
+        if columns is not None:
+            self.columns = list(columns)
+            self.values = [idx for idx, name in enumerate(self.columns) if name != self.time]
+            names = [name for name in self.columns if name != self.time]
+            levelColumns = ['time'] + [name+' min' for name in names] + [name+' max' for name in names]
+            self.levels = [SampleStore(levelColumns, chunk=self.chunk, capacity=self.ring if level < self.count - 1 else None, dtype=self.dtype)
+                           for level in range(self.count)]
+        for level in self.levels:
+            level.reset()
+        # Inputs of each level that do not fill a block yet, as (time, minima, maxima)
+        rows = 1 + 2 * len(self.values)
+        self.pending = [np.empty((rows, 0), dtype=self.dtype) for level in self.levels]
+
+    def extend(self, block):
+
+        values = block[self.values]
+        data = np.concatenate((block[[self.columns.index(self.time)]], values, values))
+        m = len(self.values)
+        for level, store in enumerate(self.levels):
+            data = np.concatenate((self.pending[level], data), axis=1)
+            n = data.shape[1] // self.base * self.base
+            self.pending[level] = data[:, n:].copy()
+            if n == 0:
+                break
+            blocks = data[:, :n].reshape(data.shape[0], -1, self.base)
+            data = np.empty((data.shape[0], n // self.base), dtype=self.dtype)
+            data[0] = blocks[0, :, 0]
+            # fmin/fmax skip NaN, disabled channels stay NaN
+            data[1:1 + m] = np.fmin.reduce(blocks[1:1 + m], axis=2)
+            data[1 + m:] = np.fmax.reduce(blocks[1 + m:], axis=2)
+            store.extend(data)
+
+    def envelope(self, t0, t1, pixels):
+
+        # Ring levels that have dropped the start of the range are skipped, the last level always covers it
+        levels = [level for level, store in enumerate(self.levels) if (store.total == len(store)) or (store['time'][0] <= t0)]
+        chosen = levels[-1]
+        for level in levels:
+            first, last = self.blocks(self.levels[level], t0, t1)
+            if last - first <= pixels:
+                chosen = level
+                break
+        first, last = self.blocks(self.levels[chosen], t0, t1)
+
+        # The blocks of the level, then the newer inputs still waiting in the
+        # partial blocks of the levels below
+        data = np.concatenate([self.levels[chosen].view()[:, first:last]] + self.pending[chosen::-1], axis=1)
+        data = data[:, data[0] <= t1]
+        m = len(self.values)
+        out = np.empty((len(self.columns), data.shape[1], 2), dtype=self.dtype)
+        out[self.columns.index(self.time)] = data[0][:, np.newaxis]
+        for row, idx in enumerate(self.values):
+            out[idx, :, 0] = data[1 + row]
+            out[idx, :, 1] = data[1 + m + row]
+        return out.reshape(len(self.columns), -1)
+
+    def blocks(self, store, t0, t1):
+
+        # Index range of the blocks of a level that overlap t0..t1
+        t = store['time']
+        return max(np.searchsorted(t, t0, side='right') - 1, 0), np.searchsorted(t, t1, side='right')
+
+
+class HistoryStore(SampleStore):
+    """SampleStore that keeps the most recent `capacity` samples in memory and
+    everything else on disk, so memory stays flat however long the run.
+
+    Samples are also written in segments of `segment` samples, one .npy file of
+    shape (columns, samples) each, by a background thread. history() reads any
+    time range back from the segments for the part that has left memory. The
+    segments go in a new folder inside `folder` (the system temp folder by
+    default) which reset() and close() remove; after a crash it is left with
+    everything but the last partial segment.
+    """
+
+    def __init__(self, columns, capacity, segment=4096, folder=None, limit=200000, time='time', chunk=4096, dtype=np.float64, lod=None):
+
+        self.segment = int(segment)
+        self.root = folder or None
+        self.limit = int(limit) if limit else None
+        self.time = time
+        self.folder = None
+        self.segments = list()      # (first sample, first time, last time, path) of each segment
+        self.pending = dict()       # path: future of the segment writes not known to be finished
+        self.cache = None
+        self.spilled = 0
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='history')
+        # Room for a full segment waiting to be written on top of the samples being added
+        super().__init__(columns, chunk=chunk, capacity=max(int(capacity), 2 * self.segment), dtype=dtype, lod=lod)
+
+    def reset(self, columns=None):
+
+        self.clear()
+        super().reset(columns)
+
+    def clear(self):
+
+        wait(list(self.pending.values()))
+        self.pending = dict()
+        if self.folder is not None:
+            shutil.rmtree(self.folder, ignore_errors=True)
+            self.folder = None
+        self.segments = list()
+        self.cache = None
+        self.spilled = 0
+
+    def close(self):
+
+        self.clear()
+        self.executor.shutdown()
+
+    def extend(self, block):
+
+        block = np.asarray(block, dtype=self.dtype)
+        if block.ndim == 1:
+            block = block[:, np.newaxis]
+        # At most one segment at a time, so nothing leaves the ring before it is spilled
+        for first in range(0, block.shape[1], self.segment):
+            super().extend(block[:, first:first + self.segment])
+            while self.total - self.spilled >= self.segment:
+                self.spill()
+
+    def spill(self):
+
+        if self.folder is None:
+            if self.root is not None:
+                os.makedirs(self.root, exist_ok=True)
+            self.folder = tempfile.mkdtemp(prefix='prc_history_', dir=self.root)
+        # The ring is mirrored, so a segment is always one contiguous slice
+        pos = self.spilled % self.capacity
+        data = self.buffer[:len(self.columns), pos:pos + self.segment].copy()
+        t = data[self.index[self.time]]
+        path = os.path.join(self.folder, f'{self.spilled:012d}.npy')
+        self.segments.append((self.spilled, np.nanmin(t), np.nanmax(t), path))
+        self.pending = {name: future for name, future in self.pending.items() if not future.done()}
+        self.pending[path] = self.executor.submit(np.save, path, data)
+        self.spilled += self.segment
+
+    def load(self, path):
+
+        future = self.pending.pop(path, None)
+        try:
+            if future is not None:
+                future.result()
+            return np.load(path, mmap_mode='r')
+        except OSError as error:
+            print('Could not read history segment '+path+': '+str(error))
+            return None
+
+    def count(self, t0, t1):
+
+        # Samples in memory, plus those of the segments that have left memory,
+        # taken as evenly spread over each segment's time span
+        count = super().count(t0, t1)
+        first = self.total - self.length
+        for start, tmin, tmax, path in self.segments:
+            if start >= first:
+                break
+            if (tmax < t0) or (tmin > t1):
+                continue
+            n = min(self.segment, first - start)
+            if tmax > tmin:
+                n *= (min(t1, tmax) - max(t0, tmin)) / (tmax - tmin)
+            count += n
+        return count
+
+    def read(self, t0, t1):
+
+        # Samples of the segments with t0 <= time <= t1, every step-th one when
+        # there are more than `limit`
+        segments = [segment for segment in self.segments if (segment[2] >= t0) and (segment[1] <= t1)]
+        step = 1
+        if self.limit is not None:
+            step = max(1, math.ceil(len(segments) * self.segment / self.limit))
+        row = self.index[self.time]
+        blocks = [np.empty((len(self.columns), 0), dtype=self.dtype)]
+        for first, tmin, tmax, path in segments:
+            data = self.load(path)
+            if data is None:
+                continue
+            t = data[row]
+            blocks.append(np.asarray(data[:, (t >= t0) & (t <= t1)][:, ::step]))
+        return np.concatenate(blocks, axis=1)
+
+    def history(self, t0, t1):
+
+        # Samples with t0 <= time <= t1, those no longer in memory read back from
+        # the segments. The segment part is read for three times the range and
+        # kept, so panning and zooming nearby or new samples arriving do not
+        # read the disk again until memory has moved past the cached samples.
+        row = self.index[self.time]
+        first = self.total - self.length
+        if (self.cache is None) or (t0 < self.cache[0]) or (t1 > self.cache[1]) or (self.cache[2] < first):
+            width = t1 - t0
+            self.cache = (t0 - width, t1 + width, self.spilled, self.read(t0 - width, t1 + width))
+        older = self.cache[3]
+        recent = self.view()
+        if self.length > 0:
+            older = older[:, older[row] < recent[row, 0]]
+        older = older[:, (older[row] >= t0) & (older[row] <= t1)]
+        recent = recent[:, (recent[row] >= t0) & (recent[row] <= t1)]
+        return np.concatenate((older, recent), axis=1)
+
+
+def openSampleStore(columns, settings, rate):
+    """The sample store configured in settings.yaml, `rate` is the expected
+    number of samples per second, used to size a history window given in seconds."""
+
+    history = settings['history']
+    lod = settings['lod'] if settings['lod']['enabled'] else None
+    if history['spill']:
+        capacity = history['samples'] or int(history['window'] * rate)
+        return HistoryStore(columns, capacity, segment=history['segment'], folder=history['folder'], limit=history['limit'], chunk=settings['samples']['chunk'], lod=lod)
+    return SampleStore(columns, chunk=settings['samples']['chunk'], capacity=settings['samples']['capacity'], lod=lod)
+
+
+class SpectrumStore:
+    """Successive spectra stored as one (time, m/z) array.
+
+    Rows are added with start() when a new spectrum begins and filled in with
+    update() as partial spectra arrive, start() returns the row number of the
+    spectrum. With capacity=None the array grows in chunks of rows and keeps
+    every spectrum. With an integer capacity it is a ring of the most recent
+    `capacity` spectra: each spectrum pushed out is appended to a file in
+    `folder` (the system temp folder by default) and save() puts them back in
+    front of those in memory. reset() and close() remove the file.
+    """
+
+    def __init__(self, mass, chunk=64, capacity=None, folder=None, dtype=np.float64):
+
+        self.chunk = int(chunk)
+        self.capacity = None if capacity is None else max(int(capacity), 1)
+        self.root = folder or None
+        self.dtype = dtype
+        self.buffer = np.empty((0, 0), dtype=dtype)
+        self.time = np.empty(0)
+        self.file = None
+        self.path = None
+        self.spilled = 0
+        self.reset(mass)
+
+    def reset(self, mass=None):
+
+        self.clear()
+        if mass is not None:
+            self.mass = np.asarray(mass, dtype=float)
+        rows = max(self.buffer.shape[0], self.chunk) if self.capacity is None else self.capacity
+        if self.buffer.shape != (rows, len(self.mass)):
+            self.buffer = np.empty((rows, len(self.mass)), dtype=self.dtype)
+            self.time = np.empty(rows)
+        self.length = 0
+        self.total = 0
+
+    def clear(self):
+
+        if self.file is not None:
+            self.file.close()
+            os.remove(self.path)
+        self.file = None
+        self.path = None
+        self.spilled = 0
+
+    def close(self):
+
+        self.clear()
+
+    def __len__(self):
+
+        return self.length
+
+    def position(self, row):
+
+        return row if self.capacity is None else row % self.capacity
+
+    def start(self, t):
+
+        if self.capacity is None:
+            if self.length == self.buffer.shape[0]:
+                rows = self.buffer.shape[0] + max(self.buffer.shape[0], self.chunk)
+                buffer = np.empty((rows, len(self.mass)), dtype=self.dtype)
+                buffer[:self.length] = self.buffer[:self.length]
+                self.buffer = buffer
+                self.time = np.resize(self.time, rows)
+        elif self.length == self.capacity:
+            # The oldest spectrum makes room for the new one
+            self.spill(self.position(self.total))
+            self.length -= 1
+        pos = self.position(self.total)
+        self.buffer[pos] = np.nan
+        self.time[pos] = t
+        self.length += 1
+        self.total += 1
+        return self.total - 1
+
+    def spill(self, pos):
+
+        if self.file is None:
+            if self.root is not None:
+                os.makedirs(self.root, exist_ok=True)
+            handle, self.path = tempfile.mkstemp(prefix='prc_spectra_', suffix='.bin', dir=self.root)
+            self.file = os.fdopen(handle, 'wb')
+        # One row of time then spectrum per spectrum, read back by save()
+        np.concatenate(([self.time[pos]], self.buffer[pos])).astype(self.dtype).tofile(self.file)
+        self.spilled += 1
+
+    def update(self, row, index, values):
+
+        self.buffer[self.position(row), index] = values
+
+    def spectrum(self, row):
+
+        return self.buffer[self.position(row)]
+
+    def order(self):
+
+        # Buffer rows of the spectra in memory, oldest first
+        if self.capacity is None:
+            return slice(0, self.length)
+        return np.arange(self.total - self.length, self.total) % self.capacity
+
+    def spectra(self):
+
+        return self.buffer[self.order()]
+
+    def times(self):
+
+        return self.time[self.order()]
+
+    def save(self, path):
+
+        # Every spectrum since reset() in one .npz: those on disk, then those in memory
+        time, spectra = self.times(), self.spectra()
+        if self.file is not None:
+            self.file.flush()
+            spilled = np.fromfile(self.path, dtype=self.dtype).reshape(self.spilled, len(self.mass) + 1)
+            time = np.concatenate((spilled[:, 0], time))
+            spectra = np.concatenate((spilled[:, 1:], spectra))
+        np.savez(path, time=time, mass=self.mass, spectra=spectra)
@@ -0,0 +1,234 @@
+import time
+from collections import deque
+import numpy as np
+from PyQt5 import QtCore
+
+
+class AcquisitionScheduler(QtCore.QObject):
+    """Turns GUI timer ticks into acquisition requests with at most one in flight.
+
+    tick() is called from the timer and emits request() only when the previous
+    request has completed, ticks that arrive in the meantime are merged into
+    the running request instead of queueing up in the worker. completed() is
+    called when the data arrives. Everything runs on the GUI thread, so no
+    flag is shared with the worker.
+
+    Each cycle records its latency, whether it overran the interval, how many
+    ticks it merged, the jitter of its start against the timer and the drift
+    of the timer itself. warning() is emitted when most of the recent cycles
+    overran, and again with an empty message once the rate is met.
+
+    A request that outlives the interval is warned about once, and one still
+    in flight after `timeout` seconds is given up so that a hung read does not
+    stop the polling for good. failed() is called instead of completed() when
+    the worker could not read. request() carries the tick of the request, which
+    the worker sends back with its data, so that the answer of a request given
+    up is not taken for that of the next one: completed() and failed() ignore
+    any request but the one in flight.
+    """
+
+    request = QtCore.pyqtSignal(int)
+    warning = QtCore.pyqtSignal(str)
+
+    def __init__(self, interval, window=20, timeout=10.0, parent=None):
+
+        super().__init__(parent)
+        self.interval = interval / 1000.0  # ms, like QTimer
+        self.window = int(window)
+        self.timeout = float(timeout)
+        self.reset()
+
+    def reset(self):
+
+        self.t0 = None
+        self.ticks = 0
+        self.inFlight = False
+        self.pending = None
+        self.lastRequest = None
+        self.lastTick = 0
+        self.merged = 0
+        self.coalesced = 0
+        self.overruns = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.stale = 0
+        self.late = False
+        self.slow = False
+        self.cycles = deque(maxlen=1000)
+
+    def tick(self):
+
+        now = time.monotonic()
+        if self.t0 is None:
+            self.t0 = now
+        self.ticks += 1
+        if self.waiting():
+            self.merged += 1
+            self.coalesced += 1
+            return False
+
+        # Timing of this request against the ideal timer grid
+        expected = (self.ticks - self.lastTick) * self.interval
+        period = now - self.lastRequest if self.lastRequest is not None else expected
+        self.pending = {
+            'tick': self.ticks,
+            'start': now - self.t0,
+            'jitter': period - expected,
+            'drift': (now - self.t0) - (self.ticks - 1) * self.interval,
+        }
+        self.lastRequest = now
+        self.lastTick = self.ticks
+        self.merged = 0
+        self.inFlight = True
+        self.request.emit(self.ticks)
+        return True
+
+    def waiting(self):
+
+        # True while a request is in flight, a late one is warned about once and
+        # a hung one is given up after the timeout
+        if not self.inFlight:
+            return False
+        elapsed = time.monotonic() - self.lastRequest
+        if elapsed > self.timeout:
+            self.timeouts += 1
+            self.inFlight = False
+            self.late = True  # Cleared by the next completed cycle
+            self.warning.emit(f'No data {elapsed:.1f} s after the request, the read was given up')
+            return False
+        if (elapsed > self.interval) and not self.late:
+            self.late = True
+            self.warning.emit(f'Read still in flight after {elapsed * 1e3:.0f} ms, longer than the {self.interval * 1e3:.0f} ms interval')
+        return True
+
+    def current(self, request):
+
+        # True for the request in flight, answers of requests given up are counted and ignored
+        if self.inFlight and (request == self.pending['tick']):
+            return True
+        if request is not None:
+            self.stale += 1
+        return False
+
+    def completed(self, request):
+
+        if not self.current(request):
+            return
+        now = time.monotonic()
+        cycle = self.pending
+        cycle['latency'] = now - self.lastRequest
+        cycle['overrun'] = cycle['latency'] > self.interval
+        cycle['merged'] = self.merged
+        self.overruns += int(cycle['overrun'])
+        self.cycles.append(cycle)
+        self.inFlight = False
+        late = self.late
+        self.late = False
+
+        recent = list(self.cycles)[-self.window:]
+        slow = (len(recent) == self.window) and (sum(c['overrun'] for c in recent) > self.window / 2)
+        if late:
+            # The late read warning is replaced by the rate one below, or cleared
+            self.slow = not slow
+        if slow != self.slow:
+            self.slow = slow
+            if slow:
+                latency = np.mean([c['latency'] for c in recent])
+                self.warning.emit(f'Cannot keep up with {1 / self.interval:.1f} Hz: cycles take {latency * 1e3:.0f} ms, about {1 / latency:.1f} Hz is possible')
+            else:
+                self.warning.emit('')
+
+    def failed(self, request):
+
+        # The worker could not read, the next tick requests again
+        if self.current(request):
+            self.failures += 1
+            self.inFlight = False
+            self.late = False
+
+    def stats(self):
+
+        if len(self.cycles) == 0:
+            return None
+        latency = np.array([c['latency'] for c in self.cycles])
+        jitter = np.array([c['jitter'] for c in self.cycles])
+        return {
+            'cycles': len(self.cycles),
+            'overruns': self.overruns,
+            'coalesced': self.coalesced,
+            'timeouts': self.timeouts,
+            'failures': self.failures,
+            'stale': self.stale,
+            'latency_mean': float(np.mean(latency)),
+            'latency_max': float(np.max(latency)),
+            'jitter_rms': float(np.sqrt(np.mean(jitter ** 2))),
+            'drift': self.cycles[-1]['drift'],
+        }
+
+    def summary(self):
+
+        stats = self.stats()
+        if stats is None:
+            return 'No acquisition cycles'
+        return (f"{stats['cycles']} cycles, {stats['overruns']} overruns, {stats['coalesced']} ticks merged, "
+                f"{stats['timeouts']} timed out, {stats['failures']} failed, {stats['stale']} late answers ignored, "
+                f"latency {stats['latency_mean'] * 1e3:.0f} ms mean / {stats['latency_max'] * 1e3:.0f} ms max, "
+                f"jitter {stats['jitter_rms'] * 1e3:.1f} ms rms, drift {stats['drift'] * 1e3:.0f} ms")
+
+
+class MassScheduler:
+    """Chooses the masses measured in each RGA cycle.
+
+    Each mass has a target interval between its measurements (0 measures it
+    every cycle), from the 'schedule' section of srs.rga100 in settings.yaml.
+    A cycle only scans the masses that are due, so slow background masses stop
+    taking serial time from the fast ones and the scans get shorter. In adaptive
+    mode the interval of a mass shrinks with the rate its pressure changes at,
+    down to every cycle at `threshold` (relative change per second).
+    """
+
+    def __init__(self, masses, intervals=None, adaptive=False, threshold=0.5, smoothing=0.3, **kwargs):
+
+        self.masses = [float(mass) for mass in masses]
+        intervals = {float(mass): float(interval) for mass, interval in (intervals or {}).items()}
+        self.targets = np.array([intervals.get(mass, 0.0) for mass in self.masses])
+        self.adaptive = bool(adaptive)
+        self.threshold = float(threshold)
+        self.smoothing = float(smoothing)
+        self.index = {mass: idx for idx, mass in enumerate(self.masses)}
+        self.last = np.full(len(self.masses), -np.inf)  # start of the last measurement of each mass
+        self.values = np.full(len(self.masses), np.nan)
+        self.change = np.zeros(len(self.masses))  # running relative change per second of each mass
+        self.previous = None
+        self.cycle = 0.0
+
+    def intervals(self):
+
+        if not self.adaptive:
+            return self.targets
+        return self.targets * np.clip(1 - self.change / self.threshold, 0, 1)
+
+    def next(self, now):
+
+        # Masses due at `now`. A mass is taken half a cycle early rather than a
+        # whole cycle late when it falls due between two cycles
+        if self.previous is not None:
+            self.cycle = now - self.previous
+        self.previous = now
+        due = now - self.last + self.cycle / 2 >= self.intervals()
+        return [mass for mass, scan in zip(self.masses, due) if scan]
+
+    def update(self, masses, values, starts):
+
+        # Results of a scan, the start of each mass on the device clock
+        for mass, value, start in zip(masses, values, starts):
+            idx = self.index.get(float(mass))
+            if idx is None:
+                continue
+            previous = self.values[idx]
+            if self.adaptive and np.isfinite(previous) and np.isfinite(value) and (start > self.last[idx]):
+                scale = max(abs(value), abs(previous))
+                rate = abs(value - previous) / (scale * (start - self.last[idx])) if scale > 0 else 0.0
+                self.change[idx] += self.smoothing * (rate - self.change[idx])
+            self.values[idx] = value
+            self.last[idx] = start
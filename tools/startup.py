@@ -0,0 +1,45 @@
+import sys
+import time
+import importlib.util
+
+
+def lazyImport(name):
+    """Returns the module `name`, executed on first attribute access instead of now.
+
+    Used for the plotting stack, so the window can be shown before pyqtgraph loads.
+    """
+
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError('No module named '+repr(name), name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+class StartupTimer:
+    """Records the time taken by each startup step, mark() closes the current step."""
+
+    def __init__(self):
+
+        self.t0 = time.perf_counter()
+        self.last = self.t0
+        self.steps = list()
+
+    def mark(self, step):
+
+        now = time.perf_counter()
+        self.steps.append((step, now - self.last))
+        self.last = now
+
+    def report(self):
+
+        lines = [f'Startup took {self.last - self.t0:.2f} s:']
+        for step, seconds in self.steps:
+            lines.append(f'  {step:<30}{seconds:7.3f} s')
+        return '\n'.join(lines)
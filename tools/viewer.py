@@ -0,0 +1,184 @@
+"""Read-only view of the run tools.daemon is recording.
+
+The daemon publishes every row it saves in a shared ring (daemon.share in
+settings.yaml) and names it in daemon.yml in the data folder. Either app
+started with --attach opens this window instead of its own: it follows the
+run as it grows without opening any device, and picks up the next run when
+the daemon is restarted.
+
+    python "Photoreactor Chamber.py" --attach
+"""
+import os
+import time
+import yaml
+import numpy as np
+from PyQt5 import QtWidgets, QtCore
+import pyqtgraph as pg
+from tools.broker import SharedRing
+from tools.catalog import columnKind
+from tools.calibration import Calibration
+from tools.samples import HistoryStore, openSampleStore
+
+
+class RunFollower:
+    """Follows the rows of the daemon's current run through its shared ring.
+
+    poll() returns the rows published since the previous call as a (columns,
+    rows) array, or None while no run is being recorded. status is the
+    daemon.yml of the run followed, and changes when the daemon starts a new run.
+    """
+
+    def __init__(self, folder, timeout=10.0):
+
+        self.statusFile = os.path.join(folder, 'daemon.yml')
+        self.timeout = float(timeout)
+        self.ring = None
+        self.status = None
+        self.cursor = 0
+
+    def current(self):
+
+        # daemon.yml of the run being recorded, None when there is none to attach to
+        try:
+            with open(self.statusFile, 'r') as stream:
+                status = yaml.safe_load(stream)
+        except (OSError, yaml.YAMLError):
+            return None
+        return status if isinstance(status, dict) and status.get('ring') else None
+
+    def poll(self):
+
+        # A silent ring is only dropped once daemon.yml is gone or names another run
+        if (self.ring is not None) and (time.time() - float(self.ring.header['heartbeat']) > self.timeout):
+            status = self.current()
+            if (status is None) or (status['path'] != self.status['path']):
+                self.detach()
+        if self.ring is None:
+            status = self.current()
+            if status is None:
+                return None
+            try:
+                self.ring = SharedRing(status['ring'])
+            except FileNotFoundError:
+                return None
+            self.status = status
+            self.cursor = 0
+        block, self.cursor = self.ring.read(self.cursor)
+        return np.array(block)
+
+    def detach(self):
+
+        if self.ring is not None:
+            self.ring.close()
+        self.ring = None
+
+    def columns(self):
+
+        return self.ring.columns if self.ring is not None else []
+
+
+class ViewerWindow(QtWidgets.QMainWindow):
+    """Plots of the masses and flowmeters of the daemon's run, refreshed on a timer."""
+
+    def __init__(self, settings, title='Viewer'):
+
+        super().__init__()
+        self.settings = settings
+        self.setWindowTitle(title+' (attached to tools.daemon)')
+        self.resize(900, 700)
+        self.follower = RunFollower(settings['data']['folder'], settings['broker']['timeout'])
+        self.unit = Calibration(**settings['calibration']).unit
+        self.path = None
+        self.samples = None
+        self.curves = dict()
+        self.plotted = -1
+
+        self.plot = pg.PlotWidget()
+        self.plot.setBackground('white')
+        self.plot.setLabel('left', 'Partial Pressure (Torr)')
+        self.plot.setLabel('bottom', 'Time (s)')
+        self.plot.addLegend()
+        self.plot.setClipToView(True)
+        self.plot_fm = pg.PlotWidget()
+        self.plot_fm.setBackground('white')
+        self.plot_fm.setLabel('bottom', 'Time (s)')
+        self.plot_fm.addLegend()
+        self.plot_fm.setXLink(self.plot)
+
+        splitter = QtWidgets.QSplitter(QtCore.Qt.Vertical)
+        splitter.addWidget(self.plot)
+        splitter.addWidget(self.plot_fm)
+        self.setCentralWidget(splitter)
+        self.statusBar().showMessage('Waiting for tools.daemon to record a run...')
+
+        self.timer = QtCore.QTimer()
+        self.timer.setInterval(settings['acquisition']['refresh'])
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start()
+        self.show()
+
+    def refresh(self):
+
+        block = self.follower.poll()
+        if block is None:
+            if self.path is not None:
+                self.statusBar().showMessage('Run '+os.path.basename(self.path)+' ended, waiting for the next one...')
+            return
+        if self.follower.status['path'] != self.path:
+            self.startRun()
+        if block.shape[1] > 0:
+            self.samples.extend(block)
+        if self.samples.total != self.plotted:
+            self.updatePlot()
+            self.plotted = self.samples.total
+            self.statusBar().showMessage('Following '+os.path.basename(self.path)+': '+str(self.samples.total)+' rows')
+
+    def startRun(self):
+
+        # A new run: a new store with the ring's columns and a curve per mass and gas
+        status = self.follower.status
+        self.path = status['path']
+        if isinstance(self.samples, HistoryStore):
+            self.samples.close()
+        columns = self.follower.columns()
+        self.samples = openSampleStore(['time'] + columns[1:], self.settings, max(float(status.get('rate', 0)), 1.0))
+        self.plotted = -1
+        self.plot.clear()
+        self.plot_fm.clear()
+        kinds = {column: columnKind(column)[0] for column in columns[1:]}
+        masses = [column for column, kind in kinds.items() if kind == 'mass']
+        gases = [column for column, kind in kinds.items() if kind == 'gas']
+        # The flows when the daemon saves them, the voltages otherwise
+        flows = [column for column in gases if column.endswith(' ('+self.unit+')')]
+        self.plot_fm.setLabel('left', 'Flow  ('+self.unit+')' if flows else 'Voltage  (v)')
+        self.curves = dict()
+        for idx, column in enumerate(masses):
+            color = pg.intColor(idx)
+            self.curves[column] = self.plot.plot(name=column, pen=pg.mkPen(color, width=1), symbol='+', symbolPen=pg.mkPen(color), symbolBrush=color)
+        for idx, column in enumerate(flows or gases):
+            color = pg.intColor(idx, hues=max(len(flows or gases), 2))
+            self.curves[column] = self.plot_fm.plot(name=column, pen=color, symbol='+', symbolSize=8, symbolPen=color, symbolBrush=pg.mkBrush(color))
+
+    def updatePlot(self):
+
+        data = self.samples.envelope(None, self.plot.getViewBox().width())
+        if data is None:
+            data = self.samples.history(-np.inf, np.inf)
+        t = data[self.samples.index['time']]
+        for column, curve in self.curves.items():
+            # Each mass against the start of its own measurements, without the cycles that skipped it
+            x = t
+            if column+' start (s)' in self.samples.index:
+                x = data[self.samples.index[column+' start (s)']]
+                x = np.where(np.isfinite(x), x, t)
+            y = data[self.samples.index[column]]
+            measured = np.isfinite(y)
+            curve.setData(x[measured], y[measured])
+
+    def closeEvent(self, event):
+
+        self.timer.stop()
+        self.follower.detach()
+        if isinstance(self.samples, HistoryStore):
+            self.samples.close()
+        event.accept()
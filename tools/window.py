@@ -0,0 +1,154 @@
+"""Methods shared by the Worker and MainWindow classes of both apps.
+
+Flowmeters.py and Photoreactor Chamber.py mix these in after their Qt base
+class. The classes keep their own signals, and set the app's settings,
+metrics and calibration as attributes of the same names in __init__.
+"""
+import os
+import time
+from tools.devices import openFlowmeter, clock
+from tools.recording import readMetadata, writeMetadata, RawRecorder
+from tools.acquisition import TimingStats
+
+
+class WorkerMixin:
+    """Flowmeter channels, connection and raw recording of an app's Worker."""
+
+    def setChannels(self, channels):
+
+        # (channel, gas) of each enabled channel, the gas picks its calibration curve
+        self.channels = [channel for channel, gas in channels]
+        self.gases = [gas for channel, gas in channels]
+
+    def syncRaw(self):
+
+        # Opens or closes the raw recording to match rawTarget, which the GUI sets.
+        # Called before each read, so the recording is only used from this thread
+        target = self.rawTarget
+        if (self.raw is not None) and (target is None or target['path'] != self.raw.path):
+            self.raw.close()
+            self.raw = None
+        if (target is not None) and (self.raw is None):
+            self.raw = RawRecorder(**target)
+
+    def recordRaw(self, record):
+
+        raw = record.pop('raw', None)
+        if raw is not None:
+            self.raw.write(record, raw)
+
+    def connectDevices(self):
+
+        # Runs in the worker thread once the window is shown, so a slow or missing
+        # flowmeter neither delays the window nor stops the app from starting
+        self.progress.emit('Connecting flowmeter...')
+        try:
+            self.fm = openFlowmeter(self.settings)
+        except Exception as error:
+            self.connected.emit({'flowmeter': False, 'error': str(error)})
+            return
+        self.connected.emit({'flowmeter': True})
+
+
+class WindowMixin:
+    """Flowmeter channels, polling and run bookkeeping of an app's MainWindow.
+
+    self.channels lists (checkbox, combobox, DAQ channel, column in self.samples,
+    plot color) for each flowmeter.
+    """
+
+    def channelSelection(self):
+
+        return [(column, combobox.currentText(), color) for checkbox, combobox, channel, column, color in self.channels if checkbox.isChecked()]
+
+    def setChannels(self):
+
+        # Only the enabled channels are read by the worker
+        self.work_setChannels.emit([(channel, combobox.currentText()) for checkbox, combobox, channel, column, color in self.channels if checkbox.isChecked()])
+
+    def channelColumn(self, channel):
+
+        for checkbox, combobox, name, column, color in self.channels:
+            if name == channel:
+                return column
+
+    def flowColumn(self, column):
+
+        # Column of the flow computed from a channel's voltage
+        return column.replace('chan', 'flow')
+
+    def noiseColumn(self, column):
+
+        # Column of the standard deviation of a channel's voltage over each read
+        return column.replace('chan', 'noise')
+
+    def startClock(self):
+
+        # Times are seconds on the monotonic clock of the device reads since now
+        self.t0 = clock()
+        self.started = time.time()
+        self.timing = TimingStats()
+
+    def saveParameters(self):
+
+        # The wall time the run's times count from and the calibration curves used go in its .yml
+        par = readMetadata(self.path)
+        par['time_origin'] = self.started
+        gases = [name for column, name, color in self.channelSelection() if name in self.calibration]
+        if len(gases) > 0:
+            par['calibration'] = self.calibration.metadata(gases)
+        writeMetadata(self.path, par)
+
+    def startRaw(self):
+
+        # The raw samples are saved by the worker in its own thread, when settings ask for them
+        if self.settings['data']['raw']:
+            par = readMetadata(self.path)
+            par['raw'] = os.path.basename(self.path)+'_raw'
+            writeMetadata(self.path, par)
+            self.worker.rawTarget = {'path': self.path, 't0': self.t0,
+                                     'channels': [channel for checkbox, combobox, channel, column, color in self.channels],
+                                     'names': [combobox.currentText() for checkbox, combobox, channel, column, color in self.channels]}
+
+    def viewChanged(self, viewbox, xrange):
+
+        # Auto-range shows the whole run, a range set by panning or zooming
+        # only that range (read back from disk for the samples no longer in memory)
+        self.viewRange = None if viewbox.autoRangeEnabled()[0] else tuple(xrange)
+        self.plotted = -1
+
+    def requestData(self, request):
+
+        self.work_getData.emit(request)
+
+    def readFailed(self, request, error):
+
+        # The next tick requests again, or restarts the worker's loop once it has returned
+        self.scheduler.failed(request)
+        if self.acquiring:
+            self.acquiring = False
+            self.draining = True
+        self.statusBar().showMessage('Read failed: '+error)
+        print('Read failed: '+error)
+
+    def rateWarning(self, message):
+
+        self.label_Rate.setText(message)
+        if message:
+            print('Warning: '+message)
+
+    def stopPolling(self):
+
+        if self.scheduler.stats() is not None:
+            print('Polling stopped: '+self.scheduler.summary())
+        self.scheduler.reset()
+        self.rateWarning('')
+
+    def showDiagnostics(self, checked):
+
+        # The panel is only built the first time it is shown
+        if checked and self.diagnostics is None:
+            from tools.diagnostics import DiagnosticsPanel
+            self.diagnostics = DiagnosticsPanel(self.metrics, title=self.windowTitle()+' diagnostics')
+        if self.diagnostics is not None:
+            self.diagnostics.setVisible(checked)
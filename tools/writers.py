@@ -0,0 +1,239 @@
+import os
+import csv
+import gzip
+import time
+import shutil
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# One thread compresses the closed segments of every run, in the order they close
+compressor = None
+
+
+class CsvWriter:
+    """Keeps a run's CSV file open and writes rows in batches.
+
+    Rows are held in memory and written when flush_rows have accumulated or
+    flush_interval seconds have passed since the last flush, whichever comes
+    first. close() writes whatever is still pending.
+    """
+
+    def __init__(self, path, header=None, flush_rows=50, flush_interval=5.0):
+
+        self.path = path
+        self.flush_rows = int(flush_rows)
+        self.flush_interval = float(flush_interval)
+        self.rows = list()
+        self.written = 0
+        self.file = open(path, "w", newline='')
+        self.writer = csv.writer(self.file, delimiter=',')
+        if header is not None:
+            self.writer.writerow(header)
+            self.file.flush()
+        self.last_flush = time.monotonic()
+
+    @property
+    def pending(self):
+
+        return len(self.rows)
+
+    @property
+    def closed(self):
+
+        return self.file is None
+
+    def writerow(self, row):
+
+        self.rows.append(row)
+        if (len(self.rows) >= self.flush_rows) or (time.monotonic() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+
+        if self.file is None:
+            return
+        if len(self.rows) > 0:
+            self.writer.writerows(self.rows)
+            self.written += len(self.rows)
+            self.rows = list()
+        self.file.flush()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+
+        if self.file is None:
+            return
+        self.flush()
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.close()
+
+
+class RotatingCsvWriter(CsvWriter):
+    """CsvWriter that moves on to a new numbered segment during a long run.
+
+    The first segment is path.csv, the next ones path_001.csv, path_002.csv...
+    A new segment starts at the first flush after the current one has reached
+    `size` MB or has been open for `hours` (0 disables either), so no row is
+    split or lost. Segments rotated out are gzipped on a background thread and the
+    writer never waits for it, the last segment stays plain CSV, so a run that
+    never rotates is a plain path.csv. The segments are listed in order under
+    'segments' in the run's .yml, each as the .csv name it was written under:
+    the file is name+'.gz' once compressed (see tools.recording.csvSegments).
+    """
+
+    def __init__(self, path, header=None, flush_rows=50, flush_interval=5.0, size=0, hours=0, compress=True):
+
+        self.base = path[:-4] if path.endswith('.csv') else path
+        self.header = header
+        self.size = float(size or 0) * 1e6
+        self.seconds = float(hours or 0) * 3600
+        self.compress = bool(compress)
+        self.segments = list()
+        super().__init__(path, header, flush_rows=flush_rows, flush_interval=flush_interval)
+        self.startSegment()
+
+    def startSegment(self):
+
+        self.opened = time.monotonic()
+        self.first = self.written
+        self.segments.append({'file': os.path.basename(self.path), 'started': datetime.now().isoformat(timespec='seconds'),
+                              'compression': None})
+        self.writeManifest()
+
+    def flush(self):
+
+        # Rotating just before rows are written never leaves an empty segment
+        if (self.file is not None) and (len(self.rows) > 0) and self.full():
+            self.rotate()
+        super().flush()
+
+    def full(self):
+
+        return ((self.size > 0) and (self.file.tell() >= self.size)) or ((self.seconds > 0) and (time.monotonic() - self.opened >= self.seconds))
+
+    def rotate(self):
+
+        self.endSegment(self.compress)
+        self.path = f'{self.base}_{len(self.segments):03d}.csv'
+        self.file = open(self.path, "w", newline='')
+        self.writer = csv.writer(self.file, delimiter=',')
+        if self.header is not None:
+            self.writer.writerow(self.header)
+            self.file.flush()
+        self.startSegment()
+
+    def endSegment(self, compress=False):
+
+        self.file.close()
+        self.file = None
+        self.segments[-1]['rows'] = self.written - self.first
+        self.segments[-1]['compression'] = 'gzip' if compress else None
+        self.writeManifest()
+        if compress:
+            global compressor
+            if compressor is None:
+                compressor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='compress')
+            compressor.submit(compressFile, self.path)
+
+    def writeManifest(self):
+
+        from tools.recording import readMetadata, writeMetadata
+
+        par = readMetadata(self.base)
+        par['segments'] = self.segments
+        writeMetadata(self.base, par)
+
+    def close(self):
+
+        if self.file is None:
+            return
+        self.flush()
+        self.endSegment()
+
+
+def compressFile(path):
+
+    # Written under a temporary name first, the .csv is only removed once the .gz is complete
+    try:
+        with open(path, 'rb') as source, gzip.open(path+'.gz.tmp', 'wb') as target:
+            shutil.copyfileobj(source, target, 1 << 20)
+        os.replace(path+'.gz.tmp', path+'.gz')
+        os.remove(path)
+    except OSError as error:
+        print('Could not compress '+path+': '+str(error))
+
+
+class WriterGroup:
+    """Forwards rows to several writers, e.g. CSV and binary for the same run."""
+
+    def __init__(self, writers):
+
+        self.writers = list(writers)
+
+    @property
+    def pending(self):
+
+        return max(writer.pending for writer in self.writers)
+
+    @property
+    def closed(self):
+
+        return all(writer.closed for writer in self.writers)
+
+    def writerow(self, row):
+
+        for writer in self.writers:
+            writer.writerow(row)
+
+    def flush(self):
+
+        for writer in self.writers:
+            writer.flush()
+
+    def close(self):
+
+        for writer in self.writers:
+            writer.close()
+
+
+def runPath(folder, now=None):
+    """Returns (path, file) for a new run: folder/YYYY/YYYY.MM.DD/prcYYYYMMDD_HHMMSS, creating the day folder."""
+
+    if now is None:
+        now = datetime.now()
+    folder = folder+f'{now.year:04d}'+'/'+f'{now.year:04d}'+'.'+f'{now.month:02d}'+'.'+f'{now.day:02d}'+'/'
+    os.makedirs(folder, exist_ok=True)
+    file = 'prc'+f'{now.year:04d}'+f'{now.month:02d}'+f'{now.day:02d}'+'_'+f'{now.hour:02d}'+f'{now.minute:02d}'+f'{now.second:02d}'
+    return folder+file, file
+
+
+def openWriter(path, header, par):
+    """Opens the writer(s) for a run, par is the 'data' section of settings.yaml."""
+
+    from tools.recording import BinaryWriter
+
+    file_format = par.get('format', 'csv')
+    flush_rows = par.get('flush_rows', 50)
+    flush_interval = par.get('flush_interval', 5.0)
+    writers = list()
+    if file_format in ('csv', 'both'):
+        if par.get('rotate_mb') or par.get('rotate_hours'):
+            writers.append(RotatingCsvWriter(path+'.csv', header, flush_rows=flush_rows, flush_interval=flush_interval,
+                                             size=par.get('rotate_mb'), hours=par.get('rotate_hours'), compress=par.get('compress', True)))
+        else:
+            writers.append(CsvWriter(path+'.csv', header, flush_rows=flush_rows, flush_interval=flush_interval))
+    if file_format in ('binary', 'both'):
+        writers.append(BinaryWriter(path, header, flush_rows=flush_rows, flush_interval=flush_interval))
+    if len(writers) == 0:
+        raise ValueError('Unknown data format: '+str(file_format))
+    if len(writers) == 1:
+        return writers[0]
+    return WriterGroup(writers)